@@ -0,0 +1,60 @@
+"""
+Compare the size of task messages and the time taken to encode and decode
+them using each of huey's serializers.
+
+    $ python examples/benchmarks/serializers.py
+"""
+import datetime
+import sys
+import time
+
+sys.path.insert(0, '.')
+
+from huey.api import QueueTask
+from huey.registry import registry
+from huey.serializer import JSONSerializer
+from huey.serializer import MsgPackSerializer
+from huey.serializer import Serializer
+from huey.serializer import msgpack
+
+
+class BenchmarkTask(QueueTask):
+    pass
+
+
+def get_serializers():
+    serializers = [('pickle', Serializer()), ('json', JSONSerializer())]
+    if msgpack is not None:
+        serializers.append(('msgpack', MsgPackSerializer()))
+    return serializers
+
+
+def measure(serializer, task, n):
+    start = time.time()
+    for i in range(n):
+        msg = registry.get_message_for_task(task, serializer)
+    encode = time.time() - start
+
+    start = time.time()
+    for i in range(n):
+        registry.get_task_for_message(msg, serializer)
+    decode = time.time() - start
+    return len(msg), n / encode, n / decode
+
+
+def main(n=20000):
+    registry.register(BenchmarkTask)
+    task = BenchmarkTask(
+        ((1, 'user@example.com', 3.5), {'tags': ['a', 'b'], 'force': True}),
+        execute_time=datetime.datetime(2016, 1, 1, 12, 0, 0),
+        retries=3,
+        retry_delay=10)
+
+    print('%-10s %8s %14s %14s' % ('format', 'bytes', 'encode/s', 'decode/s'))
+    for name, serializer in get_serializers():
+        size, encode, decode = measure(serializer, task, n)
+        print('%-10s %8d %14.0f %14.0f' % (name, size, encode, decode))
+
+
+if __name__ == '__main__':
+    main()
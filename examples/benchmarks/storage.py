@@ -0,0 +1,63 @@
+"""
+Compare the time taken to enqueue, dequeue and execute tasks using the
+in-memory, file, SQLite and Redis storages. Requires a Redis server running on
+localhost.
+
+    $ python examples/benchmarks/storage.py
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, '.')
+
+from huey import FileHuey
+from huey import MemoryHuey
+from huey import RedisHuey
+from huey import SqliteHuey
+
+
+def measure(huey, n):
+    @huey.task()
+    def add(a, b):
+        return a + b
+
+    huey.flush()
+    start = time.time()
+    results = [add(i, i) for i in range(n)]
+    enqueue = time.time() - start
+
+    start = time.time()
+    for i in range(n):
+        huey.execute(huey.dequeue())
+    execute = time.time() - start
+
+    start = time.time()
+    for result in results:
+        result.get()
+    read = time.time() - start
+
+    huey.flush()
+    return n / enqueue, n / execute, n / read
+
+
+def main(n=10000):
+    print('%-10s %14s %14s %14s' % ('storage', 'enqueue/s', 'execute/s',
+                                   'result/s'))
+    tempdir = tempfile.mkdtemp()
+    filename = os.path.join(tempdir, 'huey.db')
+    try:
+        for name, huey in (('memory', MemoryHuey('benchmark')),
+                           ('file', FileHuey('benchmark', path=tempdir)),
+                           ('sqlite', SqliteHuey('benchmark',
+                                                 filename=filename)),
+                           ('redis', RedisHuey('benchmark'))):
+            print('%-10s %14.0f %14.0f %14.0f' % ((name,) + measure(huey, n)))
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main()
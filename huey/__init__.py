@@ -4,11 +4,8 @@ __version__ = '1.2.0'
 
 from huey.api import crontab
 from huey.api import Huey
-
-try:
-    from huey.storage import RedisHuey
-except ImportError:
-    class RedisHuey(object):
-        def __init__(self, *args, **kwargs):
-            raise RuntimeError('Error, "redis" is not installed. Install '
-                               'using pip: "pip install redis"')
+from huey.storage import FileHuey
+from huey.storage import MemoryHuey
+from huey.storage import RedisHuey
+from huey.storage import ShardedRedisHuey
+from huey.storage import SqliteHuey
@@ -17,6 +17,7 @@ from huey.exceptions import QueueWriteException
 from huey.exceptions import ScheduleAddException
 from huey.exceptions import ScheduleReadException
 from huey.registry import registry
+from huey.serializer import Serializer
 from huey.utils import EmptyData
 from huey.utils import local_to_utc
 from huey.utils import wrap_exception
@@ -39,6 +40,8 @@ class Huey(object):
     :param always_eager: Useful for testing, this will execute all tasks
         immediately, without enqueueing them.
     :param store_errors: Flag to indicate whether task errors should be stored.
+    :param serializer: a :py:class:`Serializer` instance used to convert task
+        messages, results and errors to bytes. Defaults to pickle.
 
     Example usage::
 
@@ -59,7 +62,7 @@ class Huey(object):
     """
     def __init__(self, name='huey', result_store=True, events=True,
                  store_none=False, always_eager=False, store_errors=True,
-                 blocking=False, **storage_kwargs):
+                 blocking=False, serializer=None, **storage_kwargs):
         self.name = name
         self.result_store = result_store
         self.events = events
@@ -67,6 +70,7 @@ class Huey(object):
         self.always_eager = always_eager
         self.store_errors = store_errors
         self.blocking = blocking
+        self.serializer = serializer or Serializer()
         self.storage = self.get_storage(**storage_kwargs)
 
     def get_storage(self, **kwargs):
@@ -74,7 +78,9 @@ class Huey(object):
                                   'Huey class. Use `RedisHuey` instead.')
 
     def task(self, retries=0, retry_delay=0, retries_as_argument=False,
-             include_task=False, name=None):
+             include_task=False, name=None, priority=0):
+        default_priority = validate_priority(priority)
+
         def decorator(func):
             """
             Decorator to execute a function out-of-band via the consumer.
@@ -87,7 +93,7 @@ class Huey(object):
                 include_task)
 
             def schedule(args=None, kwargs=None, eta=None, delay=None,
-                         convert_utc=True, task_id=None):
+                         convert_utc=True, task_id=None, priority=None):
                 if delay and eta:
                     raise ValueError('Both a delay and an eta cannot be '
                                      'specified at the same time')
@@ -101,7 +107,9 @@ class Huey(object):
                     execute_time=eta,
                     retries=retries,
                     retry_delay=retry_delay,
-                    task_id=task_id)
+                    task_id=task_id,
+                    priority=default_priority if priority is None
+                    else validate_priority(priority))
                 return self.enqueue(cmd)
 
             func.schedule = schedule
@@ -112,10 +120,24 @@ class Huey(object):
                 cmd = klass(
                     (args, kwargs),
                     retries=retries,
-                    retry_delay=retry_delay)
+                    retry_delay=retry_delay,
+                    priority=default_priority)
                 return self.enqueue(cmd)
 
+            def map(iterable):
+                cmds = []
+                for args in iterable:
+                    if not isinstance(args, tuple):
+                        args = (args,)
+                    cmds.append(klass(
+                        (args, {}),
+                        retries=retries,
+                        retry_delay=retry_delay,
+                        priority=default_priority))
+                return self.enqueue_many(cmds)
+
             inner_run.call_local = func
+            inner_run.map = map
             return inner_run
         return decorator
 
@@ -164,13 +186,37 @@ class Huey(object):
         return decorator
 
     @_wrapped_operation(QueueWriteException)
-    def _enqueue(self, msg):
-        self.storage.enqueue(msg)
+    def _enqueue(self, msg, priority=0):
+        self.storage.enqueue(msg, priority)
+
+    @_wrapped_operation(QueueWriteException)
+    def _enqueue_many(self, messages, priority=0):
+        self.storage.enqueue_many(messages, priority)
 
     @_wrapped_operation(QueueReadException)
     def _dequeue(self):
         return self.storage.dequeue()
 
+    @_wrapped_operation(QueueReadException)
+    def _dequeue_many(self, n):
+        return self.storage.dequeue_many(n)
+
+    @_wrapped_operation(QueueWriteException)
+    def _requeue(self, messages, priority=0):
+        self.storage.requeue(messages, priority)
+
+    @_wrapped_operation(QueueRemoveException)
+    def _ack(self, message):
+        self.storage.ack(message)
+
+    @_wrapped_operation(QueueWriteException)
+    def _touch(self, message):
+        return self.storage.touch(message)
+
+    @_wrapped_operation(QueueWriteException)
+    def _requeue_expired(self):
+        return self.storage.requeue_expired()
+
     @_wrapped_operation(QueueRemoveException)
     def _unqueue(self, msg):
         return self.queue.unqueue(msg)
@@ -182,25 +228,42 @@ class Huey(object):
         else:
             return self.storage.pop_data(key)
 
+    @_wrapped_operation(DataStoreGetException)
+    def _get_data_many(self, keys, peek=False):
+        return self.storage.get_data_many(keys, peek=peek)
+
+    @_wrapped_operation(DataStoreGetException)
+    def _wait_for_data(self, key, timeout=None):
+        return self.storage.wait_for_data(key, timeout)
+
     @_wrapped_operation(DataStorePutException)
     def _put_data(self, key, value):
         return self.storage.put_data(key, value)
 
     @_wrapped_operation(DataStorePutException)
-    def _put_error(self, metadata):
-        self.storage.put_error(metadata)
+    def _put_result(self, key, value):
+        return self.storage.put_result(key, value)
+
+    @_wrapped_operation(DataStorePutException)
+    def _put_error(self, metadata, task_name=None):
+        self.storage.put_error(metadata, task_name)
 
     @_wrapped_operation(DataStoreGetException)
-    def _get_errors(self, limit=None, offset=0):
-        return self.storage.get_errors(limit=limit, offset=offset)
+    def _get_errors(self, limit=None, offset=0, task_name=None):
+        return self.storage.get_errors(limit=limit, offset=offset,
+                                       task_name=task_name)
 
     @_wrapped_operation(ScheduleAddException)
-    def _add_to_schedule(self, data, ts):
-        self.storage.add_to_schedule(data, ts)
+    def _add_to_schedule(self, data, ts, priority=0):
+        self.storage.add_to_schedule(data, ts, priority)
+
+    @_wrapped_operation(ScheduleReadException)
+    def _read_schedule(self, ts, limit=None):
+        return self.storage.read_schedule(ts, limit)
 
     @_wrapped_operation(ScheduleReadException)
-    def _read_schedule(self, ts):
-        return self.storage.read_schedule(ts)
+    def _promote_schedule(self, ts, limit=None):
+        return self.storage.promote_schedule(ts, limit)
 
     def emit(self, message):
         try:
@@ -214,15 +277,91 @@ class Huey(object):
         if self.always_eager:
             return task.execute()
 
-        self._enqueue(registry.get_message_for_task(task))
+        msg = registry.get_message_for_task(task, self.serializer)
+        self._enqueue(msg, task.priority)
 
         if self.result_store:
             return TaskResultWrapper(self, task)
 
+    def enqueue_many(self, tasks):
+        """
+        Enqueue a sequence of tasks using as few round-trips to the storage
+        as possible. If a result store is configured, a single
+        :py:class:`TaskResultGroup` is returned for all the tasks.
+        """
+        tasks = list(tasks)
+        if self.always_eager:
+            return [task.execute() for task in tasks]
+
+        for priority, group in self._group_by_priority(tasks):
+            self._enqueue_many([
+                registry.get_message_for_task(task, self.serializer)
+                for task in group], priority)
+
+        if self.result_store:
+            return TaskResultGroup(self, [task.task_id for task in tasks])
+
+    def _task_for_message(self, message):
+        task = registry.get_task_for_message(message, self.serializer)
+        task.message = message
+        return task
+
     def dequeue(self):
         message = self._dequeue()
         if message:
-            return registry.get_task_for_message(message)
+            return self._task_for_message(message)
+
+    def dequeue_many(self, n):
+        """
+        Dequeue up to ``n`` tasks in a single operation, returning them in the
+        order they would have been dequeued one at a time.
+        """
+        return [self._task_for_message(message)
+                for message in self._dequeue_many(n)]
+
+    def requeue(self, tasks):
+        """
+        Return tasks that were dequeued but never started to the front of the
+        queue, so they are the next to be dequeued.
+        """
+        for priority, group in self._group_by_priority(tasks):
+            self._requeue([
+                task.message or
+                registry.get_message_for_task(task, self.serializer)
+                for task in group], priority)
+
+    def _group_by_priority(self, tasks):
+        # Split tasks into groups of equal priority, preserving their order.
+        groups = {}
+        for task in tasks:
+            groups.setdefault(task.priority, []).append(task)
+        return sorted(groups.items(), reverse=True)
+
+    def acknowledge(self, task):
+        """
+        Signal to the storage that a dequeued task has been handled and can be
+        forgotten. Only has an effect when the storage tracks in-flight tasks.
+        """
+        if task.message is not None:
+            self._ack(task.message)
+
+    def touch(self, task):
+        """
+        Restart the visibility timeout of a dequeued task, for a task that
+        has waited to be run since it was dequeued. Returns ``False`` if the
+        task has already been returned to the queue because its visibility
+        timeout expired, in which case it should not be run.
+        """
+        if task.message is None:
+            return True
+        return self._touch(task.message)
+
+    def requeue_expired(self):
+        """
+        Return in-flight tasks whose visibility timeout has expired to the
+        queue. Returns the number of tasks that were requeued.
+        """
+        return self._requeue_expired()
 
     def _format_time(self, dt):
         if dt is None:
@@ -235,7 +374,8 @@ class Huey(object):
             'task': type(task).__name__,
             'retries': task.retries,
             'retry_delay': task.retry_delay,
-            'execute_time': self._format_time(task.execute_time)}
+            'execute_time': self._format_time(task.execute_time),
+            'priority': task.priority}
         if include_data and not isinstance(task, PeriodicQueueTask):
             targs, tkwargs = task.get_data()
             if tkwargs.get("task") and isinstance(tkwargs["task"], QueueTask):
@@ -265,18 +405,39 @@ class Huey(object):
         try:
             result = task.execute()
         except Exception as exc:
-            if self.result_store and self.store_errors:
-                metadata = self._get_task_metadata(task, True)
-                metadata['error'] = exc
-                metadata['traceback'] = traceback.format_exc()
-                self._put_error(pickle.dumps(metadata))
+            self.store_error(task, exc, traceback.format_exc())
             raise
 
+        return self.store_result(task, result)
+
+    def store_error(self, task, exc, tb):
+        """
+        Store the error raised by a task, as :py:meth:`execute` does. Used by
+        workers that run the task themselves.
+        """
+        if self.result_store and self.store_errors:
+            metadata = self._get_task_metadata(task, True)
+            metadata['error'] = exc
+            metadata['traceback'] = tb
+            self._put_error(self.serializer.serialize_error(metadata),
+                            metadata['task'])
+
+    def store_result(self, task, result):
+        """
+        Store the value returned by a task, as :py:meth:`execute` does. Used
+        by workers that run the task themselves.
+        """
         if result is None and not self.store_none:
             return
 
         if self.result_store and not isinstance(task, PeriodicQueueTask):
-            self._put_data(task.task_id, pickle.dumps(result))
+            try:
+                value = self.serializer.serialize(result)
+            except Exception:
+                # The task itself succeeded, so this is reported as a failure
+                # to store its result rather than as an error in the task.
+                wrap_exception(DataStorePutException)
+            self._put_result(task.task_id, value)
 
         return result
 
@@ -301,13 +462,22 @@ class Huey(object):
         return revoke_until is None or revoke_until > dt
 
     def add_schedule(self, task):
-        msg = registry.get_message_for_task(task)
+        msg = registry.get_message_for_task(task, self.serializer)
         ex_time = task.execute_time or datetime.datetime.fromtimestamp(0)
-        self._add_to_schedule(msg, ex_time)
+        self._add_to_schedule(msg, ex_time, task.priority)
 
-    def read_schedule(self, ts):
-        return [registry.get_task_for_message(m)
-                for m in self._read_schedule(ts)]
+    def read_schedule(self, ts, limit=None):
+        return [registry.get_task_for_message(m, self.serializer)
+                for m in self._read_schedule(ts, limit)]
+
+    def promote_schedule(self, ts, limit=None):
+        """
+        Move up to ``limit`` tasks that are due at ``ts`` from the schedule to
+        the queue within the storage, without deserializing them. Returns the
+        number of tasks moved, or ``None`` if the storage does not support
+        this, in which case :py:meth:`read_schedule` should be used.
+        """
+        return self._promote_schedule(ts, limit)
 
     def read_periodic(self, ts):
         periodic = registry.get_periodic_tasks()
@@ -319,29 +489,71 @@ class Huey(object):
         return cmd.execute_time is None or cmd.execute_time <= dt
 
     def pending(self, limit=None):
-        return [registry.get_task_for_message(m)
+        return [registry.get_task_for_message(m, self.serializer)
                 for m in self.storage.enqueued_items(limit)]
 
+    def iter_pending(self, chunk_size=1000):
+        """
+        Generate the tasks in the queue, reading ``chunk_size`` messages from
+        the storage at a time and deserializing each task as it is reached.
+        """
+        for message in self.storage.iter_enqueued(chunk_size):
+            yield registry.get_task_for_message(message, self.serializer)
+
     def pending_count(self):
         return self.storage.queue_size()
 
     def scheduled(self, limit=None):
-        return [registry.get_task_for_message(m)
+        return [registry.get_task_for_message(m, self.serializer)
                 for m in self.storage.scheduled_items(limit)]
 
+    def iter_scheduled(self, chunk_size=1000):
+        """
+        Generate the tasks in the schedule, in no particular order, reading
+        ``chunk_size`` messages from the storage at a time.
+        """
+        for message in self.storage.iter_scheduled(chunk_size):
+            yield registry.get_task_for_message(message, self.serializer)
+
     def scheduled_count(self):
         return self.storage.schedule_size()
 
     def all_results(self):
         return self.storage.result_items()
 
+    def iter_results(self, chunk_size=1000):
+        """
+        Generate ``(key, value)`` pairs from the result store, as returned by
+        :py:meth:`all_results`, reading ``chunk_size`` entries at a time.
+        """
+        return self.storage.iter_results(chunk_size)
+
     def result_count(self):
         return self.storage.result_store_size()
 
-    def errors(self, limit=None, offset=0):
+    def errors(self, limit=None, offset=0, task=None):
+        """
+        Return stored task errors, most recent first. If ``task`` is given,
+        either as a decorated function or a task name, only the errors of
+        that task are returned. Filtering requires the storage to keep a
+        per-task error index.
+        """
+        if hasattr(task, 'task_class'):
+            task = task.task_class.__name__
         return [
-            pickle.loads(error)
-            for error in self.storage.get_errors(limit, offset)]
+            self.serializer.deserialize(error)
+            for error in self.storage.get_errors(limit, offset, task)]
+
+    def iter_errors(self, task=None, chunk_size=1000):
+        """
+        Generate stored task errors, most recent first, reading
+        ``chunk_size`` errors from the storage at a time. ``task`` has the
+        same meaning as it does for :py:meth:`errors`.
+        """
+        if hasattr(task, 'task_class'):
+            task = task.task_class.__name__
+        for error in self.storage.iter_errors(chunk_size, task):
+            yield self.serializer.deserialize(error)
 
     def __len__(self):
         return self.pending_count()
@@ -370,7 +582,7 @@ class Huey(object):
         if not blocking:
             result = self._get_data(task_id, peek=preserve)
             if result is not EmptyData:
-                return pickle.loads(result)
+                return self.serializer.deserialize(result)
         else:
             task_result = TaskResultWrapper(self, QueueTask(task_id=task_id))
             return task_result.get(
@@ -381,6 +593,67 @@ class Huey(object):
                 revoke_on_timeout=revoke_on_timeout,
                 preserve=preserve)
 
+    def get_results(self, tasks, blocking=False, timeout=None, backoff=1.15,
+                    max_delay=1.0, revoke_on_timeout=False, preserve=False):
+        """
+        Retrieve the results of several tasks at once, given a list of
+        :py:class:`TaskResultWrapper` objects and/or task IDs. All results
+        are fetched using a single request to the storage, and when blocking,
+        each subsequent request asks only for the results still missing.
+        Returns a list of results in the same order, using ``None`` for
+        results that are not ready.
+        """
+        task_ids = []
+        wrappers = []
+        cache = {}
+        for task in tasks:
+            if isinstance(task, TaskResultWrapper):
+                wrappers.append(task)
+                task_id = task.task.task_id
+                if task._result is not EmptyData:
+                    cache[task_id] = task._result
+            else:
+                task_id = task
+            task_ids.append(task_id)
+
+        try:
+            self._get_results(task_ids, cache, blocking, timeout, backoff,
+                              max_delay, revoke_on_timeout, preserve)
+        finally:
+            for wrapper in wrappers:
+                if wrapper.task.task_id in cache:
+                    wrapper._result = cache[wrapper.task.task_id]
+
+        return [cache.get(task_id) for task_id in task_ids]
+
+    def _get_results(self, task_ids, cache, blocking, timeout, backoff,
+                     max_delay, revoke_on_timeout, preserve):
+        # Populate the cache, a dict of task id -> result, with the results
+        # of the given tasks.
+        start = time.time()
+        delay = .1
+        missing = []
+        for task_id in task_ids:
+            if task_id not in cache and task_id not in missing:
+                missing.append(task_id)
+
+        while missing:
+            data = self._get_data_many(missing, peek=preserve)
+            for task_id, value in zip(missing, data):
+                if value is not EmptyData:
+                    cache[task_id] = self.serializer.deserialize(value)
+            missing = [task_id for task_id in missing if task_id not in cache]
+            if not missing or not blocking:
+                break
+
+            if timeout and time.time() - start >= timeout:
+                if revoke_on_timeout:
+                    for task_id in missing:
+                        self.revoke(QueueTask(task_id=task_id))
+                raise DataStoreTimeout
+            time.sleep(min(delay, max_delay))
+            delay *= backoff
+
 
 class TaskResultWrapper(object):
     """
@@ -420,7 +693,7 @@ class TaskResultWrapper(object):
             res = self.huey._get_data(task_id)
 
             if res is not EmptyData:
-                self._result = pickle.loads(res)
+                self._result = self.huey.serializer.deserialize(res)
                 return self._result
             else:
                 return res
@@ -437,15 +710,23 @@ class TaskResultWrapper(object):
             start = time.time()
             delay = .1
             while self._result is EmptyData:
-                if timeout and time.time() - start >= timeout:
+                remaining = timeout and timeout - (time.time() - start)
+                if timeout and remaining <= 0:
                     if revoke_on_timeout:
                         self.revoke()
                     raise DataStoreTimeout
                 if delay > max_delay:
                     delay = max_delay
                 if self._get() is EmptyData:
-                    time.sleep(delay)
-                    delay *= backoff
+                    # Block until the consumer signals the result is ready,
+                    # or poll if the storage does not support this. A signal
+                    # wakes a single waiter, so others check the result again
+                    # at least every max_delay seconds.
+                    task_id = self.task.task_id
+                    wait = min(remaining, max_delay) if timeout else max_delay
+                    if not self.huey._wait_for_data(task_id, wait):
+                        time.sleep(delay)
+                        delay *= backoff
 
             return self._result
 
@@ -456,6 +737,48 @@ class TaskResultWrapper(object):
         self.huey.restore(self.task)
 
 
+class TaskResultGroup(object):
+    """
+    Lightweight handle to the results of a group of tasks that were enqueued
+    together, as returned by :py:meth:`Huey.enqueue_many` and by calling
+    ``map()`` on a decorated function::
+
+        @huey.task()
+        def add(a, b):
+            return a + b
+
+        group = add.map([(1, 2), (3, 4), (5, 6)])
+
+        # Block until all results are ready, waiting at most 10 seconds.
+        print group.get(blocking=True, timeout=10)  # Prints [3, 7, 11]
+
+    Only the task IDs are kept around, results that have been read are
+    cached on the group.
+    """
+    def __init__(self, huey, task_ids):
+        self.huey = huey
+        self.task_ids = task_ids
+        self._results = {}
+
+    def __len__(self):
+        return len(self.task_ids)
+
+    def __call__(self, *args, **kwargs):
+        return self.get(*args, **kwargs)
+
+    def get(self, blocking=False, timeout=None, backoff=1.15, max_delay=1.0,
+            revoke_on_timeout=False, preserve=False):
+        self.huey._get_results(self.task_ids, self._results, blocking,
+                               timeout, backoff, max_delay, revoke_on_timeout,
+                               preserve)
+        return [self._results.get(task_id) for task_id in self.task_ids]
+
+    def revoke(self):
+        for task_id in self.task_ids:
+            if task_id not in self._results:
+                self.huey.revoke(QueueTask(task_id=task_id))
+
+
 def with_metaclass(meta, base=object):
     return meta("NewBase", (base,), {})
 
@@ -493,15 +816,19 @@ class QueueTask(with_metaclass(QueueTaskMetaClass)):
     """
 
     def __init__(self, data=None, task_id=None, execute_time=None, retries=0,
-                 retry_delay=0):
+                 retry_delay=0, priority=0):
         self.set_data(data)
         self.task_id = task_id or self.create_id()
         self.revoke_id = 'r:%s' % self.task_id
         self.execute_time = execute_time
         self.retries = retries
         self.retry_delay = retry_delay
+        self.priority = priority or 0
         self.name = type(self).__name__
 
+        # The raw message the task was read from, if it was dequeued.
+        self.message = None
+
     def __repr__(self):
         rep = '%s: %s' % (self.name, self.task_id)
         if self.execute_time:
@@ -551,6 +878,7 @@ def create_task(task_class, func, retries_as_argument=False, task_name=None,
 
     attrs = {
         'execute': execute,
+        'func': staticmethod(func),
         '__module__': func.__module__,
         '__doc__': func.__doc__
     }
@@ -564,6 +892,18 @@ def create_task(task_class, func, retries_as_argument=False, task_name=None,
 
     return klass
 
+def validate_priority(priority):
+    # Priorities name the storage's queue lists, so they must be integers.
+    # Integral values of other types, such as 5.0 or '5', are converted.
+    try:
+        value = int(priority or 0)
+        integral = value == float(priority or 0)
+    except (TypeError, ValueError):
+        integral = False
+    if not integral:
+        raise ValueError('Priority must be an integer, got %r' % (priority,))
+    return value
+
 dash_re = re.compile('(\d+)-(\d+)')
 every_re = re.compile('\*\/(\d+)')
 
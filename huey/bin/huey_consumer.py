@@ -68,11 +68,19 @@ def get_option_parser():
        type='int',
        help='number of worker threads/processes (default=1)',
        default=1)
+    worker_opts.add_option('--min-workers',
+       dest='min_workers',
+       type='int',
+       help='fewest workers to run when autoscaling (default=1)')
+    worker_opts.add_option('--max-workers',
+       dest='max_workers',
+       type='int',
+       help='most workers to run, enables autoscaling')
     worker_opts.add_option('-k', '--worker-type',
        dest='worker_type',
-       help='worker execution model (thread, greenlet, process).',
+       help='worker execution model (thread, greenlet, process, asyncio).',
        default='thread',
-       choices=['greenlet', 'thread', 'process', 'gevent'])
+       choices=['greenlet', 'thread', 'process', 'gevent', 'asyncio'])
     worker_opts.add_option('-d', '--delay',
        dest='initial_delay',
        type='float',
@@ -88,6 +96,31 @@ def get_option_parser():
        type='float',
        help='amount to backoff delay when no results present (default=1.15)',
        default=1.15)
+    worker_opts.add_option('-p', '--prefetch',
+       dest='prefetch',
+       type='int',
+       help=('number of tasks each worker, or the dispatcher, dequeues at a '
+             'time (default=1)'),
+       default=1)
+    worker_opts.add_option('--dispatcher',
+       action='store_true',
+       dest='dispatcher',
+       help='read tasks with a single dispatcher that hands them to workers',
+       default=False)
+    worker_opts.add_option('--queue-size',
+       dest='queue_size',
+       type='int',
+       help=('most tasks the dispatcher holds for the workers '
+             '(default=number of workers)'))
+    worker_opts.add_option('--max-tasks-per-child',
+       dest='max_tasks_per_child',
+       type='int',
+       help='replace worker processes after they have run this many tasks')
+    worker_opts.add_option('--max-memory-per-child',
+       dest='max_memory_per_child',
+       type='int',
+       help=('replace worker processes once their resident memory exceeds '
+             'this many kilobytes'))
 
     scheduler_opts = parser.add_option_group(
         'Scheduler',
@@ -158,7 +191,14 @@ def consumer_main():
         options.max_delay,
         options.utc,
         options.scheduler_interval,
-        options.worker_type)
+        options.worker_type,
+        options.prefetch,
+        max_tasks_per_child=options.max_tasks_per_child,
+        max_memory_per_child=options.max_memory_per_child,
+        min_workers=options.min_workers,
+        max_workers=options.max_workers,
+        dispatcher=options.dispatcher,
+        queue_size=options.queue_size)
     consumer.run()
 
 
@@ -1,29 +1,50 @@
 import datetime
 import logging
+import math
 import os
 import signal
+import sys
 import threading
 import time
 from collections import defaultdict
+from collections import deque
 
 from multiprocessing import Event as ProcessEvent
 from multiprocessing import Process
+from multiprocessing import Queue as ProcessQueue
+
+try:
+    from queue import Empty
+    from queue import Full
+    from queue import Queue
+except ImportError:
+    from Queue import Empty
+    from Queue import Full
+    from Queue import Queue
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 try:
     import gevent
     from gevent import Greenlet
     from gevent.event import Event as GreenEvent
+    from gevent.queue import Queue as GreenQueue
 except ImportError:
-    Greenlet = GreenEvent = None
+    Greenlet = GreenEvent = GreenQueue = None
 
 from huey.exceptions import DataStoreGetException
 from huey.exceptions import QueueException
 from huey.exceptions import QueueReadException
+from huey.exceptions import QueueRemoveException
 from huey.exceptions import DataStorePutException
 from huey.exceptions import QueueWriteException
 from huey.exceptions import ScheduleAddException
 from huey.exceptions import ScheduleReadException
 from huey.registry import registry
+from huey.utils import load_class
 
 
 EVENT_CHECKING_PERIODIC = 'checking-periodic'
@@ -36,6 +57,7 @@ EVENT_ERROR_TASK = 'error-task'
 EVENT_FINISHED = 'finished'
 EVENT_RETRYING = 'retrying'
 EVENT_REVOKED = 'revoked'
+EVENT_SCALED = 'scaled'
 EVENT_SCHEDULED = 'scheduled'
 EVENT_SCHEDULING_PERIODIC = 'scheduling-periodic'
 EVENT_STARTED = 'started'
@@ -46,11 +68,31 @@ def to_timestamp(dt):
     if dt:
         return time.mktime(dt.timetuple())
 
+def get_rss():
+    """
+    Return the resident set size of the current process in kilobytes, or
+    ``None`` if it cannot be determined.
+    """
+    try:
+        with open('/proc/self/statm') as fh:
+            pages = int(fh.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    if resource is not None:
+        # Elsewhere only the peak size is available, which is reported in
+        # bytes on OS X and kilobytes on other platforms.
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss // 1024 if sys.platform == 'darwin' else rss
+
 class BaseProcess(object):
     def __init__(self, huey, utc):
         self.huey = huey
         self.utc = utc
 
+        # Set when the process should stop of its own accord.
+        self.exiting = False
+
     def get_now(self):
         if self.utc:
             return datetime.datetime.utcnow()
@@ -75,23 +117,97 @@ class BaseProcess(object):
         else:
             self._logger.debug('Enqueued task: %s' % task)
 
+    def enqueue_many(self, tasks):
+        try:
+            self.huey.enqueue_many(tasks)
+        except QueueWriteException:
+            for task in tasks:
+                self.huey.emit_task(EVENT_ERROR_ENQUEUEING, task, error=True)
+            self._logger.error('Error enqueueing %s tasks' % len(tasks))
+            return False
+        else:
+            self._logger.debug('Enqueued %s tasks' % len(tasks))
+            return True
+
+    def add_schedule(self, task):
+        self._logger.info('Adding %s to schedule' % task)
+        try:
+            self.huey.add_schedule(task)
+        except ScheduleAddException:
+            self.huey.emit_task(EVENT_ERROR_SCHEDULING, task, error=True)
+            self._logger.error('Error adding task to schedule: %s' % task)
+        else:
+            self.huey.emit_task(EVENT_SCHEDULED, task)
+
     def loop(self, now=None):
         raise NotImplementedError
 
+    def shutdown(self):
+        pass
+
 
 class Worker(BaseProcess):
-    def __init__(self, huey, default_delay, max_delay, backoff, utc):
+    # Longest time to wait for a message from the dispatcher before checking
+    # whether the worker should stop.
+    queue_timeout = 1
+
+    def __init__(self, huey, default_delay, max_delay, backoff, utc,
+                 prefetch=1, max_tasks=None, max_memory=None, busy=None,
+                 work_queue=None):
         self.delay = self.default_delay = default_delay
         self.max_delay = max_delay
         self.backoff = backoff
+        self.prefetch = prefetch
+        self.max_tasks = max_tasks
+        self.max_memory = max_memory
+        self.tasks_handled = 0
+        # Event that is set while a task is being handled, so the consumer
+        # can tell how many of its workers are busy.
+        self.busy = busy
+        # Queue of messages handed out by the consumer's dispatcher. When
+        # given, the worker never reads from the storage itself.
+        self.work_queue = work_queue
+        self._buffer = deque()
         self._logger = logging.getLogger('huey.consumer.Worker')
         super(Worker, self).__init__(huey, utc)
 
+    def get_task(self):
+        # Tasks that waited in a buffer or in the work queue have their
+        # visibility timeout restarted before they are run.
+        if self.work_queue is not None:
+            try:
+                message = self.work_queue.get(timeout=self.queue_timeout)
+            except Empty:
+                return
+            task = self.huey._task_for_message(message)
+            if self.touch(task):
+                return task
+            return
+        if self.prefetch <= 1:
+            return self.huey.dequeue()
+        if not self._buffer:
+            self._buffer.extend(self.huey.dequeue_many(self.prefetch))
+        while self._buffer:
+            task = self._buffer.popleft()
+            if self.touch(task):
+                return task
+
+    def touch(self, task):
+        try:
+            if self.huey.touch(task):
+                return True
+        except QueueWriteException:
+            self._logger.exception('Error refreshing task: %s' % task)
+            return True
+        self._logger.warning('Skipping %s, its visibility timeout expired '
+                             'before it could be run' % task)
+        return False
+
     def loop(self, now=None):
         task = None
         exc_raised = True
         try:
-            task = self.huey.dequeue()
+            task = self.get_task()
         except QueueReadException as exc:
             self.huey.emit_status(EVENT_ERROR_DEQUEUEING, error=True)
             self._logger.exception('Error reading from queue')
@@ -108,10 +224,34 @@ class Worker(BaseProcess):
 
         if task:
             self.delay = self.default_delay
-            self.handle_task(task, now or self.get_now())
-        elif exc_raised or not self.huey.blocking:
+            if self.busy is not None:
+                self.busy.set()
+            try:
+                self.handle_task(task, now or self.get_now())
+            finally:
+                self.acknowledge(task)
+                if self.busy is not None:
+                    self.busy.clear()
+            self.tasks_handled += 1
+            self.check_limits()
+        elif exc_raised or not (self.huey.blocking or
+                                self.work_queue is not None):
             self.sleep()
 
+    def check_limits(self):
+        # Once a limit is reached the worker exits after the current task,
+        # returning any prefetched tasks to the front of the queue, and is
+        # replaced by the consumer.
+        if self.max_tasks and self.tasks_handled >= self.max_tasks:
+            self._logger.info('Exiting after %s tasks' % self.tasks_handled)
+            self.exiting = True
+        elif self.max_memory:
+            rss = get_rss()
+            if rss is not None and rss > self.max_memory:
+                self._logger.info('Exiting, memory usage of %sKB exceeds '
+                                  '%sKB' % (rss, self.max_memory))
+                self.exiting = True
+
     def sleep(self):
         if self.delay > self.max_delay:
             self.delay = self.max_delay
@@ -120,6 +260,17 @@ class Worker(BaseProcess):
         time.sleep(self.delay)
         self.delay *= self.backoff
 
+    def shutdown(self):
+        if self._buffer:
+            tasks = list(self._buffer)
+            self._buffer.clear()
+            self._logger.info('Returning %s prefetched tasks to the queue' %
+                              len(tasks))
+            try:
+                self.huey.requeue(tasks)
+            except QueueWriteException:
+                self._logger.exception('Error returning prefetched tasks')
+
     def handle_task(self, task, ts):
         if not self.huey.ready_to_run(task, ts):
             self.add_schedule(task)
@@ -177,15 +328,12 @@ class Worker(BaseProcess):
         else:
             self.enqueue(task)
 
-    def add_schedule(self, task):
-        self._logger.info('Adding %s to schedule' % task)
+    def acknowledge(self, task):
         try:
-            self.huey.add_schedule(task)
-        except ScheduleAddException:
-            self.huey.emit_task(EVENT_ERROR_SCHEDULING, task, error=True)
-            self._logger.error('Error adding task to schedule: %s' % task)
-        else:
-            self.huey.emit_task(EVENT_SCHEDULED, task)
+            self.huey.acknowledge(task)
+        except QueueRemoveException:
+            self.huey.emit_task(EVENT_ERROR_INTERNAL, task, error=True)
+            self._logger.exception('Error acknowledging task: %s' % task)
 
     def is_revoked(self, task, ts):
         try:
@@ -199,10 +347,11 @@ class Worker(BaseProcess):
 
 
 class Scheduler(BaseProcess):
-    def __init__(self, huey, interval, utc, periodic):
+    def __init__(self, huey, interval, utc, periodic, batch_size=1000):
         super(Scheduler, self).__init__(huey, utc)
         self.interval = min(interval, 60)
         self.periodic = periodic
+        self.batch_size = batch_size
         if periodic:
             # Determine the periodic task interval.
             self._q, self._r = divmod(60, self.interval)
@@ -215,9 +364,8 @@ class Scheduler(BaseProcess):
         now = now or self.get_now()
         start = time.time()
 
-        for task in self.huey.read_schedule(now):
-            self._logger.info('Scheduling %s for execution' % task)
-            self.enqueue(task)
+        self.enqueue_scheduled(now)
+        self.requeue_expired()
 
         should_sleep = True
         if self.periodic:
@@ -245,6 +393,196 @@ class Scheduler(BaseProcess):
             self.sleep_for_interval(start, self.interval)
 
 
+    def enqueue_scheduled(self, now):
+        # Move tasks that are due from the schedule to the queue, a batch at
+        # a time, so that a large backlog does not monopolize the storage or
+        # have to be held in memory all at once. Where the storage supports
+        # it, tasks are moved without leaving the storage.
+        while True:
+            n = self.huey.promote_schedule(now, self.batch_size)
+            if n is None:
+                break
+            if n:
+                self._logger.info('Moved %s scheduled tasks to the queue' % n)
+            if n < self.batch_size:
+                return
+
+        while True:
+            tasks = self.huey.read_schedule(now, self.batch_size)
+            for task in tasks:
+                self._logger.info('Scheduling %s for execution' % task)
+            if tasks and not self.enqueue_many(tasks):
+                # The batch has already been removed from the schedule, so
+                # put it back to be retried on the next pass rather than
+                # losing it, and stop until then.
+                for task in tasks:
+                    self.add_schedule(task)
+                break
+            if len(tasks) < self.batch_size:
+                break
+
+    def requeue_expired(self):
+        try:
+            while True:
+                n = self.huey.requeue_expired()
+                if not n:
+                    break
+                self._logger.warning('Requeued %s expired in-flight tasks' % n)
+        except QueueWriteException:
+            self._logger.exception('Error requeueing expired tasks')
+
+
+class Dispatcher(BaseProcess):
+    """
+    Reads messages from the storage, up to ``batch_size`` at a time, and
+    hands them to the workers through ``work_queue``, so that a single reader,
+    blocking on the storage where it can, feeds all of the consumer's workers.
+    Once the work queue is full the dispatcher waits for the workers to catch
+    up before reading any more. A storage that does not block is polled every
+    ``delay`` seconds, without backing off, as the dispatcher alone stands
+    between a new task and the idle workers.
+    """
+    # Longest time to wait for room in the work queue before checking whether
+    # the dispatcher should stop.
+    queue_timeout = 1
+
+    def __init__(self, huey, work_queue, delay, utc, batch_size=1):
+        super(Dispatcher, self).__init__(huey, utc)
+        self.work_queue = work_queue
+        self.batch_size = batch_size
+        self.delay = delay
+        # Messages read from the storage that are yet to be handed out.
+        self._pending = deque()
+        self._logger = logging.getLogger('huey.consumer.Dispatcher')
+
+    def fetch(self):
+        if self.batch_size <= 1:
+            message = self.huey._dequeue()
+            return [message] if message else []
+        return self.huey._dequeue_many(self.batch_size)
+
+    def loop(self, now=None):
+        if not self._pending:
+            exc_raised = True
+            try:
+                self._pending.extend(self.fetch())
+            except QueueException:
+                self.huey.emit_status(EVENT_ERROR_DEQUEUEING, error=True)
+                self._logger.exception('Error reading from queue')
+            except KeyboardInterrupt:
+                raise
+            except:
+                self.huey.emit_status(EVENT_ERROR_DEQUEUEING, error=True)
+                self._logger.exception('Unknown exception dequeueing task.')
+            else:
+                exc_raised = False
+
+            if not self._pending:
+                if exc_raised or not self.huey.blocking:
+                    self.sleep()
+                return
+
+        # Returning while the queue is full lets the consumer stop the
+        # dispatcher; anything not handed out is requeued on shutdown.
+        while self._pending:
+            try:
+                self.work_queue.put(self._pending[0],
+                                    timeout=self.queue_timeout)
+            except Full:
+                return
+            self._pending.popleft()
+
+    def sleep(self):
+        self._logger.debug('No messages, sleeping for: %s' % self.delay)
+        time.sleep(self.delay)
+
+    def shutdown(self):
+        if self._pending:
+            messages = list(self._pending)
+            self._pending.clear()
+            self._logger.info('Returning %s undispatched tasks to the queue' %
+                              len(messages))
+            try:
+                self.huey.requeue([self.huey._task_for_message(message)
+                                   for message in messages])
+            except QueueWriteException:
+                self._logger.exception('Error returning undispatched tasks')
+
+
+class Autoscaler(object):
+    """
+    Decides how many workers the consumer should run. The size of the queue
+    and the number of busy workers are sampled every ``sample_interval``
+    seconds, and once ``window`` seconds of samples have been collected their
+    averages are used to make a decision:
+
+    * if tasks are waiting and at least ``grow_threshold`` of the workers are
+      busy, workers are added, at most doubling the number running.
+    * if no tasks are waiting and at most ``shrink_threshold`` of the workers
+      are busy, one worker is removed.
+
+    No further change is made for ``cooldown`` seconds after a change.
+    """
+    def __init__(self, min_workers, max_workers, sample_interval=1,
+                 window=10, cooldown=30, grow_threshold=0.75,
+                 shrink_threshold=0.25):
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.sample_interval = sample_interval
+        self.window = window
+        self.cooldown = cooldown
+        self.grow_threshold = grow_threshold
+        self.shrink_threshold = shrink_threshold
+
+        # Averages used to make the most recent decision.
+        self.pending = 0
+        self.utilization = 0
+
+        self._samples = []
+        self._next_sample = 0
+        self._changed_at = None
+
+    def due(self, now):
+        return now >= self._next_sample
+
+    def sample(self, now, workers, pending, busy):
+        """
+        Record a sample, returning the number of workers that should be
+        running, or ``None`` if nothing should change.
+        """
+        self._next_sample = now + self.sample_interval
+        self._samples.append((pending, float(busy) / max(workers, 1)))
+        if len(self._samples) * self.sample_interval < self.window:
+            return
+
+        n = len(self._samples)
+        self.pending = sum(p for p, _ in self._samples) / float(n)
+        self.utilization = sum(u for _, u in self._samples) / n
+        self._samples = []
+
+        if workers < self.min_workers:
+            return self.min_workers
+        elif workers > self.max_workers:
+            return self.max_workers
+        elif (self._changed_at is not None and
+              now - self._changed_at < self.cooldown):
+            return
+
+        if (self.pending >= 1 and self.utilization >= self.grow_threshold and
+                workers < self.max_workers):
+            grow = min(int(math.ceil(self.pending)), workers)
+            target = min(workers + max(grow, 1), self.max_workers)
+        elif (self.pending < 1 and
+              self.utilization <= self.shrink_threshold and
+              workers > self.min_workers):
+            target = workers - 1
+        else:
+            return
+
+        self._changed_at = now
+        return target
+
+
 class Environment(object):
     def get_stop_flag(self):
         raise NotImplementedError
@@ -252,11 +590,32 @@ class Environment(object):
     def create_process(self, runnable, name):
         raise NotImplementedError
 
+    def create_event(self):
+        # An event that can be shared with the environment's workers.
+        return self.get_stop_flag()
+
+    def create_queue(self, maxsize):
+        # A queue that can be shared with the environment's workers.
+        raise NotImplementedError
+
+    def is_alive(self, process):
+        return process.is_alive()
+
+    def configure_storage(self, storage, workers):
+        # The workers, the scheduler and the consumer's main thread, which
+        # samples the queue for the autoscaler, share the storage's
+        # connection pool, and may all be using a connection at the same
+        # time.
+        storage.configure_pool(workers + 2)
+
 
 class ThreadEnvironment(Environment):
     def get_stop_flag(self):
         return threading.Event()
 
+    def create_queue(self, maxsize):
+        return Queue(maxsize)
+
     def create_process(self, runnable, name):
         t = threading.Thread(target=runnable, name=name)
         t.daemon = True
@@ -267,6 +626,9 @@ class GreenletEnvironment(Environment):
     def get_stop_flag(self):
         return GreenEvent()
 
+    def create_queue(self, maxsize):
+        return GreenQueue(maxsize)
+
     def create_process(self, runnable, name):
         def run_wrapper():
             gevent.sleep()
@@ -274,29 +636,65 @@ class GreenletEnvironment(Environment):
             gevent.sleep()
         return Greenlet(run=run_wrapper)
 
+    def is_alive(self, process):
+        return not process.dead
+
 
 class ProcessEnvironment(Environment):
+    storage = None
+
     def get_stop_flag(self):
         return ProcessEvent()
 
+    def create_queue(self, maxsize):
+        return ProcessQueue(maxsize)
+
     def create_process(self, runnable, name):
-        p = Process(target=runnable, name=name)
+        def run_wrapper():
+            if self.storage is not None:
+                self.storage.after_fork()
+            runnable()
+        p = Process(target=run_wrapper, name=name)
         p.daemon = True
         return p
 
+    def configure_storage(self, storage, workers):
+        # Each process opens its own connections after it is forked, and
+        # runs a single worker (or the scheduler) which may emit events.
+        storage.configure_pool(2)
+        self.storage = storage
+
 
 worker_to_environment = {
     'thread': ThreadEnvironment,
     'greenlet': GreenletEnvironment,
     'gevent': GreenletEnvironment,  # Same as greenlet.
     'process': ProcessEnvironment,
+    # Imported when used, as it requires Python 3.
+    'asyncio': 'huey.contrib.asyncio.AsyncioEnvironment',
 }
 
 
 class Consumer(object):
+    # Delay before restarting a crashed worker process, doubled after each
+    # consecutive crash up to the maximum.
+    restart_delay = 1.
+    max_restart_delay = 60.
+
+    # Longest time between checks on the workers, made by the main thread
+    # while it waits for the consumer to be stopped.
+    check_interval = 1.
+
+    # Longest time to wait on shutdown for the workers to return the tasks
+    # they hold but have not started.
+    shutdown_timeout = 30.
+
     def __init__(self, huey, workers=1, periodic=True, initial_delay=0.1,
                  backoff=1.15, max_delay=10.0, utc=True, scheduler_interval=1,
-                 worker_type='thread'):
+                 worker_type='thread', prefetch=1, schedule_batch_size=1000,
+                 max_tasks_per_child=None, max_memory_per_child=None,
+                 min_workers=None, max_workers=None, dispatcher=False,
+                 queue_size=None):
 
         self._logger = logging.getLogger('huey.consumer')
         self.huey = huey
@@ -308,11 +706,54 @@ class Consumer(object):
         self.utc = utc
         self.scheduler_interval = max(min(scheduler_interval, 60), 1)
         self.worker_type = worker_type
+        self.prefetch = max(prefetch, 1)
+        self.schedule_batch_size = max(schedule_batch_size, 1)
         if worker_type not in worker_to_environment:
             raise ValueError('worker_type must be one of %s.' %
                              ', '.join(worker_to_environment))
         else:
-            self.environment = worker_to_environment[worker_type]()
+            environment = worker_to_environment[worker_type]
+            if not isinstance(environment, type):
+                environment = load_class(environment)
+            self.environment = environment()
+
+        if worker_type != 'process' and (max_tasks_per_child or
+                                         max_memory_per_child):
+            raise ValueError('max_tasks_per_child and max_memory_per_child '
+                             'require the process worker type.')
+        self.max_tasks_per_child = max_tasks_per_child
+        self.max_memory_per_child = max_memory_per_child
+
+        if max_workers:
+            min_workers = min_workers or 1
+            if min_workers > max_workers:
+                raise ValueError('min_workers cannot be greater than '
+                                 'max_workers.')
+            self.workers = workers = max(min(workers, max_workers),
+                                         min_workers)
+            self.autoscaler = Autoscaler(min_workers, max_workers)
+        elif min_workers:
+            raise ValueError('min_workers requires max_workers.')
+        else:
+            self.autoscaler = None
+
+        # The dispatcher holds a connection of its own, as it may be waiting
+        # on a blocking read.
+        self.environment.configure_storage(
+            self.huey.storage,
+            (max_workers or workers) + (1 if dispatcher else 0))
+
+        # The asyncio worker type runs a single worker, which executes up to
+        # `workers` tasks at a time.
+        self.concurrency = 1
+        if worker_type == 'asyncio':
+            if max_workers:
+                raise ValueError('The asyncio worker type cannot be '
+                                 'autoscaled.')
+            self.concurrency, workers = workers, 1
+            if dispatcher:
+                raise ValueError('The asyncio worker type cannot be used '
+                                 'with a dispatcher.')
 
         self._received_signal = False
         self.stop_flag = self.environment.get_stop_flag()
@@ -322,35 +763,90 @@ class Consumer(object):
             scheduler,
             'Scheduler')
 
+        # With a dispatcher, a single reader hands messages to the workers
+        # through a queue, which by default holds a message for each worker.
+        # The workers then read nothing from the storage themselves, and
+        # the prefetch setting is the number of messages the dispatcher reads
+        # at a time.
+        if dispatcher:
+            self.queue_size = max(queue_size or max_workers or workers, 1)
+            self.work_queue = self.environment.create_queue(self.queue_size)
+            self.dispatcher = self.environment.create_process(
+                self._create_runnable(self._create_dispatcher()),
+                'Dispatcher')
+        else:
+            if queue_size:
+                raise ValueError('queue_size requires a dispatcher.')
+            self.queue_size = None
+            self.work_queue = self.dispatcher = None
+
+        # The events used to stop each worker and to tell whether it is busy,
+        # and the workers that have been told to stop by the autoscaler.
+        self._worker_flags = {}
+        self._retiring = []
+
         self.worker_threads = []
         for i in range(workers):
-            worker = self._create_runnable(self._create_worker())
-            self.worker_threads.append(self.environment.create_process(
-                worker,
-                'Worker-%d' % (i + 1)))
+            self.worker_threads.append(self._create_worker_process(i))
+
+        # Consecutive crashes, and the time a replacement may be started, of
+        # each worker process.
+        self._crashes = [0] * workers
+        self._restart_at = [None] * workers
 
-    def _create_worker(self):
-        return Worker(
+    def _create_worker(self, busy=None):
+        kwargs = dict(
             huey=self.huey,
             default_delay=self.default_delay,
             max_delay=self.max_delay,
             backoff=self.backoff,
-            utc=self.utc)
+            utc=self.utc,
+            prefetch=self.prefetch,
+            max_tasks=self.max_tasks_per_child,
+            max_memory=self.max_memory_per_child,
+            busy=busy,
+            work_queue=self.work_queue)
+        if self.worker_type == 'asyncio':
+            return self.environment.create_worker(
+                concurrency=self.concurrency, **kwargs)
+        return Worker(**kwargs)
+
+    def _create_worker_process(self, i):
+        stop_flag = self.environment.create_event()
+        busy = self.environment.create_event()
+        worker = self._create_runnable(self._create_worker(busy), stop_flag)
+        process = self.environment.create_process(worker,
+                                                  'Worker-%d' % (i + 1))
+        self._worker_flags[process] = (stop_flag, busy)
+        return process
+
+    def _create_dispatcher(self):
+        return Dispatcher(
+            huey=self.huey,
+            work_queue=self.work_queue,
+            delay=self.default_delay,
+            utc=self.utc,
+            batch_size=self.prefetch)
 
     def _create_scheduler(self):
         return Scheduler(
             huey=self.huey,
             interval=self.scheduler_interval,
             utc=self.utc,
-            periodic=self.periodic)
+            periodic=self.periodic,
+            batch_size=self.schedule_batch_size)
 
-    def _create_runnable(self, consumer_process):
+    def _create_runnable(self, consumer_process, stop_flag=None):
         def _run():
             try:
-                while not self.stop_flag.is_set():
+                while not (self.stop_flag.is_set() or
+                           consumer_process.exiting or
+                           (stop_flag is not None and stop_flag.is_set())):
                     consumer_process.loop()
             except KeyboardInterrupt:
                 pass
+            finally:
+                consumer_process.shutdown()
         return _run
 
     def start(self):
@@ -361,8 +857,18 @@ class Consumer(object):
             os.getpid()))
         self._logger.info('Scheduler runs every %s seconds.' % (
             self.scheduler_interval))
+        if self.dispatcher is not None:
+            self._logger.info('Tasks are read by a single dispatcher, %s at '
+                              'a time, into a queue of %s.' %
+                              (self.prefetch, self.queue_size))
         self._logger.info('Periodic tasks are %s.' % (
             'enabled' if self.periodic else 'disabled'))
+        if (self.max_memory_per_child and
+                not getattr(self.huey.storage, 'reliable', False)):
+            self._logger.warning('Memory usage is only checked between '
+                                 'tasks. A worker killed while running a '
+                                 'task loses it and any it prefetched, '
+                                 'unless the storage is reliable.')
 
         self._set_signal_handler()
 
@@ -373,6 +879,8 @@ class Consumer(object):
         self._logger.info('\n'.join(msg))
 
         self.scheduler.start()
+        if self.dispatcher is not None:
+            self.dispatcher.start()
         for worker in self.worker_threads:
             worker.start()
 
@@ -384,8 +892,7 @@ class Consumer(object):
         self.start()
         while True:
             try:
-                is_set = self.stop_flag.wait(timeout=0.1)
-                time.sleep(0.1)
+                self.stop_flag.wait(timeout=self.check_interval)
             except KeyboardInterrupt:
                 self.stop()
             except:
@@ -396,8 +903,151 @@ class Consumer(object):
                     self.stop()
                 if self.stop_flag.is_set():
                     break
+                if self.worker_type == 'process':
+                    self.check_worker_health()
+                if self.autoscaler is not None:
+                    self.autoscale()
+
+        # Workers that may hold tasks they have not started, prefetched,
+        # taken from the dispatcher or waiting on an event loop, are given a
+        # while to finish their current task and hand the rest back.
+        # Otherwise there is nothing to wait for, and the workers are left to
+        # exit with the consumer.
+        if self.dispatcher is not None:
+            self._join([self.dispatcher])
+        if (self.prefetch > 1 or self.dispatcher is not None or
+                self.worker_type == 'asyncio'):
+            self._join(self.worker_threads + self._retiring)
+        if self.work_queue is not None:
+            self.requeue_undispatched()
+        stats = self.huey.storage.pool_stats()
+        if stats:
+            self._logger.debug('Connection pool: %s' % ', '.join(
+                '%s=%s' % item for item in sorted(stats.items())))
         self._logger.info('Consumer exiting.')
 
+    def _join(self, processes):
+        deadline = time.time() + self.shutdown_timeout
+        for process in processes:
+            process.join(max(deadline - time.time(), 0))
+            if self.environment.is_alive(process):
+                self._logger.warning('Gave up waiting for %s to stop' %
+                                     getattr(process, 'name', 'worker'))
+
+    def requeue_undispatched(self):
+        # Return messages left in the work queue, which no worker took before
+        # stopping, to the front of the queue.
+        messages = []
+        while True:
+            try:
+                messages.append(self.work_queue.get_nowait())
+            except Empty:
+                break
+        if messages:
+            self._logger.info('Returning %s undispatched tasks to the queue' %
+                              len(messages))
+            try:
+                self.huey.requeue([self.huey._task_for_message(message)
+                                   for message in messages])
+            except QueueWriteException:
+                self._logger.exception('Error returning undispatched tasks')
+
+    def check_worker_health(self):
+        """
+        Replace worker processes that have exited. Processes that exited
+        cleanly, having reached their task or memory limit, are replaced
+        straight away. Processes that crashed are replaced after a delay that
+        grows with each consecutive crash.
+        """
+        now = time.time()
+        for i, worker in enumerate(self.worker_threads):
+            if worker.is_alive():
+                continue
+
+            if self._restart_at[i] is None:
+                if worker.exitcode == 0:
+                    self._crashes[i] = 0
+                    delay = 0
+                    self._logger.info('%s exited, starting a replacement' %
+                                      worker.name)
+                else:
+                    delay = min(self.restart_delay * 2 ** self._crashes[i],
+                                self.max_restart_delay)
+                    self._crashes[i] += 1
+                    self._logger.error(
+                        '%s exited with code %s, restarting in %s seconds' %
+                        (worker.name, worker.exitcode, delay))
+                self._restart_at[i] = now + delay
+
+            if now >= self._restart_at[i]:
+                self._restart_at[i] = None
+                self._worker_flags.pop(worker, None)
+                self.worker_threads[i] = self._create_worker_process(i)
+                self.worker_threads[i].start()
+
+    def autoscale(self, now=None):
+        """
+        Sample the queue size and the number of busy workers, and add or
+        remove workers when the autoscaler decides to.
+        """
+        now = now or time.time()
+        if not self.autoscaler.due(now):
+            return
+
+        self._retiring = [worker for worker in self._retiring
+                          if self.environment.is_alive(worker)]
+        try:
+            pending = self.huey.pending_count()
+        except Exception:
+            self._logger.exception('Error reading the size of the queue')
+            return
+        busy = len([worker for worker in self.worker_threads
+                    if self._worker_flags[worker][1].is_set()])
+
+        current = len(self.worker_threads)
+        target = self.autoscaler.sample(now, current, pending, busy)
+        if target is None or target == current:
+            return
+
+        self._logger.info('Scaling from %s to %s workers' % (current, target))
+        self.set_worker_count(target)
+        self.huey.emit_status(
+            EVENT_SCALED,
+            workers=target,
+            previous=current,
+            pending=self.autoscaler.pending,
+            utilization=self.autoscaler.utilization,
+            timestamp=time.time())
+
+    def set_worker_count(self, n):
+        """
+        Start or stop workers so that ``n`` are running. Workers that are
+        stopped finish their current task and return any prefetched tasks to
+        the queue, idle workers being chosen first.
+        """
+        while len(self.worker_threads) < n:
+            i = len(self.worker_threads)
+            worker = self._create_worker_process(i)
+            self.worker_threads.append(worker)
+            self._crashes.append(0)
+            self._restart_at.append(None)
+            worker.start()
+
+        while len(self.worker_threads) > n:
+            i = len(self.worker_threads) - 1
+            for j in range(i, -1, -1):
+                if not self._worker_flags[self.worker_threads[j]][1].is_set():
+                    i = j
+                    break
+            worker = self.worker_threads.pop(i)
+            self._crashes.pop(i)
+            self._restart_at.pop(i)
+            stop_flag, _ = self._worker_flags.pop(worker)
+            stop_flag.set()
+            self._retiring.append(worker)
+
+        self.workers = n
+
     def _set_signal_handler(self):
         signal.signal(signal.SIGTERM, self._handle_signal)
 
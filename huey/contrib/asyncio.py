@@ -0,0 +1,617 @@
+"""
+asyncio support for huey.
+
+:py:class:`AsyncRedisHuey` lets applications enqueue tasks and wait for their
+results from a running event loop. Messages are stored in the same format as
+by :py:class:`RedisHuey`, so both can be used with the same queue.
+
+The ``asyncio`` worker type of the consumer, implemented by
+:py:class:`AsyncWorker`, runs many tasks at once on a single event loop.
+Tasks whose function is a coroutine function are awaited on the loop, other
+tasks run in a thread pool.
+
+Requires Python 3.6 or newer. The Redis client uses redis-py 4.2 or newer.
+"""
+import asyncio
+import json
+import pickle
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from functools import wraps
+
+try:
+    from redis import SSLConnection
+    from redis import asyncio as aioredis
+except ImportError:
+    SSLConnection = aioredis = None
+
+from huey.api import QueueTask
+from huey.api import TaskResultWrapper
+from huey.consumer import EVENT_ERROR_DEQUEUEING
+from huey.consumer import EVENT_ERROR_STORING_RESULT
+from huey.consumer import EVENT_ERROR_TASK
+from huey.consumer import EVENT_FINISHED
+from huey.consumer import EVENT_REVOKED
+from huey.consumer import EVENT_STARTED
+from huey.consumer import ThreadEnvironment
+from huey.consumer import Worker
+from huey.consumer import to_timestamp
+from huey.exceptions import DataStoreGetException
+from huey.exceptions import DataStorePutException
+from huey.exceptions import DataStoreTimeout
+from huey.exceptions import QueueReadException
+from huey.exceptions import QueueWriteException
+from huey.registry import registry
+from huey.storage import POP_DATA_LUA
+from huey.storage import QUEUE_POP_LUA
+from huey.storage import RedisHuey
+from huey.storage import RedisStorage
+from huey.utils import EmptyData
+from huey.utils import wrap_exception
+
+
+# Settings of a RedisStorage's connection pool that are passed on to the
+# asyncio client. Other keyword arguments taken by the synchronous client
+# are not accepted by the asyncio one.
+CONNECTION_PARAMS = (
+    'host', 'port', 'db', 'username', 'password', 'client_name',
+    'socket_timeout', 'socket_connect_timeout', 'socket_keepalive',
+    'socket_keepalive_options', 'retry_on_timeout', 'health_check_interval')
+SSL_CONNECTION_PARAMS = (
+    'ssl_keyfile', 'ssl_certfile', 'ssl_cert_reqs', 'ssl_ca_certs',
+    'ssl_ca_data', 'ssl_check_hostname')
+
+
+def get_connection_params(pool):
+    """
+    Return the keyword arguments used to create an asyncio Redis client that
+    connects to the same server as the given connection pool.
+    """
+    kwargs = pool.connection_kwargs
+    params = dict((key, kwargs[key]) for key in CONNECTION_PARAMS
+                  if key in kwargs)
+    if 'path' in kwargs:
+        params['unix_socket_path'] = kwargs['path']
+    if issubclass(pool.connection_class, SSLConnection):
+        params['ssl'] = True
+        params.update((key, kwargs[key]) for key in SSL_CONNECTION_PARAMS
+                      if key in kwargs)
+    return params
+
+
+class ExecutorStorage(object):
+    """
+    Exposes the methods of a storage as coroutines, which call the storage in
+    a thread pool. ``executor`` defaults to the event loop's default
+    executor.
+    """
+    def __init__(self, storage, executor=None):
+        self.storage = storage
+        self.executor = executor
+
+    def __getattr__(self, attr):
+        method = getattr(self.storage, attr)
+
+        async def inner(*args, **kwargs):
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(
+                self.executor, partial(method, *args, **kwargs))
+        return inner
+
+    async def close(self):
+        pass
+
+
+class AsyncRedisStorage(ExecutorStorage):
+    """
+    Performs the operations used by producers -- enqueueing tasks, reading
+    results and listening for events -- and by the asyncio worker to dequeue
+    tasks, over an asyncio Redis connection. Key names and settings are taken
+    from the given :py:class:`RedisStorage`, which keeps working as before
+    for everything else. Other storage methods are called in a thread pool.
+    """
+    def __init__(self, storage, executor=None, **connection_params):
+        if aioredis is None:
+            raise RuntimeError('Error, "redis.asyncio" is not available. '
+                               'Install redis-py 4.2 or newer using pip: '
+                               '"pip install -U redis"')
+        if not isinstance(storage, RedisStorage):
+            raise ValueError('asyncio is only supported with RedisStorage.')
+
+        super(AsyncRedisStorage, self).__init__(storage, executor)
+        if not connection_params:
+            connection_params = get_connection_params(storage.pool)
+        self.conn = aioredis.Redis(**connection_params)
+        self._pop_data = self.conn.register_script(POP_DATA_LUA)
+        self._pop_script = self.conn.register_script(QUEUE_POP_LUA)
+
+    async def close(self):
+        await self.conn.connection_pool.disconnect()
+
+    async def dequeue_many(self, n):
+        storage = self.storage
+        keys, args = storage._pop_params(n)
+        messages = await self._pop_script(keys=keys, args=args)
+        if not messages and storage.blocking:
+            # Nothing is ready, so wait for a single message.
+            message = await self._blocking_dequeue()
+            if message is not None:
+                messages = [message]
+        return messages or []
+
+    async def _blocking_dequeue(self):
+        storage = self.storage
+        if storage.reliable:
+            # As in RedisStorage, only the default priority is waited on, and
+            # the processing list is registered beforehand.
+            await self.conn.sadd(storage.processing_lists_key,
+                                 storage.processing_key)
+            message = await self.conn.brpoplpush(
+                storage.queue_key,
+                storage.processing_key,
+                timeout=storage.read_timeout)
+            if message is not None:
+                await storage._zadd(self.conn, storage.inflight_key,
+                                    storage._deadline(), message)
+            return message
+
+        priorities = await self.conn.zrevrangebyscore(
+            storage.priorities_key, '+inf', '-inf')
+        if priorities:
+            queue_keys = [storage.queue_key_for(int(p)) for p in priorities]
+        else:
+            queue_keys = [storage.queue_key]
+        res = await self.conn.brpop(queue_keys, timeout=storage.read_timeout)
+        return res[1] if res else None
+
+    async def enqueue(self, data, priority=0):
+        storage = self.storage
+        if not priority:
+            await self.conn.lpush(storage.queue_key, data)
+        else:
+            pipe = self.conn.pipeline()
+            storage._register_priority(pipe, priority)
+            pipe.lpush(storage.queue_key_for(priority), data)
+            await pipe.execute()
+
+    async def put_data(self, key, value):
+        storage = self.storage
+        if not storage.result_keys:
+            await self.conn.hset(storage.result_key, key, value)
+            return
+
+        now = time.time()
+        pipe = self.conn.pipeline()
+        pipe.set(storage.result_prefix + key, value)
+        storage._zadd(pipe, storage.result_index_key, float('inf'),
+                      storage.result_prefix + key)
+        pipe.zremrangebyscore(storage.result_index_key, '-inf', now)
+        await pipe.execute()
+
+    async def peek_data(self, key):
+        storage = self.storage
+        if storage.result_keys:
+            val = await self.conn.get(storage.result_prefix + key)
+        else:
+            val = await self.conn.hget(storage.result_key, key)
+        return EmptyData if val is None else val
+
+    async def pop_data(self, key):
+        storage = self.storage
+        if storage.result_keys:
+            keys = [storage.result_prefix + key, storage.result_index_key]
+            args = []
+        else:
+            keys = [storage.result_key]
+            args = [key]
+        res = await self._pop_data(keys=keys, args=args)
+        return res[1] if res[0] else EmptyData
+
+    async def wait_for_data(self, key, timeout=None):
+        if not self.storage.notify_results:
+            return False
+        if self.storage._float_timeouts is None:
+            self.storage._set_server_info(await self.conn.info('server'))
+        await self.conn.blpop(self.storage.notify_prefix + key,
+                              timeout=self.storage._blocking_timeout(timeout))
+        return True
+
+    async def events(self):
+        pubsub = self.conn.pubsub()
+        await pubsub.subscribe(self.storage.name)
+        try:
+            async for message in pubsub.listen():
+                if message['type'] == 'message':
+                    yield json.loads(message['data'].decode('utf-8'))
+        finally:
+            await pubsub.reset()
+
+
+def get_async_storage(storage, executor=None):
+    """
+    Return an object exposing the methods of ``storage`` as coroutines, using
+    an asyncio Redis client where possible.
+    """
+    if aioredis is not None and isinstance(storage, RedisStorage):
+        return AsyncRedisStorage(storage, executor)
+    return ExecutorStorage(storage, executor)
+
+
+def _wrapped_operation(exc_class):
+    # The coroutine counterpart of Huey._wrapped_operation.
+    def decorator(fn):
+        @wraps(fn)
+        async def inner(*args, **kwargs):
+            try:
+                return await fn(*args, **kwargs)
+            except (KeyboardInterrupt, RuntimeError, asyncio.CancelledError):
+                raise
+            except:
+                wrap_exception(exc_class)
+        return inner
+    return decorator
+
+
+class AsyncRedisHuey(RedisHuey):
+    """
+    A :py:class:`RedisHuey` whose tasks can also be enqueued, and whose
+    results and events can be awaited, without blocking the event loop::
+
+        huey = AsyncRedisHuey('my-app', notify_results=True)
+
+        @huey.task()
+        def add(a, b):
+            return a + b
+
+        async def handler():
+            result = await add.aenqueue(1, 2)
+            return await result.aget(timeout=10)
+
+    The synchronous API is unchanged. Connections for the asyncio methods
+    are opened with the same parameters as the storage's connection pool.
+    """
+    def __init__(self, *args, **kwargs):
+        super(AsyncRedisHuey, self).__init__(*args, **kwargs)
+        self.async_storage = AsyncRedisStorage(self.storage)
+
+    def task(self, retries=0, retry_delay=0, retries_as_argument=False,
+             include_task=False, name=None, priority=0):
+        decorator = super(AsyncRedisHuey, self).task(
+            retries, retry_delay, retries_as_argument, include_task, name,
+            priority)
+
+        def async_decorator(func):
+            inner_run = decorator(func)
+            klass = inner_run.task_class
+
+            async def aenqueue(*args, **kwargs):
+                cmd = klass(
+                    (args, kwargs),
+                    retries=retries,
+                    retry_delay=retry_delay,
+                    priority=priority)
+                return await self.aenqueue(cmd)
+
+            inner_run.aenqueue = aenqueue
+            return inner_run
+        return async_decorator
+
+    @_wrapped_operation(QueueWriteException)
+    async def _aenqueue(self, msg, priority=0):
+        await self.async_storage.enqueue(msg, priority)
+
+    @_wrapped_operation(DataStoreGetException)
+    async def _aget_data(self, key, peek=False):
+        if peek:
+            return await self.async_storage.peek_data(key)
+        else:
+            return await self.async_storage.pop_data(key)
+
+    @_wrapped_operation(DataStoreGetException)
+    async def _await_data(self, key, timeout=None):
+        return await self.async_storage.wait_for_data(key, timeout)
+
+    @_wrapped_operation(DataStorePutException)
+    async def _aput_data(self, key, value):
+        await self.async_storage.put_data(key, value)
+
+    def enqueue(self, task):
+        # Results of tasks enqueued synchronously can be awaited as well.
+        result = super(AsyncRedisHuey, self).enqueue(task)
+        if self.always_eager or result is None:
+            return result
+        return AsyncTaskResultWrapper(self, task)
+
+    async def aenqueue(self, task):
+        if self.always_eager:
+            return task.execute()
+
+        msg = registry.get_message_for_task(task, self.serializer)
+        await self._aenqueue(msg, task.priority)
+
+        if self.result_store:
+            return AsyncTaskResultWrapper(self, task)
+
+    async def arevoke(self, task, revoke_until=None, revoke_once=False):
+        serialized = pickle.dumps((revoke_until, revoke_once))
+        await self._aput_data(task.revoke_id, serialized)
+
+    async def aresult(self, task_id, blocking=False, timeout=None,
+                      backoff=1.15, max_delay=1.0, revoke_on_timeout=False,
+                      preserve=False):
+        """
+        Retrieve the result of a task, given the task's ID. Accepts the same
+        parameters as :py:meth:`Huey.result`.
+        """
+        task_result = AsyncTaskResultWrapper(self, QueueTask(task_id=task_id))
+        return await task_result.aget(
+            blocking=blocking,
+            timeout=timeout,
+            backoff=backoff,
+            max_delay=max_delay,
+            revoke_on_timeout=revoke_on_timeout,
+            preserve=preserve)
+
+    def aevents(self):
+        """
+        Asynchronous iterator over consumer-sent events::
+
+            async for event in huey.aevents():
+                print(event['status'], event['id'])
+        """
+        return self.async_storage.events()
+
+    async def aclose(self):
+        """Close the connections used by the asyncio methods."""
+        await self.async_storage.close()
+
+
+class AsyncTaskResultWrapper(TaskResultWrapper):
+    """
+    A :py:class:`TaskResultWrapper` whose result can also be awaited. Unlike
+    :py:meth:`TaskResultWrapper.get`, :py:meth:`aget` waits for the result
+    by default.
+    """
+    async def _aget(self, preserve=False):
+        if self._result is EmptyData:
+            res = await self.huey._aget_data(self.task.task_id, peek=preserve)
+            if res is EmptyData:
+                return res
+            self._result = self.huey.serializer.deserialize(res)
+        return self._result
+
+    async def aget(self, blocking=True, timeout=None, backoff=1.15,
+                   max_delay=1.0, revoke_on_timeout=False, preserve=False):
+        if not blocking:
+            res = await self._aget(preserve)
+            if res is not EmptyData:
+                return res
+        else:
+            start = time.time()
+            delay = .1
+            while self._result is EmptyData:
+                remaining = timeout and timeout - (time.time() - start)
+                if timeout and remaining <= 0:
+                    if revoke_on_timeout:
+                        await self.arevoke()
+                    raise DataStoreTimeout
+                if delay > max_delay:
+                    delay = max_delay
+                if await self._aget(preserve) is EmptyData:
+                    # Wait for the consumer to signal the result is ready,
+                    # or poll if it does not, as in TaskResultWrapper.get().
+                    task_id = self.task.task_id
+                    wait = min(remaining, max_delay) if timeout else max_delay
+                    if not await self.huey._await_data(task_id, wait):
+                        await asyncio.sleep(delay)
+                        delay *= backoff
+
+            return self._result
+
+    async def arevoke(self):
+        await self.huey.arevoke(self.task)
+
+
+class AsyncWorker(Worker):
+    """
+    Worker that runs up to ``concurrency`` tasks at a time on its own asyncio
+    event loop. Tasks are dequeued using an asyncio storage client. Tasks
+    whose function is a coroutine function are awaited on the loop, while
+    other tasks, and the storage operations that have no asyncio counterpart,
+    are run in a pool of at most ``max_threads`` threads.
+    """
+    max_threads = 32
+
+    def __init__(self, huey, default_delay, max_delay, backoff, utc,
+                 prefetch=1, concurrency=100, **kwargs):
+        super(AsyncWorker, self).__init__(huey, default_delay, max_delay,
+                                          backoff, utc, prefetch, **kwargs)
+        self.concurrency = concurrency
+        self._loop = None
+        self._in_flight = set()
+
+    def _setup(self):
+        # The loop is created by the thread that runs it.
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._executor = ThreadPoolExecutor(
+            min(self.concurrency, self.max_threads))
+        self.storage = get_async_storage(self.huey.storage, self._executor)
+
+    def run_sync(self, fn, *args, **kwargs):
+        return self._loop.run_in_executor(
+            self._executor, partial(fn, *args, **kwargs))
+
+    def loop(self, now=None):
+        if self._loop is None:
+            self._setup()
+        self._loop.run_until_complete(self._next(now))
+
+    async def _next(self, now):
+        # Wait for a free slot. Tasks that are in flight run meanwhile.
+        await self._semaphore.acquire()
+        task = None
+        exc_raised = True
+        try:
+            task = await self.get_task_async()
+        except QueueReadException:
+            self.huey.emit_status(EVENT_ERROR_DEQUEUEING, error=True)
+            self._logger.exception('Error reading from queue')
+        except Exception:
+            self.huey.emit_status(EVENT_ERROR_DEQUEUEING, error=True)
+            self._logger.exception('Unknown exception dequeueing task.')
+        else:
+            exc_raised = False
+
+        if task is None:
+            self._semaphore.release()
+            if exc_raised or not self.huey.blocking:
+                await self.sleep_async()
+            return
+
+        self.delay = self.default_delay
+        future = asyncio.ensure_future(
+            self._run(task, now or self.get_now()))
+        self._in_flight.add(future)
+        future.add_done_callback(self._in_flight.discard)
+
+    async def get_task_async(self):
+        if not self._buffer:
+            try:
+                messages = await self.storage.dequeue_many(self.prefetch)
+            except Exception:
+                wrap_exception(QueueReadException)
+            for message in messages:
+                task = await self._task_for_message(message)
+                if task is not None:
+                    self._buffer.append(task)
+        while self._buffer:
+            task = self._buffer.popleft()
+            # Tasks that waited in the buffer for a free slot have their
+            # visibility timeout restarted, as in Worker.get_task().
+            if self.prefetch <= 1 or await self.run_sync(self.touch, task):
+                return task
+
+    async def _task_for_message(self, message):
+        # A message that cannot be read is dropped on its own, rather than
+        # taking the rest of its batch with it.
+        try:
+            return self.huey._task_for_message(message)
+        except Exception:
+            self.huey.emit_status(EVENT_ERROR_DEQUEUEING, error=True)
+            self._logger.exception('Unable to read message %r' % message)
+            await self.run_sync(self.huey._ack, message)
+
+    async def sleep_async(self):
+        if self.delay > self.max_delay:
+            self.delay = self.max_delay
+
+        self._logger.debug('No messages, sleeping for: %s' % self.delay)
+        await asyncio.sleep(self.delay)
+        self.delay *= self.backoff
+
+    async def _run(self, task, ts):
+        try:
+            await self.handle_task_async(task, ts)
+        except Exception:
+            self._logger.exception('Error handling task %s' % task)
+        finally:
+            await self.run_sync(self.acknowledge, task)
+            self.tasks_handled += 1
+            self._semaphore.release()
+
+    async def handle_task_async(self, task, ts):
+        if not self.huey.ready_to_run(task, ts):
+            await self.run_sync(self.add_schedule, task)
+        elif not await self.run_sync(self.is_revoked, task, ts):
+            await self.process_task_async(task, ts)
+        else:
+            await self.run_sync(
+                self.huey.emit_task,
+                EVENT_REVOKED,
+                task,
+                timestamp=to_timestamp(ts))
+            self._logger.debug('Task %s was revoked, not running' % task)
+
+    async def process_task_async(self, task, ts):
+        await self.run_sync(self.huey.emit_task, EVENT_STARTED, task,
+                            timestamp=to_timestamp(ts))
+        self._logger.info('Executing %s' % task)
+        start = time.time()
+        try:
+            try:
+                await self.execute(task)
+            finally:
+                duration = time.time() - start
+                self._logger.debug('Task %s ran in %0.3fs' % (task, duration))
+        except DataStorePutException:
+            await self.run_sync(
+                self.huey.emit_task,
+                EVENT_ERROR_STORING_RESULT,
+                task,
+                error=True,
+                duration=duration)
+            self._logger.exception('Error storing result')
+        except Exception:
+            await self.run_sync(
+                self.huey.emit_task,
+                EVENT_ERROR_TASK,
+                task,
+                error=True,
+                duration=duration)
+            self._logger.exception('Unhandled exception in worker')
+            if task.retries:
+                await self.run_sync(self.requeue_task, task, self.get_now())
+        else:
+            await self.run_sync(
+                self.huey.emit_task,
+                EVENT_FINISHED,
+                task,
+                duration=duration,
+                timestamp=self.get_timestamp())
+
+    async def execute(self, task):
+        func = getattr(task, 'func', None) or task.execute
+        if not asyncio.iscoroutinefunction(func):
+            return await self.run_sync(self.huey.execute, task)
+
+        try:
+            result = await task.execute()
+        except Exception as exc:
+            await self.run_sync(self.huey.store_error, task, exc,
+                                traceback.format_exc())
+            raise
+        return await self.run_sync(self.huey.store_result, task, result)
+
+    def shutdown(self):
+        if self._loop is not None:
+            if self._in_flight:
+                self._logger.info('Waiting for %s tasks to finish' %
+                                  len(self._in_flight))
+                self._loop.run_until_complete(
+                    asyncio.wait(list(self._in_flight)))
+            self._loop.run_until_complete(self.storage.close())
+
+        # Return prefetched tasks to the queue.
+        super(AsyncWorker, self).shutdown()
+
+        if self._loop is not None:
+            self._executor.shutdown()
+            self._loop.close()
+            self._loop = None
+
+
+class AsyncioEnvironment(ThreadEnvironment):
+    """
+    Runs a single :py:class:`AsyncWorker` in a thread, which executes as many
+    tasks at a time as the consumer has workers.
+    """
+    def configure_storage(self, storage, workers):
+        # Synchronous storage calls are made from the worker's thread pool.
+        storage.configure_pool(min(workers, AsyncWorker.max_threads) + 2)
+
+    def create_worker(self, **kwargs):
+        return AsyncWorker(**kwargs)
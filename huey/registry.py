@@ -1,6 +1,5 @@
-import pickle
-
 from huey.exceptions import QueueException
+from huey.serializer import Serializer
 
 
 class TaskRegistry(object):
@@ -42,15 +41,19 @@ class TaskRegistry(object):
     def __contains__(self, klass_str):
         return klass_str in self._registry
 
-    def get_message_for_task(self, task):
+    def __init__(self):
+        self.serializer = Serializer()
+
+    def get_message_for_task(self, task, serializer=None):
         """Convert a task object to a message for storage in the queue"""
-        return pickle.dumps((
+        return (serializer or self.serializer).serialize_message((
             task.task_id,
             self.task_to_string(type(task)),
             task.execute_time,
             task.retries,
             task.retry_delay,
             task.get_data(),
+            task.priority,
         ))
 
     def get_task_class(self, klass_str):
@@ -61,14 +64,17 @@ class TaskRegistry(object):
 
         return klass
 
-    def get_task_for_message(self, msg):
+    def get_task_for_message(self, msg, serializer=None):
         """Convert a message from the queue into a task"""
         # parse out the pieces from the enqueued message
-        raw = pickle.loads(msg)
-        task_id, klass_str, execute_time, retries, delay, data = raw
+        raw = (serializer or self.serializer).deserialize_message(msg)
+        task_id, klass_str, execute_time, retries, delay, data = raw[:6]
+
+        # Messages written before priorities were added have no priority.
+        priority = raw[6] if len(raw) > 6 else 0
 
         klass = self.get_task_class(klass_str)
-        return klass(data, task_id, execute_time, retries, delay)
+        return klass(data, task_id, execute_time, retries, delay, priority)
 
     def get_periodic_tasks(self):
         return self._periodic_tasks
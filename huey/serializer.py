@@ -0,0 +1,149 @@
+import datetime
+import json
+import pickle
+
+import zlib
+
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# Compressed payloads are prefixed with a byte that can never begin a pickle,
+# JSON (UTF-8) or msgpack document, so uncompressed data carries no header
+# and can still be read back after compression has been enabled.
+COMPRESSED = b'\xc1'
+LZ4_MAGIC = b'\x04\x22\x4d\x18'
+
+
+class Serializer(object):
+    """
+    Converts task messages, results and errors to and from the bytes stored
+    by the storage layer. The default implementation uses pickle, which can
+    handle arbitrary Python objects and matches the format used by earlier
+    versions of huey.
+
+    :param compression: ``None`` (the default), ``'zlib'`` or ``'lz4'``.
+    :param int compression_threshold: payloads smaller than this many bytes
+        are stored uncompressed.
+    :param int compression_level: compression level passed to the codec.
+    """
+    def __init__(self, compression=None, compression_threshold=1024,
+                 compression_level=None):
+        if compression not in (None, 'zlib', 'lz4'):
+            raise ValueError('Unsupported compression: %r' % compression)
+        if compression == 'lz4' and lz4 is None:
+            raise RuntimeError('Error, "lz4" is not installed. Install '
+                               'using pip: "pip install lz4"')
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        self.compression_level = compression_level
+
+    def _serialize(self, data):
+        return pickle.dumps(data)
+
+    def _deserialize(self, data):
+        return pickle.loads(data)
+
+    def compress(self, data):
+        if not self.compression or len(data) < self.compression_threshold:
+            return data
+        if self.compression == 'lz4':
+            if self.compression_level is None:
+                compressed = lz4.compress(data)
+            else:
+                compressed = lz4.compress(
+                    data,
+                    compression_level=self.compression_level)
+        elif self.compression_level is None:
+            compressed = zlib.compress(data)
+        else:
+            compressed = zlib.compress(data, self.compression_level)
+        if len(compressed) + 1 >= len(data):
+            return data
+        return COMPRESSED + compressed
+
+    def decompress(self, data):
+        if data[:1] != COMPRESSED:
+            return data
+        data = data[1:]
+        if data[:4] == LZ4_MAGIC:
+            if lz4 is None:
+                raise RuntimeError('Error, "lz4" is required to read this '
+                                   'data. Install using pip: "pip install '
+                                   'lz4"')
+            return lz4.decompress(data)
+        return zlib.decompress(data)
+
+    def serialize(self, data):
+        return self.compress(self._serialize(data))
+
+    def deserialize(self, data):
+        return self._deserialize(self.decompress(data))
+
+    def serialize_message(self, message):
+        return self.serialize(message)
+
+    def deserialize_message(self, data):
+        return self.deserialize(data)
+
+    def serialize_error(self, metadata):
+        return self.serialize(metadata)
+
+
+class CompactSerializer(Serializer):
+    """
+    Base class for serializers that are limited to JSON-like types. The
+    ``execute_time`` of a message is stored as a float timestamp.
+
+    Note that tuples are read back as lists. Task arguments and results that
+    cannot be represented natively raise a ``TypeError``. The only values that
+    are converted are the exceptions stored with task errors, which are
+    stored as their ``repr()``.
+    """
+    def serialize_message(self, message):
+        message = list(message)
+        if message[2] is not None:
+            message[2] = (message[2] - EPOCH).total_seconds()
+        return self.serialize(message)
+
+    def deserialize_message(self, data):
+        message = self.deserialize(data)
+        if message[2] is not None:
+            message[2] = EPOCH + datetime.timedelta(seconds=message[2])
+        return message
+
+    def serialize_error(self, metadata):
+        if metadata.get('error') is not None:
+            metadata = dict(metadata, error=repr(metadata['error']))
+        return self.serialize(metadata)
+
+
+class JSONSerializer(CompactSerializer):
+    def _serialize(self, data):
+        return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+    def _deserialize(self, data):
+        return json.loads(data.decode('utf-8'))
+
+
+class MsgPackSerializer(CompactSerializer):
+    def __init__(self, *args, **kwargs):
+        if msgpack is None:
+            raise RuntimeError('Error, "msgpack" is not installed. Install '
+                               'using pip: "pip install msgpack"')
+        super(MsgPackSerializer, self).__init__(*args, **kwargs)
+
+    def _serialize(self, data):
+        return msgpack.packb(data, use_bin_type=True)
+
+    def _deserialize(self, data):
+        return msgpack.unpackb(data, raw=False)
@@ -1,10 +1,41 @@
+import binascii
+import heapq
+import itertools
 import json
+import math
+import mmap
+import os
+import random
 import re
+import shutil
+import socket
+import sqlite3
+import struct
 import sys
+import threading
 import time
-
-import redis
-from redis.exceptions import ConnectionError
+import uuid
+import weakref
+from collections import deque
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from queue import Full
+    from queue import Queue
+except ImportError:
+    from Queue import Full
+    from Queue import Queue
+
+try:
+    import redis
+    from redis.exceptions import ConnectionError
+except ImportError:
+    redis = None
 
 from huey.api import Huey
 from huey.utils import EmptyData
@@ -14,12 +45,35 @@ class BaseStorage(object):
     def __init__(self, name='huey', **storage_kwargs):
         self.name = name
 
-    def enqueue(self, data):
+    def enqueue(self, data, priority=0):
+        raise NotImplementedError
+
+    def enqueue_many(self, data, priority=0):
         raise NotImplementedError
 
     def dequeue(self):
         raise NotImplementedError
 
+    def dequeue_many(self, n):
+        raise NotImplementedError
+
+    def requeue(self, data, priority=0):
+        raise NotImplementedError
+
+    def ack(self, data):
+        # Only meaningful for storages that track in-flight messages.
+        pass
+
+    def touch(self, data):
+        # Restart the visibility timeout of an in-flight message. Returns
+        # False if the message is no longer in flight. Only meaningful for
+        # storages that track in-flight messages.
+        return True
+
+    def requeue_expired(self):
+        # Only meaningful for storages that track in-flight messages.
+        return 0
+
     def unqueue(self, data):
         raise NotImplementedError
 
@@ -32,12 +86,19 @@ class BaseStorage(object):
     def flush_queue(self):
         raise NotImplementedError
 
-    def add_to_schedule(self, data, ts):
+    def add_to_schedule(self, data, ts, priority=0):
         raise NotImplementedError
 
-    def read_schedule(self, ts):
+    def read_schedule(self, ts, limit=None):
         raise NotImplementedError
 
+    def promote_schedule(self, ts, limit=None):
+        # Storages that can move due items from the schedule to the queue
+        # without returning them to the caller return the number moved. By
+        # default this returns None, and the items are read and enqueued by
+        # the scheduler instead.
+        return None
+
     def schedule_size(self):
         raise NotImplementedError
 
@@ -50,12 +111,26 @@ class BaseStorage(object):
     def put_data(self, key, value):
         raise NotImplementedError
 
+    def put_result(self, key, value):
+        # Task return values, as opposed to other data such as revocations.
+        return self.put_data(key, value)
+
+    def wait_for_data(self, key, timeout=None):
+        # Block until data may have been stored for the given key, or until
+        # the timeout expires. Storages that cannot notify waiters return
+        # False, in which case the caller should fall back to polling.
+        return False
+
     def peek_data(self, key):
         raise NotImplementedError
 
     def pop_data(self, key):
         raise NotImplementedError
 
+    def get_data_many(self, keys, peek=False):
+        # Returns a list of values, with EmptyData for missing keys.
+        raise NotImplementedError
+
     def has_data_for_key(self, key):
         raise NotImplementedError
 
@@ -68,10 +143,14 @@ class BaseStorage(object):
     def flush_results(self):
         raise NotImplementedError
 
-    def put_error(self, metadata):
+    def put_error(self, metadata, task_name=None):
         raise NotImplementedError
 
-    def get_errors(self, limit=None, offset=0):
+    def put_errors(self, metadata_list, task_names=None):
+        for i, metadata in enumerate(metadata_list):
+            self.put_error(metadata, task_names[i] if task_names else None)
+
+    def get_errors(self, limit=None, offset=0, task_name=None):
         raise NotImplementedError
 
     def flush_errors(self):
@@ -84,6 +163,40 @@ class BaseStorage(object):
         # Iterate over consumer-sent events.
         raise NotImplementedError
 
+    def configure_pool(self, max_connections):
+        # Called by the consumer with the number of connections its workers
+        # may use at the same time. Only meaningful for storages that keep a
+        # pool of connections.
+        pass
+
+    def after_fork(self):
+        # Called in a worker process after it has been forked, so that
+        # connections inherited from the parent are not shared with it.
+        pass
+
+    def pool_stats(self):
+        # Counters describing the use of the connection pool, if any.
+        return {}
+
+    # The iter_* methods page through the storage rather than reading
+    # everything at once. Implementations that cannot do so fall back to
+    # the methods that return lists.
+    def iter_enqueued(self, chunk_size=1000):
+        for item in self.enqueued_items():
+            yield item
+
+    def iter_scheduled(self, chunk_size=1000):
+        for item in self.scheduled_items():
+            yield item
+
+    def iter_results(self, chunk_size=1000):
+        for item in self.result_items().items():
+            yield item
+
+    def iter_errors(self, chunk_size=1000, task_name=None):
+        for item in self.get_errors(task_name=task_name):
+            yield item
+
     def flush_all(self):
         self.flush_queue()
         self.flush_schedule()
@@ -92,37 +205,382 @@ class BaseStorage(object):
 
 
 # A custom lua script to pass to redis that will read tasks from the schedule
-# and atomically pop them from the sorted set and return them. It won't return
-# anything if it isn't able to remove the items it reads.
+# and atomically pop them from the sorted set and return them. If a limit is
+# given, at most that many of the oldest tasks are read, and exactly the
+# members that were read are removed.
 SCHEDULE_POP_LUA = """\
 local key = KEYS[1]
 local unix_ts = ARGV[1]
-local res = redis.call('zrangebyscore', key, '-inf', unix_ts)
-if #res and redis.call('zremrangebyscore', key, '-inf', unix_ts) == #res then
-    return res
+local limit = tonumber(ARGV[2])
+local res
+if limit > 0 then
+    res = redis.call('zrangebyscore', key, '-inf', unix_ts, 'LIMIT', 0, limit)
+else
+    res = redis.call('zrangebyscore', key, '-inf', unix_ts)
+end
+for i = 1, #res, 1000 do
+    local chunk = {unpack(res, i, math.min(i + 999, #res))}
+    redis.call('zrem', key, unpack(chunk))
+    redis.call('hdel', KEYS[2], unpack(chunk))
+end
+return res"""
+
+# Move due members of the schedule straight onto the queue, oldest first,
+# without them ever leaving the server. Messages scheduled with a non-default
+# priority have the list they belong on recorded in a hash; all others go to
+# the default list. Returns the number of messages moved.
+SCHEDULE_PROMOTE_LUA = """\
+local schedule = KEYS[1]
+local queue = KEYS[2]
+local destinations = KEYS[3]
+local limit = tonumber(ARGV[2])
+local res
+if limit > 0 then
+    res = redis.call('zrangebyscore', schedule, '-inf', ARGV[1],
+                     'LIMIT', 0, limit)
+else
+    res = redis.call('zrangebyscore', schedule, '-inf', ARGV[1])
+end
+for _, msg in ipairs(res) do
+    local destination = redis.call('hget', destinations, msg) or queue
+    redis.call('lpush', destination, msg)
+    redis.call('zrem', schedule, msg)
+    redis.call('hdel', destinations, msg)
+end
+return #res"""
+
+# Pop up to N messages in a single atomic step. The queue is made up of one
+# list per priority (the list for the default priority, 0, being the queue key
+# itself), and the priorities in use are tracked in a sorted set. Messages are
+# taken from the tail of the lists (the end consumed by RPOP), highest priority
+# first. If weights are given, each message is instead taken from a non-empty
+# list chosen at random in proportion to the weight of its priority, so that
+# lower priorities still make progress.
+#
+# In reliable mode, popped messages are moved atomically to the consumer's
+# processing list and recorded in the in-flight sorted set, scored by the time
+# at which their visibility timeout expires. The list a message came from is
+# remembered if it was not the default one, so it can be requeued there.
+QUEUE_POP_LUA = """\
+local queue = KEYS[1]
+local priorities = KEYS[2]
+local processing = KEYS[3]
+local inflight = KEYS[4]
+local processing_lists = KEYS[5]
+local inflight_sources = KEYS[6]
+local n = tonumber(ARGV[1])
+local reliable = ARGV[2] == '1'
+local deadline = ARGV[3]
+
+local keys = {queue}
+local levels = {'0'}
+local in_use = redis.call('zrevrangebyscore', priorities, '+inf', '-inf')
+if #in_use > 0 then
+    keys = {}
+    levels = in_use
+    for i, p in ipairs(in_use) do
+        if p == '0' then
+            keys[i] = queue
+        else
+            keys[i] = queue .. '.p' .. p
+        end
+    end
+end
+
+local weights = nil
+if #ARGV > 4 then
+    weights = {}
+    math.randomseed(tonumber(ARGV[4]))
+    for i = 5, #ARGV, 2 do
+        weights[ARGV[i]] = tonumber(ARGV[i + 1])
+    end
+end
+
+local function pick()
+    if not weights then
+        for _, key in ipairs(keys) do
+            if redis.call('llen', key) > 0 then
+                return key
+            end
+        end
+        return nil
+    end
+    local total = 0
+    local candidates = {}
+    for i, key in ipairs(keys) do
+        if redis.call('llen', key) > 0 then
+            local weight = weights[levels[i]] or 1
+            total = total + weight
+            candidates[#candidates + 1] = {key, total}
+        end
+    end
+    if #candidates == 0 then
+        return nil
+    end
+    local r = math.random() * total
+    for _, candidate in ipairs(candidates) do
+        if r < candidate[2] then
+            return candidate[1]
+        end
+    end
+    return candidates[#candidates][1]
+end
+
+local popped = {}
+for i = 1, n do
+    local key = pick()
+    if not key then
+        break
+    end
+    local msg
+    if reliable then
+        msg = redis.call('rpoplpush', key, processing)
+        redis.call('zadd', inflight, deadline, msg)
+        if key ~= queue then
+            redis.call('hset', inflight_sources, msg, key)
+        end
+    else
+        msg = redis.call('rpop', key)
+    end
+    popped[#popped + 1] = msg
+end
+if reliable and #popped > 0 then
+    redis.call('sadd', processing_lists, processing)
+end
+return popped"""
+
+# Return at most N in-flight messages whose visibility timeout has expired to
+# the front of the list they were read from, removing them from whichever
+# processing list holds them. Returns the number of messages requeued.
+#
+# A message moved by BRPOPLPUSH is only added to the in-flight set by a second
+# command, so a consumer that dies in between leaves it in its processing list
+# alone. Any such message is first given a new deadline, after which it
+# expires like any other.
+REQUEUE_EXPIRED_LUA = """\
+local inflight = KEYS[1]
+local queue = KEYS[2]
+local processing_lists = KEYS[3]
+local inflight_sources = KEYS[4]
+local lists = redis.call('smembers', processing_lists)
+for _, processing in ipairs(lists) do
+    for _, msg in ipairs(redis.call('lrange', processing, 0, -1)) do
+        if not redis.call('zscore', inflight, msg) then
+            redis.call('zadd', inflight, ARGV[3], msg)
+        end
+    end
+end
+local expired = redis.call('zrangebyscore', inflight, '-inf', ARGV[1],
+                           'LIMIT', 0, tonumber(ARGV[2]))
+if #expired == 0 then
+    return 0
+end
+for _, msg in ipairs(expired) do
+    for _, processing in ipairs(lists) do
+        if redis.call('lrem', processing, 1, msg) > 0 then
+            break
+        end
+    end
+    local source = redis.call('hget', inflight_sources, msg) or queue
+    redis.call('rpush', source, msg)
+    redis.call('zrem', inflight, msg)
+    redis.call('hdel', inflight_sources, msg)
+end
+return #expired"""
+
+# Atomically read and remove a result, returning a pair of an "exists" flag
+# and the value, so that a stored empty value can be told apart from a missing
+# one. KEYS[1] is the result hash, or the result's own key when results are
+# stored as individual keys, in which case KEYS[2] is the result index.
+POP_DATA_LUA = """\
+local value
+if #KEYS == 1 then
+    value = redis.call('hget', KEYS[1], ARGV[1])
+    if value then
+        redis.call('hdel', KEYS[1], ARGV[1])
+    end
+else
+    value = redis.call('get', KEYS[1])
+    if value then
+        redis.call('del', KEYS[1])
+    end
+    redis.call('zrem', KEYS[2], KEYS[1])
+end
+if value then
+    return {1, value}
+end
+return {0}"""
+
+# Push one or more errors onto the error list, trimming it once it grows past
+# the cap. If per-task indexes are kept, KEYS[2] is a set naming the index
+# lists and KEYS[i + 2] is the index list for the i-th error, which is capped
+# in the same way.
+PUT_ERRORS_LUA = """\
+local max_errors = tonumber(ARGV[1])
+local trim_to = tonumber(ARGV[2])
+local function push(key, value)
+    if redis.call('lpush', key, value) > max_errors then
+        redis.call('ltrim', key, 0, trim_to)
+    end
+end
+for i = 3, #ARGV do
+    push(KEYS[1], ARGV[i])
+    if #KEYS > 1 and KEYS[i] ~= '' then
+        redis.call('sadd', KEYS[2], KEYS[i])
+        push(KEYS[i], ARGV[i])
+    end
 end"""
 
 
+class _CountingPoolMixin(object):
+    """
+    Keeps counters describing how a connection pool is used, so that
+    contention for connections can be observed. A checkout is counted as a
+    wait when every connection the pool may open was already in use.
+    """
+    def reset(self):
+        super(_CountingPoolMixin, self).reset()
+        self._stats_lock = threading.Lock()
+        self.created = 0
+        self.checkouts = 0
+        self.in_use = 0
+        self.max_in_use = 0
+        self.waits = 0
+        self.wait_time = 0.
+        self.timeouts = 0
+
+    def make_connection(self):
+        connection = super(_CountingPoolMixin, self).make_connection()
+        with self._stats_lock:
+            self.created += 1
+        return connection
+
+    def get_connection(self, command_name, *keys, **options):
+        contended = self.in_use >= self.max_connections
+        start = time.time()
+        try:
+            connection = super(_CountingPoolMixin, self).get_connection(
+                command_name, *keys, **options)
+        except ConnectionError:
+            with self._stats_lock:
+                self.timeouts += int(contended)
+            raise
+        with self._stats_lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+            if contended:
+                self.waits += 1
+                self.wait_time += time.time() - start
+        return connection
+
+    def release(self, connection):
+        if connection.pid == self.pid:
+            with self._stats_lock:
+                self.in_use -= 1
+        super(_CountingPoolMixin, self).release(connection)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'max_connections': self.max_connections,
+                'created': self.created,
+                'checkouts': self.checkouts,
+                'in_use': self.in_use,
+                'max_in_use': self.max_in_use,
+                'waits': self.waits,
+                'wait_time': self.wait_time,
+                'timeouts': self.timeouts}
+
+
+if redis is not None:
+    class CountingConnectionPool(_CountingPoolMixin, redis.ConnectionPool):
+        pass
+
+    class BlockingCountingConnectionPool(_CountingPoolMixin,
+                                         redis.BlockingConnectionPool):
+        pass
+
 class RedisStorage(BaseStorage):
+    # Number of seconds a result wake-up is kept when nobody is waiting.
+    notify_ttl = 60
+
     def __init__(self, name='huey', blocking=False, read_timeout=1,
-                 max_errors=1000, connection_pool=None, **connection_params):
-        if connection_pool is None:
-            connection_pool = redis.ConnectionPool(**connection_params)
+                 max_errors=1000, connection_pool=None,
+                 enqueue_chunk_size=1000, reliable=False,
+                 visibility_timeout=300, consumer_id=None, reap_batch_size=100,
+                 result_keys=False, result_ttl=None, notify_results=False,
+                 priority_weights=None, error_index=False, shard=None,
+                 max_connections=None, pool_timeout=20,
+                 **connection_params):
+        if redis is None:
+            raise RuntimeError('Error, "redis" is not installed. Install '
+                               'using pip: "pip install redis"')
+        if result_ttl and not result_keys:
+            raise ValueError('result_ttl requires result_keys=True, as fields '
+                             'of the result hash cannot be expired.')
 
-        self.pool = connection_pool
-        self.conn = redis.Redis(connection_pool=connection_pool)
         self.connection_params = connection_params
-        self._pop = self.conn.register_script(SCHEDULE_POP_LUA)
+        self.pool_timeout = pool_timeout
+        # Pools created here may be resized by the consumer and are replaced
+        # after a fork. Pools passed in are left under the caller's control.
+        self._owns_pool = connection_pool is None
+        if connection_pool is None:
+            connection_pool = self.create_pool(max_connections)
+        self._connect(connection_pool)
 
         self.name = self.clean_name(name)
-        self.queue_key = 'huey.redis.%s' % self.name
-        self.schedule_key = 'huey.schedule.%s' % self.name
-        self.result_key = 'huey.results.%s' % self.name
-        self.error_key = 'huey.errors.%s' % self.name
+        self.shard = shard
+
+        # The keys of a shard all contain the same hash tag, so that they map
+        # to a single Redis Cluster slot and can be used together by the Lua
+        # scripts.
+        if shard is None:
+            key_name = self.name
+        else:
+            key_name = '{%s.%d}' % (self.name, shard)
+
+        self.queue_key = 'huey.redis.%s' % key_name
+        self.priorities_key = 'huey.priorities.%s' % key_name
+        self.schedule_key = 'huey.schedule.%s' % key_name
+        self.schedule_destinations_key = 'huey.scheduledest.%s' % key_name
+        self.result_key = 'huey.results.%s' % key_name
+        self.error_key = 'huey.errors.%s' % key_name
+        self.error_index_key = 'huey.errorindex.%s' % key_name
+
+        # Keys used by the reliable queue: a processing list for each
+        # consumer, a set naming all the processing lists, and a sorted set
+        # of in-flight messages scored by visibility deadline.
+        if consumer_id is None:
+            consumer_id = '%s%s' % (socket.gethostname(), os.getpid())
+        self.consumer_id = self.clean_name(consumer_id)
+        self.processing_lists_key = 'huey.processing.%s' % key_name
+        self.processing_key = '%s.%s' % (self.processing_lists_key,
+                                         self.consumer_id)
+        self.inflight_key = 'huey.inflight.%s' % key_name
+        self.inflight_sources_key = 'huey.inflightsources.%s' % key_name
+
+        # When results are stored in individual keys, a sorted set of the keys
+        # scored by expiry time is kept so the store can be sized and listed.
+        self.result_prefix = 'huey.result.%s.' % key_name
+        self.result_index_key = 'huey.resultindex.%s' % key_name
+        self.notify_prefix = 'huey.notify.%s.' % key_name
 
         self.blocking = blocking
         self.read_timeout = read_timeout
         self.max_errors = max_errors
+        self.enqueue_chunk_size = enqueue_chunk_size
+        self.reliable = reliable
+        self.visibility_timeout = visibility_timeout
+        self.reap_batch_size = reap_batch_size
+        self.result_keys = result_keys
+        self.result_ttl = result_ttl
+        self.notify_results = notify_results
+        self.priority_weights = priority_weights
+        self.error_index = error_index
+        # Whether the server accepts fractional timeouts, found out on the
+        # first wait_for_data().
+        self._float_timeouts = None
 
     def clean_name(self, name):
         return re.sub('[^a-z0-9]', '', name)
@@ -130,97 +588,527 @@ class RedisStorage(BaseStorage):
     def convert_ts(self, ts):
         return time.mktime(ts.timetuple())
 
-    def enqueue(self, data):
-        self.conn.lpush(self.queue_key, data)
+    def create_pool(self, max_connections=None):
+        if max_connections is None:
+            return CountingConnectionPool(**self.connection_params)
+        return BlockingCountingConnectionPool(
+            max_connections=max_connections,
+            timeout=self.pool_timeout,
+            **self.connection_params)
+
+    def _connect(self, pool):
+        self.pool = pool
+        self.conn = redis.Redis(connection_pool=pool)
+        self._schedule_pop = self.conn.register_script(SCHEDULE_POP_LUA)
+        self._schedule_promote = self.conn.register_script(
+            SCHEDULE_PROMOTE_LUA)
+        self._pop_script = self.conn.register_script(QUEUE_POP_LUA)
+        self._requeue_expired = self.conn.register_script(REQUEUE_EXPIRED_LUA)
+        self._pop_data = self.conn.register_script(POP_DATA_LUA)
+        self._put_errors = self.conn.register_script(PUT_ERRORS_LUA)
+
+    def configure_pool(self, max_connections):
+        # Pools are grown when they are too small to be used by all of the
+        # consumer's workers at once, but are never shrunk.
+        if self._owns_pool and self.pool.max_connections < max_connections:
+            self.pool.disconnect()
+            self._connect(self.create_pool(max_connections))
+
+    def after_fork(self):
+        # Connections inherited from the parent share its sockets, so the
+        # child starts again with an empty pool. The inherited connections
+        # are dropped without being closed, as closing them would also
+        # disrupt the parent.
+        if self._owns_pool:
+            max_connections = None
+            if isinstance(self.pool, redis.BlockingConnectionPool):
+                max_connections = self.pool.max_connections
+            self._connect(self.create_pool(max_connections))
+        else:
+            self.pool.reset()
+
+    def pool_stats(self):
+        if isinstance(self.pool, _CountingPoolMixin):
+            return self.pool.stats()
+        return {}
+
+    # ZADD and LREM take their arguments in a different order in each major
+    # version of redis-py, so they are sent as raw commands, which are the
+    # same in every version.
+    def _zadd(self, client, key, *args):
+        # Arguments are score, member pairs, as taken by the command.
+        return client.execute_command('ZADD', key, *args)
+
+    def _lrem(self, client, key, value, count=0):
+        return client.execute_command('LREM', key, count, value)
+
+    def queue_key_for(self, priority):
+        if not priority:
+            return self.queue_key
+        return '%s.p%d' % (self.queue_key, priority)
+
+    def _queue_keys(self):
+        # Keys of the lists that make up the queue, highest priority first.
+        priorities = self.conn.zrevrangebyscore(self.priorities_key, '+inf',
+                                                '-inf')
+        if not priorities:
+            return [self.queue_key]
+        return [self.queue_key_for(int(p)) for p in priorities]
+
+    def _register_priority(self, pipe, priority):
+        if priority:
+            # The default priority is registered along with the first other
+            # priority, so that all of the queue's lists are listed.
+            self._zadd(pipe, self.priorities_key, 0, 0, priority, priority)
+
+    def enqueue(self, data, priority=0):
+        if not priority:
+            self.conn.lpush(self.queue_key, data)
+        else:
+            pipe = self.conn.pipeline()
+            self._register_priority(pipe, priority)
+            pipe.lpush(self.queue_key_for(priority), data)
+            pipe.execute()
+
+    def enqueue_many(self, data, priority=0):
+        # Push the messages using multi-value LPUSH commands, sent through a
+        # single pipeline. Ordering is the same as calling enqueue() in a loop.
+        pipe = self.conn.pipeline(transaction=False)
+        self._register_priority(pipe, priority)
+        queue_key = self.queue_key_for(priority)
+        chunk_size = self.enqueue_chunk_size
+        for i in range(0, len(data), chunk_size):
+            pipe.lpush(queue_key, *data[i:i + chunk_size])
+        pipe.execute()
 
     def dequeue(self):
-        if self.blocking:
+        messages = self._pop(1)
+        if messages:
+            return messages[0]
+        elif self.blocking:
+            return self._blocking_dequeue()
+
+    def _pop(self, n):
+        keys, args = self._pop_params(n)
+        return self._pop_script(keys=keys, args=args)
+
+    def _pop_params(self, n):
+        # Keys and arguments of the QUEUE_POP_LUA script.
+        args = [n, int(self.reliable), self._deadline()]
+        if self.priority_weights:
+            args.append(random.randint(1, 2 ** 31))
+            for priority, weight in self.priority_weights.items():
+                args.extend((priority, weight))
+        keys = [self.queue_key, self.priorities_key, self.processing_key,
+                self.inflight_key, self.processing_lists_key,
+                self.inflight_sources_key]
+        return keys, args
+
+    def _blocking_dequeue(self):
+        if self.reliable:
+            # BRPOPLPUSH can only wait on a single list, so only the default
+            # priority is waited on. Other priorities are picked up by the
+            # next call to dequeue(). The processing list is registered
+            # beforehand, so that requeue_expired() finds a message that was
+            # moved but never added to the in-flight set.
             try:
-                return self.conn.brpop(
+                self.conn.sadd(self.processing_lists_key, self.processing_key)
+                message = self.conn.brpoplpush(
                     self.queue_key,
-                    timeout=self.read_timeout)[1]
-            except (ConnectionError, TypeError, IndexError):
-                # Unfortunately, there is no way to differentiate a socket
-                # timing out and a host being unreachable.
+                    self.processing_key,
+                    timeout=self.read_timeout)
+            except ConnectionError:
                 return None
-        else:
-            return self.conn.rpop(self.queue_key)
+            if message is not None:
+                self._zadd(self.conn, self.inflight_key, self._deadline(),
+                           message)
+            return message
+
+        try:
+            return self.conn.brpop(
+                self._queue_keys(),
+                timeout=self.read_timeout)[1]
+        except (ConnectionError, TypeError, IndexError):
+            # Unfortunately, there is no way to differentiate a socket
+            # timing out and a host being unreachable.
+            return None
+
+    def _deadline(self):
+        return time.time() + self.visibility_timeout
+
+    def dequeue_many(self, n):
+        messages = self._pop(n)
+        if not messages and self.blocking:
+            # Nothing is ready, so block waiting for a single message.
+            message = self._blocking_dequeue()
+            if message is not None:
+                messages = [message]
+        return messages or []
+
+    def requeue(self, data, priority=0):
+        # Push the messages back onto the end of the queue that is read from,
+        # so that they are the next to be dequeued and keep their order.
+        if not data:
+            return
+        pipe = self.conn.pipeline()
+        if self.reliable:
+            for message in data:
+                self._lrem(pipe, self.processing_key, message, 1)
+                pipe.zrem(self.inflight_key, message)
+                pipe.hdel(self.inflight_sources_key, message)
+        self._register_priority(pipe, priority)
+        pipe.rpush(self.queue_key_for(priority), *reversed(data))
+        pipe.execute()
+
+    def ack(self, data):
+        if self.reliable:
+            pipe = self.conn.pipeline()
+            self._lrem(pipe, self.processing_key, data, 1)
+            pipe.zrem(self.inflight_key, data)
+            pipe.hdel(self.inflight_sources_key, data)
+            pipe.execute()
+
+    def touch(self, data):
+        if not self.reliable:
+            return True
+        # XX only updates a message that is still in flight, and CH counts
+        # the update, so nothing is re-added once the message has expired.
+        return bool(self.conn.execute_command(
+            'ZADD', self.inflight_key, 'XX', 'CH', self._deadline(), data))
+
+    def requeue_expired(self):
+        # Each call handles a bounded batch, so that a large number of expired
+        # messages cannot block the server for long.
+        if not self.reliable:
+            return 0
+        return self._requeue_expired(
+            keys=[self.inflight_key, self.queue_key,
+                  self.processing_lists_key, self.inflight_sources_key],
+            args=[time.time(), self.reap_batch_size, self._deadline()])
 
     def unqueue(self, data):
-        return self.conn.lrem(self.queue_key, data)
+        pipe = self.conn.pipeline()
+        for queue_key in self._queue_keys():
+            self._lrem(pipe, queue_key, data)
+        return sum(pipe.execute())
 
     def queue_size(self):
-        return self.conn.llen(self.queue_key)
+        pipe = self.conn.pipeline()
+        for queue_key in self._queue_keys():
+            pipe.llen(queue_key)
+        return sum(pipe.execute())
+
+    def _end_index(self, limit, offset=0):
+        # Convert a number of items into the inclusive end index taken by
+        # LRANGE and ZRANGE.
+        return -1 if limit is None else offset + limit - 1
+
+    def _iter_list(self, key, chunk_size):
+        # Read a list in windows of chunk_size items. The list may change
+        # while it is being read, so this is not a consistent snapshot.
+        start = 0
+        while True:
+            items = self.conn.lrange(key, start, start + chunk_size - 1)
+            for item in items:
+                yield item
+            if len(items) < chunk_size:
+                break
+            start += chunk_size
 
     def enqueued_items(self, limit=None):
-        limit = limit or -1
-        return self.conn.lrange(self.queue_key, 0, limit)
+        if limit == 0:
+            return []
+        accum = []
+        for queue_key in self._queue_keys():
+            accum.extend(self.conn.lrange(queue_key, 0,
+                                          self._end_index(limit)))
+            if limit is not None and len(accum) >= limit:
+                return accum[:limit]
+        return accum
+
+    def iter_enqueued(self, chunk_size=1000):
+        for queue_key in self._queue_keys():
+            for item in self._iter_list(queue_key, chunk_size):
+                yield item
+
+    def inflight_size(self):
+        return self.conn.zcard(self.inflight_key)
 
     def flush_queue(self):
-        self.conn.delete(self.queue_key)
+        keys = self._queue_keys() + [self.queue_key, self.priorities_key]
+        if self.reliable:
+            keys.extend(self.conn.smembers(self.processing_lists_key))
+            keys.extend((self.processing_lists_key, self.inflight_key,
+                         self.inflight_sources_key))
+        self.conn.delete(*keys)
+
+    def add_to_schedule(self, data, ts, priority=0):
+        if not priority:
+            self._zadd(self.conn, self.schedule_key, self.convert_ts(ts), data)
+            return
 
-    def add_to_schedule(self, data, ts):
-        self.conn.zadd(self.schedule_key, data, self.convert_ts(ts))
+        pipe = self.conn.pipeline()
+        self._register_priority(pipe, priority)
+        pipe.hset(self.schedule_destinations_key, data,
+                  self.queue_key_for(priority))
+        self._zadd(pipe, self.schedule_key, self.convert_ts(ts), data)
+        pipe.execute()
 
-    def read_schedule(self, ts):
+    def read_schedule(self, ts, limit=None):
         unix_ts = self.convert_ts(ts)
         # invoke the redis lua script that will atomically pop off
-        # all the tasks older than the given timestamp
-        tasks = self._pop(keys=[self.schedule_key], args=[unix_ts])
+        # the tasks older than the given timestamp, up to the limit
+        tasks = self._schedule_pop(
+            keys=[self.schedule_key, self.schedule_destinations_key],
+            args=[unix_ts, limit or 0])
         return [] if tasks is None else tasks
 
+    def promote_schedule(self, ts, limit=None):
+        return self._schedule_promote(
+            keys=[self.schedule_key, self.queue_key,
+                  self.schedule_destinations_key],
+            args=[self.convert_ts(ts), limit or 0])
+
     def schedule_size(self):
         return self.conn.zcard(self.schedule_key)
 
     def scheduled_items(self, limit=None):
-        limit = limit or -1
-        return self.conn.zrange(self.schedule_key, 0, limit, withscores=False)
+        if limit == 0:
+            return []
+        return self.conn.zrange(self.schedule_key, 0, self._end_index(limit),
+                                withscores=False)
+
+    def iter_scheduled(self, chunk_size=1000):
+        # Items are returned in no particular order.
+        for item, _ in self.conn.zscan_iter(self.schedule_key,
+                                            count=chunk_size):
+            yield item
 
     def flush_schedule(self):
-        self.conn.delete(self.schedule_key)
+        self.conn.delete(self.schedule_key, self.schedule_destinations_key)
 
     def put_data(self, key, value):
-        self.conn.hset(self.result_key, key, value)
+        self._put_data(key, value)
+
+    def put_result(self, key, value):
+        self._put_data(key, value, self.result_ttl, self.notify_results)
+
+    def _put_data(self, key, value, ttl=None, notify=False):
+        if not self.result_keys and not notify:
+            self.conn.hset(self.result_key, key, value)
+            return
 
-    def peek_data(self, key):
         pipe = self.conn.pipeline()
-        pipe.hexists(self.result_key, key)
-        pipe.hget(self.result_key, key)
-        exists, val = pipe.execute()
-        return EmptyData if not exists else val
+        if self.result_keys:
+            now = time.time()
+            pipe.set(self.result_prefix + key, value, ex=ttl)
+            self._zadd(pipe, self.result_index_key,
+                       now + ttl if ttl else float('inf'),
+                       self.result_prefix + key)
+            # Drop index entries for results that have expired since.
+            pipe.zremrangebyscore(self.result_index_key, '-inf', now)
+        else:
+            pipe.hset(self.result_key, key, value)
+        if notify:
+            # Wake up a client blocked in wait_for_data(). The wake-up is
+            # expired in case nobody is waiting for it.
+            pipe.lpush(self.notify_prefix + key, 1)
+            pipe.expire(self.notify_prefix + key, self.notify_ttl)
+        pipe.execute()
+
+    def wait_for_data(self, key, timeout=None):
+        # With no timeout this blocks until the result is stored, unless the
+        # connection has a socket_timeout.
+        if not self.notify_results:
+            return False
+        if self._float_timeouts is None:
+            self._set_server_info(self.conn.info('server'))
+        self.conn.blpop(self.notify_prefix + key,
+                        timeout=self._blocking_timeout(timeout))
+        return True
+
+    def _set_server_info(self, info):
+        version = info.get('redis_version', '0')
+        self._float_timeouts = int(version.split('.')[0]) >= 6
+
+    def _blocking_timeout(self, timeout):
+        # Redis 6 accepts fractional timeouts for blocking commands. Older
+        # servers only accept whole seconds, so the timeout is rounded up.
+        if not timeout:
+            return 0
+        elif self._float_timeouts:
+            return timeout
+        return int(math.ceil(timeout))
+
+    def peek_data(self, key):
+        # A missing value is returned as None, whereas a stored empty value is
+        # returned as an empty string, so a single command suffices.
+        if self.result_keys:
+            val = self.conn.get(self.result_prefix + key)
+        else:
+            val = self.conn.hget(self.result_key, key)
+        return EmptyData if val is None else val
 
     def pop_data(self, key):
+        if self.result_keys:
+            keys = [self.result_prefix + key, self.result_index_key]
+            args = []
+        else:
+            keys = [self.result_key]
+            args = [key]
+        res = self._pop_data(keys=keys, args=args)
+        return res[1] if res[0] else EmptyData
+
+    def get_data_many(self, keys, peek=False):
+        if not keys:
+            return []
         pipe = self.conn.pipeline()
-        pipe.hexists(self.result_key, key)
-        pipe.hget(self.result_key, key)
-        pipe.hdel(self.result_key, key)
-        exists, val, n = pipe.execute()
-        return EmptyData if not exists else val
+        if self.result_keys:
+            result_keys = [self.result_prefix + key for key in keys]
+            pipe.mget(result_keys)
+            if not peek:
+                pipe.delete(*result_keys)
+                pipe.zrem(self.result_index_key, *result_keys)
+        else:
+            pipe.hmget(self.result_key, keys)
+            if not peek:
+                pipe.hdel(self.result_key, *keys)
+        values = pipe.execute()[0]
+        return [EmptyData if value is None else value for value in values]
 
     def has_data_for_key(self, key):
+        if self.result_keys:
+            return bool(self.conn.exists(self.result_prefix + key))
         return self.conn.hexists(self.result_key, key)
 
     def result_store_size(self):
+        if self.result_keys:
+            pipe = self.conn.pipeline()
+            pipe.zremrangebyscore(self.result_index_key, '-inf', time.time())
+            pipe.zcard(self.result_index_key)
+            return pipe.execute()[1]
         return self.conn.hlen(self.result_key)
 
     def result_items(self):
-        return self.conn.hgetall(self.result_key)
+        if not self.result_keys:
+            return self.conn.hgetall(self.result_key)
+
+        self.conn.zremrangebyscore(self.result_index_key, '-inf', time.time())
+        keys = self.conn.zrange(self.result_index_key, 0, -1)
+        prefix_len = len(self.result_prefix)
+        accum = {}
+        for i in range(0, len(keys), 1000):
+            chunk = keys[i:i + 1000]
+            for key, value in zip(chunk, self.conn.mget(chunk)):
+                if value is not None:
+                    accum[key[prefix_len:]] = value
+        return accum
+
+    def iter_results(self, chunk_size=1000):
+        if not self.result_keys:
+            for item in self.conn.hscan_iter(self.result_key,
+                                             count=chunk_size):
+                yield item
+            return
+
+        now = time.time()
+        chunk = []
+        for key, expires in self.conn.zscan_iter(self.result_index_key,
+                                                 count=chunk_size):
+            if expires > now:
+                chunk.append(key)
+            if len(chunk) == chunk_size:
+                for item in self._read_result_keys(chunk):
+                    yield item
+                chunk = []
+        for item in self._read_result_keys(chunk):
+            yield item
+
+    def _read_result_keys(self, keys):
+        prefix_len = len(self.result_prefix)
+        values = self.conn.mget(keys) if keys else []
+        for key, value in zip(keys, values):
+            if value is not None:
+                yield key[prefix_len:], value
 
     def flush_results(self):
-        self.conn.delete(self.result_key)
-
-    def put_error(self, metadata):
-        self.conn.lpush(self.error_key, metadata)
-        if self.conn.llen(self.error_key) > self.max_errors:
-            self.conn.ltrim(self.error_key, 0, int(self.max_errors * .9))
-
-    def get_errors(self, limit=None, offset=0):
-        if limit is None:
-            limit = -1
-        return self.conn.lrange(self.error_key, offset, limit)
+        keys = self.conn.zrange(self.result_index_key, 0, -1)
+        for i in range(0, len(keys), 1000):
+            self.conn.delete(*keys[i:i + 1000])
+        self.conn.delete(self.result_key, self.result_index_key)
+
+    def migrate_results(self, batch_size=1000):
+        """
+        Move results stored in the legacy result hash into individual keys,
+        applying the configured ``result_ttl``. The hash is walked with HSCAN
+        so that each step only touches ``batch_size`` fields. Returns the
+        number of results that were migrated.
+        """
+        if not self.result_keys:
+            raise ValueError('Results can only be migrated when '
+                             'result_keys=True.')
+
+        prefix = self.result_prefix.encode('utf-8')
+        migrated = 0
+        cursor = 0
+        while True:
+            cursor, data = self.conn.hscan(self.result_key, cursor,
+                                           count=batch_size)
+            if data:
+                expires = (time.time() + self.result_ttl if self.result_ttl
+                           else float('inf'))
+                pipe = self.conn.pipeline()
+                for key, value in data.items():
+                    pipe.set(prefix + key, value, ex=self.result_ttl)
+                    self._zadd(pipe, self.result_index_key, expires,
+                               prefix + key)
+                pipe.hdel(self.result_key, *data.keys())
+                pipe.execute()
+                migrated += len(data)
+            if not cursor:
+                break
+        return migrated
+
+    def error_key_for(self, task_name):
+        return '%s.%s' % (self.error_key, task_name)
+
+    def put_error(self, metadata, task_name=None):
+        self.put_errors([metadata], [task_name] if task_name else None)
+
+    def put_errors(self, metadata_list, task_names=None):
+        if not metadata_list:
+            return
+        keys = [self.error_key]
+        if self.error_index and task_names:
+            keys.append(self.error_index_key)
+            # Errors without a task name are only added to the main list.
+            keys.extend(self.error_key_for(name) if name is not None else ''
+                        for name in task_names)
+        self._put_errors(
+            keys=keys,
+            args=[self.max_errors, int(self.max_errors * .9)] +
+            list(metadata_list))
+
+    def _error_list_key(self, task_name):
+        if task_name is None:
+            return self.error_key
+        elif self.error_index:
+            return self.error_key_for(task_name)
+        raise ValueError('Errors can only be filtered by task when '
+                         'error_index=True.')
+
+    def get_errors(self, limit=None, offset=0, task_name=None):
+        if limit == 0:
+            return []
+        return self.conn.lrange(self._error_list_key(task_name), offset,
+                                self._end_index(limit, offset))
+
+    def iter_errors(self, chunk_size=1000, task_name=None):
+        return self._iter_list(self._error_list_key(task_name), chunk_size)
 
     def flush_errors(self):
-        self.conn.delete(self.error_key)
+        keys = self.conn.smembers(self.error_index_key)
+        self.conn.delete(self.error_key, self.error_index_key, *keys)
 
     def emit(self, message):
         self.conn.publish(self.name, message)
@@ -245,13 +1133,1495 @@ class _EventIterator(object):
     __next__ = next
 
 
+class ShardedRedisStorage(BaseStorage):
+    """
+    Spreads the queue, schedule and results of a huey instance over several
+    :py:class:`RedisStorage` shards, each of which may use a different Redis
+    server or cluster node.
+
+    Tasks are enqueued on the shards in turn, and are dequeued by sweeping
+    over the shards starting from a different one on each call. Results are
+    placed on a shard chosen by hashing their key. Errors and events are kept
+    on the first shard, so that they remain in order.
+
+    :param shards: a list with an item for each shard, either a
+        ``redis.ConnectionPool`` or a dict of connection parameters. An
+        integer may be given instead to create that many shards using the
+        remaining connection parameters.
+    """
+    def __init__(self, name='huey', shards=2, blocking=False, read_timeout=1,
+                 max_errors=1000, enqueue_chunk_size=1000,
+                 result_keys=False, result_ttl=None, notify_results=False,
+                 priority_weights=None, error_index=False,
+                 **connection_params):
+        super(ShardedRedisStorage, self).__init__(name)
+        if isinstance(shards, int):
+            shards = [connection_params] * shards
+        if not shards:
+            raise ValueError('At least one shard is required.')
+
+        self.shards = []
+        for i, shard in enumerate(shards):
+            if isinstance(shard, dict):
+                params = dict(connection_params, **shard)
+                pool = None
+            else:
+                params, pool = {}, shard
+            self.shards.append(RedisStorage(
+                name=name,
+                blocking=False,
+                read_timeout=read_timeout,
+                max_errors=max_errors,
+                connection_pool=pool,
+                enqueue_chunk_size=enqueue_chunk_size,
+                result_keys=result_keys,
+                result_ttl=result_ttl,
+                notify_results=notify_results,
+                priority_weights=priority_weights,
+                error_index=error_index,
+                shard=i,
+                **params))
+
+        self.name = self.shards[0].name
+        self.blocking = blocking
+        # Start at a random shard, so that producers and consumers started
+        # at the same time do not all favor the first shard.
+        self._counter = itertools.count(random.randint(0, len(self.shards)))
+
+    def _rotation(self):
+        # The shards in the order in which they should be tried.
+        n = len(self.shards)
+        start = next(self._counter) % n
+        return [self.shards[(start + i) % n] for i in range(n)]
+
+    def _next_shard(self):
+        return self.shards[next(self._counter) % len(self.shards)]
+
+    def _shard_for_key(self, key):
+        index = binascii.crc32(to_bytes(key)) & 0xffffffff
+        return self.shards[index % len(self.shards)]
+
+    def _split(self, n, size):
+        # Divide n into a share for each of size shards.
+        return [n // size + (1 if i < n % size else 0) for i in range(size)]
+
+    def _sweep(self, limit, fetch):
+        # Call fetch(shard, n) for each shard, starting from a different shard
+        # on each call so the remainder of the split does not always fall to
+        # the same shards. Shares left over by shards that ran out are offered
+        # to the shards that filled theirs, so that fewer than limit items are
+        # only fetched once every shard has been drained.
+        shards = self._rotation()
+        if not limit:
+            for shard in shards:
+                fetch(shard, None)
+            return
+
+        remaining = limit
+        while remaining and shards:
+            more = []
+            for shard, share in zip(shards, self._split(remaining,
+                                                        len(shards))):
+                n = fetch(shard, share) if share else 0
+                remaining -= n
+                if n == share:
+                    more.append(shard)
+            shards = more
+
+    def enqueue(self, data, priority=0):
+        self._next_shard().enqueue(data, priority)
+
+    def enqueue_many(self, data, priority=0):
+        shards = self._rotation()
+        for i, shard in enumerate(shards):
+            messages = data[i::len(shards)]
+            if messages:
+                shard.enqueue_many(messages, priority)
+
+    def dequeue(self):
+        messages = self.dequeue_many(1)
+        if messages:
+            return messages[0]
+
+    def dequeue_many(self, n):
+        shards = self._rotation()
+        accum = []
+        for shard in shards:
+            accum.extend(shard.dequeue_many(n - len(accum)))
+            if len(accum) == n:
+                return accum
+        if not accum and self.blocking:
+            # A blocking read cannot span servers, so wait on a single shard.
+            # Messages arriving on the others are found by the next sweep.
+            message = shards[0]._blocking_dequeue()
+            if message is not None:
+                accum.append(message)
+        return accum
+
+    def requeue(self, data, priority=0):
+        self._next_shard().requeue(data, priority)
+
+    def unqueue(self, data):
+        return sum(shard.unqueue(data) for shard in self.shards)
+
+    def queue_size(self):
+        return sum(shard.queue_size() for shard in self.shards)
+
+    def enqueued_items(self, limit=None):
+        accum = []
+        for shard in self.shards:
+            accum.extend(shard.enqueued_items(limit))
+        return accum if limit is None else accum[:limit]
+
+    def iter_enqueued(self, chunk_size=1000):
+        for shard in self.shards:
+            for item in shard.iter_enqueued(chunk_size):
+                yield item
+
+    def flush_queue(self):
+        for shard in self.shards:
+            shard.flush_queue()
+
+    def add_to_schedule(self, data, ts, priority=0):
+        self._next_shard().add_to_schedule(data, ts, priority)
+
+    def read_schedule(self, ts, limit=None):
+        accum = []
+        def fetch(shard, n):
+            items = shard.read_schedule(ts, n)
+            accum.extend(items)
+            return len(items)
+        self._sweep(limit, fetch)
+        return accum
+
+    def promote_schedule(self, ts, limit=None):
+        # Each shard moves its own due tasks onto its own queue.
+        counts = []
+        def fetch(shard, n):
+            counts.append(shard.promote_schedule(ts, n))
+            return counts[-1]
+        self._sweep(limit, fetch)
+        return sum(counts)
+
+    def schedule_size(self):
+        return sum(shard.schedule_size() for shard in self.shards)
+
+    def scheduled_items(self, limit=None):
+        accum = []
+        for shard in self.shards:
+            accum.extend(shard.scheduled_items(limit))
+        return accum if limit is None else accum[:limit]
+
+    def iter_scheduled(self, chunk_size=1000):
+        for shard in self.shards:
+            for item in shard.iter_scheduled(chunk_size):
+                yield item
+
+    def flush_schedule(self):
+        for shard in self.shards:
+            shard.flush_schedule()
+
+    def put_data(self, key, value):
+        self._shard_for_key(key).put_data(key, value)
+
+    def put_result(self, key, value):
+        self._shard_for_key(key).put_result(key, value)
+
+    def wait_for_data(self, key, timeout=None):
+        return self._shard_for_key(key).wait_for_data(key, timeout)
+
+    def peek_data(self, key):
+        return self._shard_for_key(key).peek_data(key)
+
+    def pop_data(self, key):
+        return self._shard_for_key(key).pop_data(key)
+
+    def get_data_many(self, keys, peek=False):
+        by_shard = {}
+        for i, key in enumerate(keys):
+            by_shard.setdefault(self._shard_for_key(key), []).append(i)
+        values = [EmptyData] * len(keys)
+        for shard, indexes in by_shard.items():
+            shard_values = shard.get_data_many([keys[i] for i in indexes],
+                                               peek)
+            for i, value in zip(indexes, shard_values):
+                values[i] = value
+        return values
+
+    def has_data_for_key(self, key):
+        return self._shard_for_key(key).has_data_for_key(key)
+
+    def result_store_size(self):
+        return sum(shard.result_store_size() for shard in self.shards)
+
+    def result_items(self):
+        accum = {}
+        for shard in self.shards:
+            accum.update(shard.result_items())
+        return accum
+
+    def iter_results(self, chunk_size=1000):
+        for shard in self.shards:
+            for item in shard.iter_results(chunk_size):
+                yield item
+
+    def flush_results(self):
+        for shard in self.shards:
+            shard.flush_results()
+
+    def put_error(self, metadata, task_name=None):
+        self.shards[0].put_error(metadata, task_name)
+
+    def put_errors(self, metadata_list, task_names=None):
+        self.shards[0].put_errors(metadata_list, task_names)
+
+    def get_errors(self, limit=None, offset=0, task_name=None):
+        return self.shards[0].get_errors(limit, offset, task_name)
+
+    def iter_errors(self, chunk_size=1000, task_name=None):
+        return self.shards[0].iter_errors(chunk_size, task_name)
+
+    def flush_errors(self):
+        self.shards[0].flush_errors()
+
+    def emit(self, message):
+        self.shards[0].emit(message)
+
+    def listener(self):
+        return self.shards[0].listener()
+
+    def __iter__(self):
+        return iter(self.shards[0])
+
+    def configure_pool(self, max_connections):
+        for shard in self.shards:
+            shard.configure_pool(max_connections)
+
+    def after_fork(self):
+        for shard in self.shards:
+            shard.after_fork()
+
+    def pool_stats(self):
+        # The counters of the shards added together.
+        stats = {}
+        for shard in self.shards:
+            for key, value in shard.pool_stats().items():
+                stats[key] = stats.get(key, 0) + value
+        return stats
+
+
 class RedisHuey(Huey):
     def get_storage(self, read_timeout=1, max_errors=1000,
-                    connection_pool=None, **connection_params):
+                    connection_pool=None, enqueue_chunk_size=1000,
+                    reliable=False, visibility_timeout=300, consumer_id=None,
+                    result_keys=False, result_ttl=None, notify_results=False,
+                    reap_batch_size=100, priority_weights=None,
+                    error_index=False, **connection_params):
         return RedisStorage(
             name=self.name,
             blocking=self.blocking,
             read_timeout=read_timeout,
             max_errors=max_errors,
             connection_pool=connection_pool,
+            enqueue_chunk_size=enqueue_chunk_size,
+            reliable=reliable,
+            visibility_timeout=visibility_timeout,
+            consumer_id=consumer_id,
+            reap_batch_size=reap_batch_size,
+            result_keys=result_keys,
+            result_ttl=result_ttl,
+            notify_results=notify_results,
+            priority_weights=priority_weights,
+            error_index=error_index,
+            **connection_params)
+
+
+class ShardedRedisHuey(Huey):
+    def get_storage(self, shards=2, read_timeout=1, max_errors=1000,
+                    enqueue_chunk_size=1000, result_keys=False,
+                    result_ttl=None, notify_results=False,
+                    priority_weights=None, error_index=False,
+                    **connection_params):
+        return ShardedRedisStorage(
+            name=self.name,
+            shards=shards,
+            blocking=self.blocking,
+            read_timeout=read_timeout,
+            max_errors=max_errors,
+            enqueue_chunk_size=enqueue_chunk_size,
+            result_keys=result_keys,
+            result_ttl=result_ttl,
+            notify_results=notify_results,
+            priority_weights=priority_weights,
+            error_index=error_index,
             **connection_params)
+
+
+class MemoryStorage(BaseStorage):
+    """
+    Storage that keeps everything in the memory of the current process. It
+    is safe to use from multiple threads or greenlets, but cannot be shared
+    between processes, and nothing survives a restart.
+    """
+    def __init__(self, name='huey', blocking=False, read_timeout=1,
+                 max_errors=1000, max_events=1000, **storage_kwargs):
+        super(MemoryStorage, self).__init__(name, **storage_kwargs)
+        self.blocking = blocking
+        self.read_timeout = read_timeout
+        self.max_errors = max_errors
+        self.max_events = max_events
+
+        # A single condition guards all state. It is notified whenever a
+        # message is enqueued or a value is stored, waking blocked readers.
+        self._lock = threading.Condition()
+
+        # One deque per priority. Messages are added on the left and taken
+        # from the right, as with the lists used by RedisStorage.
+        self._queues = {}
+        self._queue_size = 0
+
+        # Heap of (timestamp, sequence, data, priority).
+        self._schedule = []
+        self._sequence = itertools.count()
+
+        self._results = {}
+        self._errors = deque(maxlen=max_errors)
+        self._task_errors = {}
+        # Listeners are held weakly, so a queue that is no longer referenced
+        # stops receiving events without being explicitly closed.
+        self._subscribers = weakref.WeakSet()
+
+    def _priorities(self):
+        return sorted(self._queues, reverse=True)
+
+    def _queue_for(self, priority):
+        queue = self._queues.get(priority)
+        if queue is None:
+            queue = self._queues[priority] = deque()
+        return queue
+
+    def _push(self, data, priority):
+        self._queue_for(priority).extendleft(data)
+        self._queue_size += len(data)
+        self._lock.notify_all()
+
+    def _pop(self, n):
+        accum = []
+        for priority in self._priorities():
+            queue = self._queues[priority]
+            while queue and len(accum) < n:
+                accum.append(queue.pop())
+            if len(accum) == n:
+                break
+        self._queue_size -= len(accum)
+        return accum
+
+    def enqueue(self, data, priority=0):
+        with self._lock:
+            self._push([data], priority)
+
+    def enqueue_many(self, data, priority=0):
+        with self._lock:
+            self._push(data, priority)
+
+    def dequeue(self):
+        messages = self.dequeue_many(1)
+        if messages:
+            return messages[0]
+
+    def dequeue_many(self, n):
+        with self._lock:
+            if self.blocking:
+                # The condition is also notified when a result is stored, so
+                # keep waiting until a message arrives or the timeout is up.
+                deadline = time.time() + self.read_timeout
+                while not self._queue_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._lock.wait(remaining)
+            return self._pop(n)
+
+    def requeue(self, data, priority=0):
+        # Return the messages to the end that is read from, keeping their
+        # order, so they are the next to be dequeued.
+        with self._lock:
+            self._queue_for(priority).extend(reversed(data))
+            self._queue_size += len(data)
+            self._lock.notify_all()
+
+    def unqueue(self, data):
+        n = 0
+        with self._lock:
+            for queue in self._queues.values():
+                while data in queue:
+                    queue.remove(data)
+                    n += 1
+            self._queue_size -= n
+        return n
+
+    def queue_size(self):
+        return self._queue_size
+
+    def enqueued_items(self, limit=None):
+        with self._lock:
+            accum = []
+            for priority in self._priorities():
+                accum.extend(self._queues[priority])
+        return accum if limit is None else accum[:limit]
+
+    def flush_queue(self):
+        with self._lock:
+            self._queues = {}
+            self._queue_size = 0
+
+    def add_to_schedule(self, data, ts, priority=0):
+        with self._lock:
+            heapq.heappush(self._schedule,
+                           (ts, next(self._sequence), data, priority))
+
+    def _pop_schedule(self, ts, limit):
+        accum = []
+        while self._schedule and self._schedule[0][0] <= ts:
+            if limit and len(accum) == limit:
+                break
+            accum.append(heapq.heappop(self._schedule))
+        return accum
+
+    def read_schedule(self, ts, limit=None):
+        with self._lock:
+            return [item[2] for item in self._pop_schedule(ts, limit)]
+
+    def promote_schedule(self, ts, limit=None):
+        with self._lock:
+            items = self._pop_schedule(ts, limit)
+            for _, _, data, priority in items:
+                self._push([data], priority)
+        return len(items)
+
+    def schedule_size(self):
+        return len(self._schedule)
+
+    def scheduled_items(self, limit=None):
+        with self._lock:
+            items = sorted(self._schedule)
+        return [item[2] for item in items[:limit]]
+
+    def flush_schedule(self):
+        with self._lock:
+            self._schedule = []
+
+    def put_data(self, key, value):
+        with self._lock:
+            self._results[key] = value
+            self._lock.notify_all()
+
+    def wait_for_data(self, key, timeout=None):
+        with self._lock:
+            if key not in self._results:
+                self._lock.wait(timeout)
+        return True
+
+    def peek_data(self, key):
+        return self._results.get(key, EmptyData)
+
+    def pop_data(self, key):
+        with self._lock:
+            return self._results.pop(key, EmptyData)
+
+    def get_data_many(self, keys, peek=False):
+        with self._lock:
+            if peek:
+                return [self._results.get(key, EmptyData) for key in keys]
+            return [self._results.pop(key, EmptyData) for key in keys]
+
+    def has_data_for_key(self, key):
+        return key in self._results
+
+    def result_store_size(self):
+        return len(self._results)
+
+    def result_items(self):
+        with self._lock:
+            return dict(self._results)
+
+    def flush_results(self):
+        with self._lock:
+            self._results = {}
+
+    def put_error(self, metadata, task_name=None):
+        with self._lock:
+            self._errors.appendleft(metadata)
+            if task_name is not None:
+                errors = self._task_errors.get(task_name)
+                if errors is None:
+                    errors = deque(maxlen=self.max_errors)
+                    self._task_errors[task_name] = errors
+                errors.appendleft(metadata)
+
+    def get_errors(self, limit=None, offset=0, task_name=None):
+        with self._lock:
+            if task_name is None:
+                errors = list(self._errors)
+            else:
+                errors = list(self._task_errors.get(task_name, ()))
+        if limit is None:
+            return errors[offset:]
+        return errors[offset:offset + limit]
+
+    def flush_errors(self):
+        with self._lock:
+            self._errors.clear()
+            self._task_errors = {}
+
+    def emit(self, message):
+        with self._lock:
+            for subscriber in self._subscribers:
+                try:
+                    subscriber.put_nowait(message)
+                except Full:
+                    # The listener has fallen behind, drop the event rather
+                    # than let its queue grow without bound.
+                    pass
+
+    def listener(self):
+        # Events are delivered to a queue for each listener. Events emitted
+        # while nobody is listening are discarded.
+        queue = Queue(self.max_events or 0)
+        with self._lock:
+            self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        with self._lock:
+            self._subscribers.discard(queue)
+
+    def __iter__(self):
+        return _MemoryEventIterator(self, self.listener())
+
+
+class _MemoryEventIterator(object):
+    def __init__(self, storage, queue):
+        self.storage = storage
+        self.queue = queue
+
+    def next(self):
+        return json.loads(self.queue.get())
+
+    __next__ = next
+
+    def close(self):
+        self.storage.unsubscribe(self.queue)
+
+    def __del__(self):
+        self.close()
+
+
+class MemoryHuey(Huey):
+    def get_storage(self, read_timeout=1, max_errors=1000, max_events=1000,
+                    **kwargs):
+        return MemoryStorage(
+            name=self.name,
+            blocking=self.blocking,
+            read_timeout=read_timeout,
+            max_errors=max_errors,
+            max_events=max_events,
+            **kwargs)
+
+
+def to_bytes(value):
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    return value
+
+
+def to_blob(value):
+    return sqlite3.Binary(to_bytes(value))
+
+
+class SqliteStorage(BaseStorage):
+    """
+    Storage backed by a SQLite database file, for durable queues on hosts
+    without a Redis server. Several huey instances may share one database,
+    as every row is tagged with the instance's name.
+
+    The database is opened in WAL mode, so readers are not blocked by the
+    writer, and each thread uses its own connection. A burst of writes can be
+    made in a single transaction (and so a single sync to disk) by wrapping
+    them in :py:meth:`batch`.
+    """
+    def __init__(self, name='huey', filename='huey.db', blocking=False,
+                 read_timeout=1, poll_interval=0.1, max_errors=1000,
+                 timeout=5, **storage_kwargs):
+        super(SqliteStorage, self).__init__(name, **storage_kwargs)
+        self.filename = filename
+        self.blocking = blocking
+        self.read_timeout = read_timeout
+        self.poll_interval = poll_interval
+        self.max_errors = max_errors
+        self.timeout = timeout
+        self._local = threading.local()
+        self.create_tables()
+
+    @property
+    def conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Transactions are managed explicitly, see _transaction().
+            conn = sqlite3.connect(self.filename, timeout=self.timeout,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=wal')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.depth = 0
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        # Nested uses join the outermost transaction. BEGIN IMMEDIATE takes
+        # the write lock up front, so that a read followed by a delete (as
+        # when claiming messages) cannot race with another writer.
+        conn = self.conn
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield conn
+            finally:
+                self._local.depth -= 1
+            return
+
+        conn.execute('BEGIN IMMEDIATE')
+        self._local.depth = 1
+        try:
+            yield conn
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        else:
+            conn.execute('COMMIT')
+        finally:
+            self._local.depth = 0
+
+    def batch(self):
+        """
+        Context manager which groups all writes made within it by the
+        current thread into a single transaction.
+        """
+        return self._transaction()
+
+    def after_fork(self):
+        # A SQLite connection must not be used in more than one process.
+        self._local = threading.local()
+
+    def create_tables(self):
+        with self._transaction() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS task ('
+                'id INTEGER PRIMARY KEY, queue TEXT NOT NULL, '
+                'data BLOB NOT NULL, priority INTEGER NOT NULL DEFAULT 0)')
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS task_priority_id '
+                'ON task (queue, priority DESC, id)')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS schedule ('
+                'id INTEGER PRIMARY KEY, queue TEXT NOT NULL, '
+                'data BLOB NOT NULL, timestamp REAL NOT NULL, '
+                'priority INTEGER NOT NULL DEFAULT 0)')
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS schedule_timestamp '
+                'ON schedule (queue, timestamp, id)')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS kv ('
+                'queue TEXT NOT NULL, key TEXT NOT NULL, '
+                'value BLOB NOT NULL, PRIMARY KEY (queue, key))')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS error ('
+                'id INTEGER PRIMARY KEY, queue TEXT NOT NULL, '
+                'task_name TEXT, data BLOB NOT NULL)')
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS error_id ON error (queue, id)')
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS error_task_name_id '
+                'ON error (queue, task_name, id)')
+
+    def convert_ts(self, ts):
+        return time.mktime(ts.timetuple())
+
+    def enqueue(self, data, priority=0):
+        self.enqueue_many([data], priority)
+
+    def enqueue_many(self, data, priority=0):
+        with self._transaction() as conn:
+            conn.executemany(
+                'INSERT INTO task (queue, data, priority) VALUES (?, ?, ?)',
+                [(self.name, to_blob(message), priority)
+                 for message in data])
+
+    def _claim(self, n):
+        # Select and delete the next messages in one transaction.
+        with self._transaction() as conn:
+            rows = conn.execute(
+                'SELECT id, data FROM task WHERE queue = ? '
+                'ORDER BY priority DESC, id LIMIT ?',
+                (self.name, n)).fetchall()
+            if rows:
+                self._delete_ids(conn, 'task', [row[0] for row in rows])
+        return [bytes(row[1]) for row in rows]
+
+    def _delete_ids(self, conn, table, ids):
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            conn.execute('DELETE FROM %s WHERE id IN (%s)' %
+                         (table, ','.join('?' * len(chunk))), chunk)
+
+    def dequeue(self):
+        messages = self.dequeue_many(1)
+        if messages:
+            return messages[0]
+
+    def dequeue_many(self, n):
+        messages = self._claim(n)
+        if messages or not self.blocking:
+            return messages
+
+        # SQLite cannot notify readers of new rows, so poll until a message
+        # arrives or the read timeout elapses.
+        deadline = time.time() + self.read_timeout
+        while not messages and time.time() < deadline:
+            time.sleep(self.poll_interval)
+            messages = self._claim(n)
+        return messages
+
+    def requeue(self, data, priority=0):
+        # Give the messages IDs lower than any in the queue, keeping their
+        # order, so that they are the next to be dequeued.
+        if not data:
+            return
+        with self._transaction() as conn:
+            first, = conn.execute('SELECT MIN(id) FROM task').fetchone()
+            first = first or 0
+            conn.executemany(
+                'INSERT INTO task (id, queue, data, priority) '
+                'VALUES (?, ?, ?, ?)',
+                [(first - len(data) + i, self.name, to_blob(message),
+                  priority)
+                 for i, message in enumerate(data)])
+
+    def unqueue(self, data):
+        with self._transaction() as conn:
+            return conn.execute(
+                'DELETE FROM task WHERE queue = ? AND data = ?',
+                (self.name, to_blob(data))).rowcount
+
+    def queue_size(self):
+        return self.conn.execute('SELECT COUNT(*) FROM task WHERE queue = ?',
+                                 (self.name,)).fetchone()[0]
+
+    def enqueued_items(self, limit=None):
+        # Ordered to match RedisStorage: highest priority first, and most
+        # recently enqueued first within a priority.
+        cursor = self.conn.execute(
+            'SELECT data FROM task WHERE queue = ? '
+            'ORDER BY priority DESC, id DESC LIMIT ?',
+            (self.name, -1 if limit is None else limit))
+        return [bytes(row[0]) for row in cursor]
+
+    def flush_queue(self):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM task WHERE queue = ?', (self.name,))
+
+    def add_to_schedule(self, data, ts, priority=0):
+        with self._transaction() as conn:
+            conn.execute(
+                'INSERT INTO schedule (queue, data, timestamp, priority) '
+                'VALUES (?, ?, ?, ?)',
+                (self.name, to_blob(data), self.convert_ts(ts), priority))
+
+    def _claim_schedule(self, conn, ts, limit):
+        rows = conn.execute(
+            'SELECT id, data, priority FROM schedule '
+            'WHERE queue = ? AND timestamp <= ? '
+            'ORDER BY timestamp, id LIMIT ?',
+            (self.name, self.convert_ts(ts), limit or -1)).fetchall()
+        if rows:
+            self._delete_ids(conn, 'schedule', [row[0] for row in rows])
+        return rows
+
+    def read_schedule(self, ts, limit=None):
+        with self._transaction() as conn:
+            rows = self._claim_schedule(conn, ts, limit)
+        return [bytes(row[1]) for row in rows]
+
+    def promote_schedule(self, ts, limit=None):
+        with self._transaction() as conn:
+            rows = self._claim_schedule(conn, ts, limit)
+            conn.executemany(
+                'INSERT INTO task (queue, data, priority) VALUES (?, ?, ?)',
+                [(self.name, data, priority) for _, data, priority in rows])
+        return len(rows)
+
+    def schedule_size(self):
+        return self.conn.execute(
+            'SELECT COUNT(*) FROM schedule WHERE queue = ?',
+            (self.name,)).fetchone()[0]
+
+    def scheduled_items(self, limit=None):
+        cursor = self.conn.execute(
+            'SELECT data FROM schedule WHERE queue = ? '
+            'ORDER BY timestamp, id LIMIT ?',
+            (self.name, -1 if limit is None else limit))
+        return [bytes(row[0]) for row in cursor]
+
+    def flush_schedule(self):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM schedule WHERE queue = ?',
+                         (self.name,))
+
+    def put_data(self, key, value):
+        with self._transaction() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO kv (queue, key, value) '
+                'VALUES (?, ?, ?)',
+                (self.name, key, to_blob(value)))
+
+    def peek_data(self, key):
+        row = self.conn.execute(
+            'SELECT value FROM kv WHERE queue = ? AND key = ?',
+            (self.name, key)).fetchone()
+        return EmptyData if row is None else bytes(row[0])
+
+    def pop_data(self, key):
+        with self._transaction() as conn:
+            value = self.peek_data(key)
+            if value is not EmptyData:
+                conn.execute('DELETE FROM kv WHERE queue = ? AND key = ?',
+                             (self.name, key))
+        return value
+
+    def get_data_many(self, keys, peek=False):
+        values = {}
+        with self._transaction() as conn:
+            for i in range(0, len(keys), 500):
+                chunk = list(keys[i:i + 500])
+                where = 'queue = ? AND key IN (%s)' % (
+                    ','.join('?' * len(chunk)))
+                values.update(conn.execute(
+                    'SELECT key, value FROM kv WHERE ' + where,
+                    [self.name] + chunk))
+                if not peek:
+                    conn.execute('DELETE FROM kv WHERE ' + where,
+                                 [self.name] + chunk)
+        return [bytes(values[key]) if key in values else EmptyData
+                for key in keys]
+
+    def has_data_for_key(self, key):
+        return self.peek_data(key) is not EmptyData
+
+    def result_store_size(self):
+        return self.conn.execute('SELECT COUNT(*) FROM kv WHERE queue = ?',
+                                 (self.name,)).fetchone()[0]
+
+    def result_items(self):
+        cursor = self.conn.execute(
+            'SELECT key, value FROM kv WHERE queue = ?', (self.name,))
+        return dict((key, bytes(value)) for key, value in cursor)
+
+    def flush_results(self):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM kv WHERE queue = ?', (self.name,))
+
+    def put_error(self, metadata, task_name=None):
+        self.put_errors([metadata], [task_name] if task_name else None)
+
+    def put_errors(self, metadata_list, task_names=None):
+        task_names = task_names or [None] * len(metadata_list)
+        with self._transaction() as conn:
+            conn.executemany(
+                'INSERT INTO error (queue, task_name, data) VALUES (?, ?, ?)',
+                [(self.name, name, to_blob(metadata))
+                 for metadata, name in zip(metadata_list, task_names)])
+            # Keep only the most recent max_errors errors.
+            conn.execute(
+                'DELETE FROM error WHERE queue = ? AND id <= ('
+                'SELECT id FROM error WHERE queue = ? '
+                'ORDER BY id DESC LIMIT 1 OFFSET ?)',
+                (self.name, self.name, self.max_errors))
+
+    def get_errors(self, limit=None, offset=0, task_name=None):
+        query = 'SELECT data FROM error WHERE queue = ?'
+        params = [self.name]
+        if task_name is not None:
+            query += ' AND task_name = ?'
+            params.append(task_name)
+        query += ' ORDER BY id DESC LIMIT ? OFFSET ?'
+        params.extend((-1 if limit is None else limit, offset))
+        return [bytes(row[0]) for row in self.conn.execute(query, params)]
+
+    def flush_errors(self):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM error WHERE queue = ?', (self.name,))
+
+    def emit(self, message):
+        # SQLite has no means of publishing events, so they are discarded.
+        pass
+
+
+class SqliteHuey(Huey):
+    def get_storage(self, filename='huey.db', read_timeout=1,
+                    poll_interval=0.1, max_errors=1000, **kwargs):
+        return SqliteStorage(
+            name=self.name,
+            filename=filename,
+            blocking=self.blocking,
+            read_timeout=read_timeout,
+            poll_interval=poll_interval,
+            max_errors=max_errors,
+            **kwargs)
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
+if hasattr(os, 'pread'):
+    _pread = os.pread
+
+    def _pwrite(fd, data, offset):
+        while data:
+            n = os.pwrite(fd, data, offset)
+            data, offset = data[n:], offset + n
+else:
+    def _pread(fd, n, offset):
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, n)
+
+    def _pwrite(fd, data, offset):
+        os.lseek(fd, offset, os.SEEK_SET)
+        while data:
+            data = data[os.write(fd, data):]
+
+
+class _SegmentedLog(object):
+    """
+    Append-only log of records, split into numbered segment files. Each
+    record is prefixed with its length and CRC32. A small metadata file
+    records the position of the next unread record, the end of the last
+    record written and the number of unread records.
+
+    The metadata is written after the records it refers to, in a single
+    write, so a record whose write was interrupted is never read and the
+    count always matches the records. Should records be damaged regardless,
+    as may happen if the host crashes while ``fsync`` is off, the rest of the
+    segment from the first record that fails its checksum is skipped.
+    Segments are deleted once every record in them has been read.
+
+    The log does no locking of its own; callers must hold the storage lock.
+    File descriptors and the memory map of the segment being read are kept
+    open between calls, so a log must not be used by a process other than
+    the one that created it.
+    """
+    meta = struct.Struct('>QQQQQ')  # read segment, read position, write
+                                    # segment, write position, unread
+                                    # record count.
+    header = struct.Struct('>II')  # record length, CRC32.
+
+    def __init__(self, path, segment_size, fsync=False):
+        self.path = path
+        self.segment_size = segment_size
+        self.fsync = fsync
+        _makedirs(path)
+        self._meta_fd = os.open(os.path.join(path, 'meta'),
+                                os.O_RDWR | os.O_CREAT, 0o644)
+        self._write_segment = None
+        self._write_fd = None
+        self._map_segment = None
+        self._map = None
+
+    def close(self):
+        os.close(self._meta_fd)
+        self._close_segment()
+        self._unmap()
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, '%016d.log' % segment)
+
+    def _load(self):
+        data = _pread(self._meta_fd, self.meta.size, 0)
+        if len(data) < self.meta.size:
+            return [0, 0, 0, 0, 0]
+        return list(self.meta.unpack(data))
+
+    def _save(self, meta):
+        # The metadata is small enough to be written with a single write()
+        # to the start of the file.
+        _pwrite(self._meta_fd, self.meta.pack(*meta), 0)
+        if self.fsync:
+            os.fsync(self._meta_fd)
+
+    def __len__(self):
+        return self._load()[4]
+
+    def _close_segment(self):
+        if self._write_fd is not None:
+            os.close(self._write_fd)
+        self._write_fd = self._write_segment = None
+
+    def _open_segment(self, segment):
+        if segment != self._write_segment:
+            self._close_segment()
+            fd = os.open(self._segment_path(segment),
+                         os.O_WRONLY | os.O_CREAT, 0o644)
+            # Segments are extended to their full size up front, so that a
+            # reader can map a segment once while it is being written.
+            if os.fstat(fd).st_size < self.segment_size:
+                os.ftruncate(fd, self.segment_size)
+            self._write_fd, self._write_segment = fd, segment
+        return self._write_fd
+
+    def append(self, records):
+        if not records:
+            return
+        meta = self._load()
+        buf = b''.join(
+            self.header.pack(len(record), binascii.crc32(record) & 0xffffffff)
+            + record for record in records)
+        segment, pos = meta[2], meta[3]
+        if pos and pos + len(buf) > self.segment_size:
+            # A segment that is finished is cut to the end of its last
+            # record, which is where its readers stop.
+            os.ftruncate(self._open_segment(segment), pos)
+            segment, pos = segment + 1, 0
+        fd = self._open_segment(segment)
+        _pwrite(fd, buf, pos)
+        if self.fsync:
+            os.fsync(fd)
+        meta[2], meta[3] = segment, pos + len(buf)
+        meta[4] += len(records)
+        self._save(meta)
+
+    def _unmap(self):
+        if self._map is not None:
+            self._map.close()
+        self._map = self._map_segment = None
+
+    def _segment_map(self, segment):
+        # Return a memory map of the segment, reusing the map made by the
+        # previous call while the segment keeps its size. A segment is cut
+        # short once it has been written, possibly by another instance, and
+        # a map of its old size would read zeroes or fault past the new end.
+        try:
+            size = os.stat(self._segment_path(segment)).st_size
+        except OSError:
+            return None
+        if segment != self._map_segment or size != len(self._map):
+            self._unmap()
+            if not size:
+                return None
+            with open(self._segment_path(segment), 'rb') as fh:
+                self._map = mmap.mmap(fh.fileno(), size,
+                                      access=mmap.ACCESS_READ)
+            self._map_segment = segment
+        return self._map
+
+    def _read_segment(self, segment, pos, end, n):
+        # Parse up to n records from a segment, starting at pos and stopping
+        # at end, or at the end of the file when end is None. Returns the
+        # records and the position following the last one.
+        mm = self._segment_map(segment)
+        if mm is None:
+            return [], pos
+        if end is None:
+            end = len(mm)
+        accum = []
+        while pos < end and (n is None or len(accum) < n):
+            start = pos + self.header.size
+            if start > end:
+                return accum, end
+            length, crc = self.header.unpack(mm[pos:start])
+            record = mm[start:start + length]
+            if (not length or start + length > end or
+                    binascii.crc32(record) & 0xffffffff != crc):
+                # The record is damaged, and those following it cannot be
+                # located, so the rest of the segment is skipped. Records are
+                # never empty, and zeroes would otherwise pass the checksum.
+                return accum, end
+            accum.append(record)
+            pos = start + length
+        return accum, pos
+
+    def read(self, n=None, consume=True):
+        meta = self._load()
+        if consume and not meta[4]:
+            return []
+        segment, pos = meta[0], meta[1]
+        accum = []
+        while n is None or len(accum) < n:
+            end = meta[3] if segment == meta[2] else None
+            records, pos = self._read_segment(
+                segment, pos, end, None if n is None else n - len(accum))
+            accum.extend(records)
+            if segment >= meta[2]:
+                break
+            if n is None or len(accum) < n:
+                # The segment is exhausted, so move on to the next one.
+                if consume:
+                    if segment == self._map_segment:
+                        self._unmap()
+                    os.unlink(self._segment_path(segment))
+                segment, pos = segment + 1, 0
+        if consume and (accum or segment != meta[0]):
+            meta[0], meta[1] = segment, pos
+            if segment == meta[2] and pos >= meta[3]:
+                # Everything written has been read, including any records
+                # that were skipped.
+                meta[4] = 0
+            else:
+                meta[4] -= len(accum)
+            self._save(meta)
+        return accum
+
+    def rewrite(self, records):
+        # Replace the unread records, discarding all existing segments.
+        self.clear()
+        self.append(records)
+
+    def clear(self):
+        meta = self._load()
+        self._close_segment()
+        self._unmap()
+        for filename in os.listdir(self.path):
+            if filename.endswith('.log'):
+                os.unlink(os.path.join(self.path, filename))
+        self._save([meta[2] + 1, 0, meta[2] + 1, 0, 0])
+
+
+class FileStorage(BaseStorage):
+    """
+    Storage that keeps its data in a directory on the local filesystem, for
+    durable, serverless queues on a single host.
+
+    Each priority of the queue is a segmented append-only log: enqueueing
+    appends to the last segment, dequeueing advances a persisted read offset
+    and segments are deleted once fully read. The schedule and result store
+    use a file per entry. All operations take an exclusive ``flock()`` on a
+    lock file, so the storage may be shared by several consumer processes.
+    """
+    def __init__(self, name='huey', path='huey-data', blocking=False,
+                 read_timeout=1, poll_interval=0.1, max_errors=1000,
+                 segment_size=64 * 1024 * 1024, fsync=False,
+                 **storage_kwargs):
+        super(FileStorage, self).__init__(name, **storage_kwargs)
+        self.path = os.path.join(path, self.clean_name(name))
+        self.blocking = blocking
+        self.read_timeout = read_timeout
+        self.poll_interval = poll_interval
+        self.max_errors = max_errors
+        self.segment_size = segment_size
+        self.fsync = fsync
+
+        self.queue_path = os.path.join(self.path, 'queue')
+        self.schedule_path = os.path.join(self.path, 'schedule')
+        self.result_path = os.path.join(self.path, 'results')
+        for path in (self.queue_path, self.schedule_path, self.result_path):
+            _makedirs(path)
+
+        # flock() does not exclude threads sharing a file descriptor, so a
+        # thread lock is held as well. The lock may be taken again by the
+        # thread holding it, the file lock being released only when the
+        # outermost holder is done.
+        self._thread_lock = threading.RLock()
+        self._lock_depth = 0
+        self._open()
+
+    def _open(self):
+        # Open the lock file and logs for the current process. Descriptors
+        # inherited across a fork share their lock and file offsets with the
+        # parent, so they are reopened by the child.
+        self._pid = os.getpid()
+        self._lock_file = open(os.path.join(self.path, 'lock'), 'a')
+        self._queue_logs = {}
+        self.errors = _SegmentedLog(os.path.join(self.path, 'errors'),
+                                    self.segment_size, self.fsync)
+
+    def clean_name(self, name):
+        return re.sub('[^a-z0-9]', '', name)
+
+    def convert_ts(self, ts):
+        return time.mktime(ts.timetuple())
+
+    @contextmanager
+    def _lock(self):
+        with self._thread_lock:
+            if not self._lock_depth:
+                if self._pid != os.getpid():
+                    self._open()
+                if fcntl is not None:
+                    fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if not self._lock_depth and fcntl is not None:
+                    fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _logs(self, priority):
+        # Messages returned with requeue() are kept in a separate log which
+        # is read before the main one.
+        logs = self._queue_logs.get(priority)
+        if logs is None:
+            path = os.path.join(self.queue_path, str(priority))
+            logs = self._queue_logs[priority] = (
+                _SegmentedLog(os.path.join(path, 'requeued'),
+                              self.segment_size, self.fsync),
+                _SegmentedLog(os.path.join(path, 'queue'),
+                              self.segment_size, self.fsync))
+        return logs
+
+    def _priorities(self):
+        return sorted((int(p) for p in os.listdir(self.queue_path)),
+                      reverse=True)
+
+    def enqueue(self, data, priority=0):
+        self.enqueue_many([data], priority)
+
+    def enqueue_many(self, data, priority=0):
+        with self._lock():
+            self._logs(priority)[1].append([to_bytes(m) for m in data])
+
+    def _claim(self, n):
+        accum = []
+        with self._lock():
+            for priority in self._priorities():
+                for log in self._logs(priority):
+                    accum.extend(log.read(n - len(accum)))
+                    if len(accum) == n:
+                        return accum
+        return accum
+
+    def dequeue(self):
+        messages = self.dequeue_many(1)
+        if messages:
+            return messages[0]
+
+    def dequeue_many(self, n):
+        messages = self._claim(n)
+        if messages or not self.blocking:
+            return messages
+
+        deadline = time.time() + self.read_timeout
+        while not messages and time.time() < deadline:
+            time.sleep(self.poll_interval)
+            messages = self._claim(n)
+        return messages
+
+    def requeue(self, data, priority=0):
+        with self._lock():
+            self._logs(priority)[0].append([to_bytes(m) for m in data])
+
+    def unqueue(self, data):
+        data = to_bytes(data)
+        n = 0
+        with self._lock():
+            for priority in self._priorities():
+                for log in self._logs(priority):
+                    records = log.read(consume=False)
+                    remaining = [r for r in records if r != data]
+                    if len(remaining) != len(records):
+                        n += len(records) - len(remaining)
+                        log.rewrite(remaining)
+        return n
+
+    def queue_size(self):
+        with self._lock():
+            return sum(len(log) for priority in self._priorities()
+                       for log in self._logs(priority))
+
+    def enqueued_items(self, limit=None):
+        # Ordered to match RedisStorage: highest priority first, and most
+        # recently enqueued first within a priority.
+        accum = []
+        with self._lock():
+            for priority in self._priorities():
+                requeued, queue = self._logs(priority)
+                accum.extend(reversed(queue.read(consume=False)))
+                accum.extend(reversed(requeued.read(consume=False)))
+        return accum if limit is None else accum[:limit]
+
+    def flush_queue(self):
+        # The logs are emptied rather than removed, as other processes may
+        # have them open.
+        with self._lock():
+            for priority in self._priorities():
+                for log in self._logs(priority):
+                    log.clear()
+
+    def _write_file(self, path, data):
+        tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+        with open(tmp_path, 'wb') as fh:
+            fh.write(to_bytes(data))
+            if self.fsync:
+                fh.flush()
+                os.fsync(fh.fileno())
+        os.rename(tmp_path, path)
+
+    def _read_file(self, path):
+        with open(path, 'rb') as fh:
+            return fh.read()
+
+    def add_to_schedule(self, data, ts, priority=0):
+        # Entries are named so that sorting the filenames sorts the entries
+        # by timestamp.
+        filename = '%020.6f_%s_%d' % (max(self.convert_ts(ts), 0),
+                                      uuid.uuid4().hex, priority)
+        with self._lock():
+            self._write_file(os.path.join(self.schedule_path, filename), data)
+
+    def _schedule_entries(self):
+        return sorted(f for f in os.listdir(self.schedule_path)
+                      if not f.endswith('.tmp'))
+
+    def _claim_schedule(self, ts, limit):
+        unix_ts = self.convert_ts(ts)
+        accum = []
+        for filename in self._schedule_entries():
+            if float(filename.split('_', 1)[0]) > unix_ts:
+                break
+            if limit and len(accum) == limit:
+                break
+            path = os.path.join(self.schedule_path, filename)
+            accum.append((self._read_file(path),
+                          int(filename.rsplit('_', 1)[1])))
+            os.unlink(path)
+        return accum
+
+    def read_schedule(self, ts, limit=None):
+        with self._lock():
+            return [data for data, _ in self._claim_schedule(ts, limit)]
+
+    def promote_schedule(self, ts, limit=None):
+        with self._lock():
+            entries = self._claim_schedule(ts, limit)
+            for data, priority in entries:
+                self._logs(priority)[1].append([data])
+        return len(entries)
+
+    def schedule_size(self):
+        return len(self._schedule_entries())
+
+    def scheduled_items(self, limit=None):
+        with self._lock():
+            return [self._read_file(os.path.join(self.schedule_path, f))
+                    for f in self._schedule_entries()[:limit]]
+
+    def flush_schedule(self):
+        with self._lock():
+            shutil.rmtree(self.schedule_path)
+            _makedirs(self.schedule_path)
+
+    def _result_file(self, key):
+        # Keys are hex-encoded so that any key is a valid filename.
+        return os.path.join(self.result_path, binascii.hexlify(
+            to_bytes(key)).decode('ascii'))
+
+    def put_data(self, key, value):
+        with self._lock():
+            self._write_file(self._result_file(key), value)
+
+    def peek_data(self, key):
+        try:
+            return self._read_file(self._result_file(key))
+        except IOError:
+            return EmptyData
+
+    def pop_data(self, key):
+        with self._lock():
+            value = self.peek_data(key)
+            if value is not EmptyData:
+                os.unlink(self._result_file(key))
+        return value
+
+    def get_data_many(self, keys, peek=False):
+        if peek:
+            return [self.peek_data(key) for key in keys]
+        with self._lock():
+            return [self.pop_data(key) for key in keys]
+
+    def has_data_for_key(self, key):
+        return os.path.exists(self._result_file(key))
+
+    def _result_keys(self):
+        return [f for f in os.listdir(self.result_path)
+                if not f.endswith('.tmp')]
+
+    def result_store_size(self):
+        return len(self._result_keys())
+
+    def result_items(self):
+        accum = {}
+        with self._lock():
+            for filename in self._result_keys():
+                key = binascii.unhexlify(filename).decode('utf-8')
+                accum[key] = self._read_file(
+                    os.path.join(self.result_path, filename))
+        return accum
+
+    def flush_results(self):
+        with self._lock():
+            shutil.rmtree(self.result_path)
+            _makedirs(self.result_path)
+
+    def put_error(self, metadata, task_name=None):
+        self.put_errors([metadata], [task_name] if task_name else None)
+
+    def put_errors(self, metadata_list, task_names=None):
+        # The task name is stored in front of the error, separated by a NUL.
+        task_names = task_names or [None] * len(metadata_list)
+        with self._lock():
+            self.errors.append([
+                to_bytes(name or '') + b'\x00' + to_bytes(metadata)
+                for metadata, name in zip(metadata_list, task_names)])
+            excess = len(self.errors) - self.max_errors
+            if excess > 0:
+                self.errors.read(excess)
+
+    def get_errors(self, limit=None, offset=0, task_name=None):
+        with self._lock():
+            records = self.errors.read(consume=False)
+        accum = []
+        for record in reversed(records):
+            name, metadata = record.split(b'\x00', 1)
+            if task_name is None or name == to_bytes(task_name):
+                accum.append(metadata)
+        if limit is None:
+            return accum[offset:]
+        return accum[offset:offset + limit]
+
+    def flush_errors(self):
+        with self._lock():
+            self.errors.clear()
+
+    def emit(self, message):
+        # There is no means of publishing events, so they are discarded.
+        pass
+
+
+class FileHuey(Huey):
+    def get_storage(self, path='huey-data', read_timeout=1,
+                    poll_interval=0.1, max_errors=1000,
+                    segment_size=64 * 1024 * 1024, fsync=False, **kwargs):
+        return FileStorage(
+            name=self.name,
+            path=path,
+            blocking=self.blocking,
+            read_timeout=read_timeout,
+            poll_interval=poll_interval,
+            max_errors=max_errors,
+            segment_size=segment_size,
+            fsync=fsync,
+            **kwargs)
+
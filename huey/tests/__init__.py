@@ -1,7 +1,13 @@
+import sys
+
 from huey.tests.test_consumer import *
 from huey.tests.test_crontab import *
 from huey.tests.test_queue import *
 from huey.tests.test_registry import *
+from huey.tests.test_serializer import *
 from huey.tests.test_storage import *
 from huey.tests.test_utils import *
 from huey.tests.test_wrapper import *
+
+if sys.version_info >= (3, 6):
+    from huey.tests.test_asyncio import *
@@ -0,0 +1,216 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from huey import MemoryHuey
+from huey import RedisHuey
+from huey.consumer import Consumer
+from huey.contrib.asyncio import AsyncioEnvironment
+from huey.contrib.asyncio import AsyncRedisHuey
+from huey.contrib.asyncio import AsyncRedisStorage
+from huey.contrib.asyncio import AsyncWorker
+from huey.contrib.asyncio import aioredis
+from huey.exceptions import DataStoreTimeout
+from huey.tests.base import BaseTestCase
+
+
+def multiply(a, b):
+    return a * b
+
+
+@unittest.skipIf(aioredis is None, 'requires redis-py 4.2 or newer')
+class TestAsyncRedisHuey(BaseTestCase):
+    @classmethod
+    def setUpClass(cls):
+        # Created here rather than on import, as the asyncio Redis client is
+        # not available with older versions of redis-py.
+        cls.huey = AsyncRedisHuey('testing-async', blocking=False)
+        cls.huey_notify = AsyncRedisHuey('testing-async', blocking=False,
+                                         notify_results=True)
+        cls.huey_sync = RedisHuey('testing-async', blocking=False)
+        cls.multiply = staticmethod(
+            cls.huey.task(name='async_multiply')(multiply))
+        cls.multiply_priority = staticmethod(cls.huey.task(
+            name='async_multiply_priority', priority=5)(multiply))
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.huey.flush()
+
+    def tearDown(self):
+        self.huey.flush()
+        for h in (self.huey, self.huey_notify):
+            self._run_coro(h.aclose())
+        self.loop.close()
+
+    def _run_coro(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_connection_params(self):
+        huey = RedisHuey('testing-async', blocking=False, db=0,
+                         socket_timeout=5)
+        storage = AsyncRedisStorage(huey.storage)
+        kwargs = storage.conn.connection_pool.connection_kwargs
+        self.assertEqual(kwargs['db'], 0)
+        self.assertEqual(kwargs['socket_timeout'], 5)
+        self.assertEqual(self._run_coro(storage.conn.ping()), True)
+        self._run_coro(storage.close())
+
+    def test_aenqueue(self):
+        huey, huey_sync = self.huey, self.huey_sync
+        res = self._run_coro(self.multiply.aenqueue(3, 4))
+        self.assertEqual(len(huey), 1)
+        self.assertEqual(self._run_coro(res.aget(blocking=False)), None)
+
+        # The message is read by the synchronous API, as by the consumer.
+        task = huey_sync.dequeue()
+        self.assertEqual(task.task_id, res.task.task_id)
+        self.assertEqual(task.data, ((3, 4), {}))
+        huey_sync.execute(task)
+        self.assertEqual(self._run_coro(res.aget(timeout=1)), 12)
+
+        res = self._run_coro(self.multiply_priority.aenqueue(5, 6))
+        self.multiply(1, 2)
+        self.assertEqual(huey_sync.dequeue().task_id, res.task.task_id)
+
+    def test_aget_preserve(self):
+        huey = self.huey
+        res = self.multiply(2, 3)
+        huey.execute(huey.dequeue())
+        self.assertEqual(self._run_coro(res.aget(preserve=True)), 6)
+        self.assertEqual(self._run_coro(huey.aresult(res.task.task_id)), 6)
+        self.assertEqual(self._run_coro(huey.aresult(res.task.task_id)),
+                         None)
+
+    def test_aget_timeout(self):
+        res = self._run_coro(self.multiply.aenqueue(1, 2))
+        self.assertRaises(DataStoreTimeout, self._run_coro,
+                          res.aget(timeout=.2, max_delay=.05,
+                                   revoke_on_timeout=True))
+        self.assertTrue(self.huey.is_revoked(res.task))
+
+    def test_aget_notify(self):
+        huey_notify = self.huey_notify
+        res = self._run_coro(huey_notify.aenqueue(
+            self.multiply.task_class(((4, 5), {}))))
+
+        def execute():
+            huey_notify.execute(huey_notify.dequeue())
+
+        async def wait():
+            self.loop.call_later(.1, threading.Thread(target=execute).start)
+            return await res.aget(timeout=5)
+
+        self.assertEqual(self._run_coro(wait()), 20)
+
+    def test_aevents(self):
+        huey = self.huey
+
+        async def listen():
+            events = huey.aevents()
+            event = asyncio.ensure_future(events.__anext__())
+            await asyncio.sleep(.1)
+            huey.emit_status('testing', id='t1')
+            try:
+                return await event
+            finally:
+                await events.aclose()
+
+        event = self._run_coro(listen())
+        self.assertEqual(event['status'], 'testing')
+        self.assertEqual(event['id'], 't1')
+
+
+memory_huey = MemoryHuey('testing-async-worker', blocking=False)
+
+@memory_huey.task()
+async def sleep_and_add(a, b):
+    await asyncio.sleep(.2)
+    return a + b
+
+@memory_huey.task()
+def add_sync(a, b):
+    return a + b
+
+@memory_huey.task()
+async def fail_async():
+    raise ValueError('failed')
+
+
+class TestAsyncWorker(BaseTestCase):
+    def setUp(self):
+        memory_huey.flush()
+        self.consumer = Consumer(memory_huey, workers=10,
+                                 worker_type='asyncio')
+
+    def tearDown(self):
+        memory_huey.flush()
+
+    def test_worker(self):
+        self.assertEqual(len(self.consumer.worker_threads), 1)
+        self.assertTrue(isinstance(self.consumer.environment,
+                                   AsyncioEnvironment))
+        self.assertRaises(ValueError, Consumer, memory_huey,
+                          worker_type='asyncio', max_workers=4)
+
+        worker = self.consumer._create_worker()
+        self.assertTrue(isinstance(worker, AsyncWorker))
+        self.assertEqual(worker.concurrency, 10)
+
+        results = [sleep_and_add(i, i) for i in range(10)]
+        sync_result = add_sync(1, 2)
+        error_result = fail_async()
+
+        # The coroutines run at the same time.
+        start = time.time()
+        for i in range(12):
+            worker.loop()
+        worker.shutdown()
+        self.assertTrue(time.time() - start < 1)
+
+        self.assertEqual([r.get() for r in results],
+                         [i * 2 for i in range(10)])
+        self.assertEqual(sync_result.get(), 3)
+        self.assertEqual(error_result.get(), None)
+        error, = memory_huey.errors()
+        self.assertEqual(error['task'], 'queuecmd_fail_async')
+        self.assertTrue('ValueError: failed' in error['traceback'])
+        self.assertEqual(worker.tasks_handled, 12)
+
+    def test_concurrency(self):
+        consumer = Consumer(memory_huey, workers=2, worker_type='asyncio',
+                            prefetch=4)
+        worker = consumer._create_worker()
+        for i in range(4):
+            sleep_and_add(i, i)
+
+        # Once both slots are in use, the next loop waits for a task to
+        # finish. Tasks that are not started are returned on shutdown.
+        worker.loop()
+        worker.loop()
+        self.assertEqual(len(worker._in_flight), 2)
+        self.assertEqual(len(worker._buffer), 2)
+        worker.shutdown()
+        self.assertEqual(len(worker._in_flight), 0)
+        self.assertEqual(len(memory_huey), 2)
+
+    def test_prefetch(self):
+        consumer = Consumer(memory_huey, workers=2, worker_type='asyncio',
+                            prefetch=4)
+        worker = consumer._create_worker()
+        r1 = add_sync(1, 2)
+        memory_huey.storage.enqueue(b'not a task')
+        r2 = add_sync(3, 4)
+        r3 = add_sync(5, 6)
+
+        # A message that cannot be read does not lose the rest of the batch,
+        # and buffered tasks whose visibility timeout expired are skipped.
+        worker.touch = lambda task: task.task_id != r2.task.task_id
+        worker.loop()
+        worker.loop()
+        worker.shutdown()
+        self.assertEqual(r1.get(), 3)
+        self.assertEqual(r2.get(), None)
+        self.assertEqual(r3.get(), 11)
+        self.assertEqual(len(worker._buffer), 0)
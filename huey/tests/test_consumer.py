@@ -3,6 +3,9 @@ import threading
 import time
 
 from huey import crontab
+from huey import MemoryHuey
+from huey import RedisHuey
+from huey.consumer import Autoscaler
 from huey.consumer import Consumer
 from huey.consumer import Scheduler
 from huey.consumer import Worker
@@ -18,6 +21,12 @@ state = {}
 
 lock = threading.Lock()
 
+memory_huey = MemoryHuey('memory', blocking=True, read_timeout=0.1)
+
+@memory_huey.task()
+def multiply(a, b):
+    return a * b
+
 # Create some test tasks.
 @test_huey.task()
 def modify_state(k, v):
@@ -78,6 +87,20 @@ class TestExecution(HueyTestCase):
         self.assertEqual(state, {'k1': 'v1', 'k2': 'v2', 'k3': 'v3'})
 
 
+    def test_memory_execution(self):
+        consumer = Consumer(memory_huey, workers=2)
+        results = multiply.map([(i, i) for i in range(10)])
+        consumer.start()
+        try:
+            self.assertEqual(results.get(blocking=True, timeout=5),
+                             [i * i for i in range(10)])
+        finally:
+            consumer.stop()
+            for worker in consumer.worker_threads:
+                worker.join()
+        self.assertEqual(len(memory_huey), 0)
+
+
 class TestConsumerAPIs(HueyTestCase):
     def setUp(self):
         super(TestConsumerAPIs, self).setUp()
@@ -133,6 +156,335 @@ class TestConsumerAPIs(HueyTestCase):
             ('started', res.task),
             ('finished', res.task))
 
+    def test_prefetch(self):
+        consumer = self.get_consumer(workers=1, prefetch=3)
+        worker = consumer._create_worker()
+        r1 = modify_state('k1', 'v1')
+        r2 = modify_state('k2', 'v2')
+        r3 = modify_state('k3', 'v3')
+        r4 = modify_state('k4', 'v4')
+
+        # The first loop reads three tasks in one go and executes the first.
+        worker.loop()
+        self.assertEqual(state, {'k1': 'v1'})
+        self.assertEqual(len(self.huey), 1)
+        self.assertEqual(len(worker._buffer), 2)
+
+        worker.loop()
+        self.assertEqual(state, {'k1': 'v1', 'k2': 'v2'})
+
+        # Unstarted tasks are returned to the front of the queue.
+        worker.shutdown()
+        self.assertEqual(len(worker._buffer), 0)
+        self.assertEqual([t.task_id for t in self.huey.pending()],
+                         [r4.task.task_id, r3.task.task_id])
+        self.assertEqual(self.huey.dequeue().task_id, r3.task.task_id)
+
+    def test_worker_limits(self):
+        self.assertRaises(ValueError, self.get_consumer,
+                          max_tasks_per_child=2)
+
+        consumer = self.get_consumer(workers=1, prefetch=3,
+                                     worker_type='process',
+                                     max_tasks_per_child=2)
+        worker = consumer._create_worker()
+        r1 = modify_state('k1', 'v1')
+        r2 = modify_state('k2', 'v2')
+        r3 = modify_state('k3', 'v3')
+
+        worker.loop()
+        self.assertFalse(worker.exiting)
+        worker.loop()
+        self.assertTrue(worker.exiting)
+        self.assertEqual(state, {'k1': 'v1', 'k2': 'v2'})
+
+        # The runnable exits, handing the prefetched task back to the queue.
+        consumer._create_runnable(worker)()
+        self.assertEqual([t.task_id for t in self.huey.pending()],
+                         [r3.task.task_id])
+
+        consumer = self.get_consumer(workers=1, worker_type='process',
+                                     max_memory_per_child=1)
+        worker = consumer._create_worker()
+        modify_state('k4', 'v4')
+        worker.loop()
+        self.assertTrue(worker.exiting)
+
+    def test_check_worker_health(self):
+        class FakeProcess(object):
+            def __init__(self, name, exitcode=None):
+                self.name = name
+                self.exitcode = exitcode
+                self.started = False
+
+            def is_alive(self):
+                return self.started and self.exitcode is None
+
+            def start(self):
+                self.started = True
+
+        consumer = self.get_consumer(workers=2, worker_type='process')
+        consumer._create_worker_process = lambda i: FakeProcess('W%d' % i)
+        consumer.worker_threads = [FakeProcess('W0', exitcode=0),
+                                   FakeProcess('W1', exitcode=1)]
+
+        # A worker that exited cleanly is replaced immediately, a crashed
+        # worker after a delay.
+        with CaptureLogs() as capture:
+            consumer.check_worker_health()
+        self.assertLogs(capture, ['W0 exited, starting a replacement',
+                                  'W1 exited with code 1, restarting in 1.0'])
+        self.assertTrue(consumer.worker_threads[0].started)
+        self.assertEqual(consumer.worker_threads[1].exitcode, 1)
+
+        consumer.check_worker_health()
+        self.assertEqual(consumer.worker_threads[1].exitcode, 1)
+        consumer._restart_at[1] = 0
+        consumer.check_worker_health()
+        self.assertTrue(consumer.worker_threads[1].is_alive())
+
+        # Consecutive crashes double the delay.
+        consumer.worker_threads[1].exitcode = -9
+        consumer.check_worker_health()
+        self.assertEqual(consumer._crashes[1], 2)
+        self.assertTrue(consumer._restart_at[1] - time.time() > 1.5)
+
+    def test_autoscaler(self):
+        autoscaler = Autoscaler(1, 4, sample_interval=1, window=3,
+                                cooldown=10)
+        self.assertTrue(autoscaler.due(0))
+        self.assertEqual(autoscaler.sample(0, 2, 10, 2), None)
+        self.assertFalse(autoscaler.due(0.5))
+        self.assertEqual(autoscaler.sample(1, 2, 10, 2), None)
+
+        # Busy workers with tasks waiting: grow, at most doubling.
+        self.assertEqual(autoscaler.sample(2, 2, 10, 1), 4)
+        self.assertEqual(autoscaler.pending, 10)
+        self.assertEqual(autoscaler.utilization, 2.5 / 3)
+
+        # Nothing changes during the cool-down.
+        for now in (3, 4, 5):
+            self.assertEqual(autoscaler.sample(now, 4, 0, 0), None)
+
+        # Idle workers with nothing waiting: shrink one at a time.
+        for now in (12, 13, 14):
+            target = autoscaler.sample(now, 4, 0, 0)
+        self.assertEqual(target, 3)
+
+        # Between the thresholds nothing changes.
+        for now in (30, 31, 32):
+            target = autoscaler.sample(now, 3, 0, 2)
+        self.assertEqual(target, None)
+
+    def test_set_worker_count(self):
+        self.assertRaises(ValueError, Consumer, memory_huey, min_workers=2)
+        self.assertRaises(ValueError, Consumer, memory_huey, min_workers=3,
+                          max_workers=2)
+
+        consumer = Consumer(memory_huey, workers=8, min_workers=2,
+                            max_workers=4)
+        self.assertEqual(len(consumer.worker_threads), 4)
+        consumer.start()
+        try:
+            consumer.set_worker_count(6)
+            self.assertEqual(len(consumer.worker_threads), 6)
+            self.assertEqual([w.name for w in consumer.worker_threads[4:]],
+                             ['Worker-5', 'Worker-6'])
+
+            # Stopped workers exit after their current task.
+            retiring = consumer.worker_threads[3:]
+            consumer.set_worker_count(3)
+            self.assertEqual(set(consumer._retiring), set(retiring))
+            for worker in retiring:
+                worker.join(5)
+                self.assertFalse(worker.is_alive())
+            self.assertTrue(all(w.is_alive() for w in consumer.worker_threads))
+
+            res = multiply(3, 4)
+            self.assertEqual(res.get(blocking=True, timeout=5), 12)
+        finally:
+            consumer.stop()
+            for worker in consumer.worker_threads:
+                worker.join()
+            consumer.scheduler.join()
+            memory_huey.flush()
+
+    def test_dispatcher(self):
+        consumer = Consumer(memory_huey, workers=2, dispatcher=True)
+        self.assertTrue(consumer.dispatcher is not None)
+        worker = consumer._create_worker()
+        self.assertTrue(worker.work_queue is consumer.work_queue)
+
+        results = multiply.map([(i, i) for i in range(10)])
+        consumer.start()
+        try:
+            self.assertEqual(results.get(blocking=True, timeout=5),
+                             [i * i for i in range(10)])
+        finally:
+            consumer.stop()
+            consumer.dispatcher.join()
+            for worker in consumer.worker_threads:
+                worker.join()
+            consumer.scheduler.join()
+        self.assertEqual(len(memory_huey), 0)
+
+    def test_dispatcher_requeue(self):
+        consumer = Consumer(memory_huey, workers=1, dispatcher=True)
+        dispatcher = consumer._create_dispatcher()
+        dispatcher.queue_timeout = 0.01
+        r1, r2, r3 = [multiply(i, i) for i in range(3)]
+
+        # Once the work queue is full, the dispatcher holds on to the message
+        # it read, and returns it to the queue on shutdown.
+        dispatcher.loop()
+        dispatcher.loop()
+        self.assertEqual(len(memory_huey), 1)
+        dispatcher.shutdown()
+        self.assertEqual(len(memory_huey), 2)
+
+        # Messages left in the work queue are returned by the consumer.
+        consumer.requeue_undispatched()
+        self.assertEqual([t.task_id for t in memory_huey.pending()],
+                         [r3.task.task_id, r2.task.task_id, r1.task.task_id])
+        memory_huey.flush()
+
+    def test_shutdown_timeout(self):
+        consumer = self.get_consumer(workers=1, prefetch=2)
+        consumer.shutdown_timeout = 0.1
+        event = threading.Event()
+        worker = threading.Thread(target=event.wait, name='Worker-1')
+        worker.start()
+
+        # A worker that does not stop in time is left behind.
+        start = time.time()
+        with CaptureLogs() as capture:
+            consumer._join([worker])
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(capture.messages,
+                         ['Gave up waiting for Worker-1 to stop'])
+        event.set()
+        worker.join()
+
+    def test_dispatcher_delay(self):
+        # An empty, non-blocking storage is polled without backing off.
+        consumer = Consumer(self.huey, workers=1, dispatcher=True,
+                            initial_delay=0.1, max_delay=10)
+        dispatcher = consumer._create_dispatcher()
+        delays = []
+        time.sleep = delays.append
+        for i in range(3):
+            dispatcher.loop()
+        self.assertEqual(delays, [0.1, 0.1, 0.1])
+
+    def test_dispatcher_batches(self):
+        self.assertRaises(ValueError, Consumer, memory_huey, queue_size=4)
+        consumer = Consumer(memory_huey, workers=2, dispatcher=True,
+                            prefetch=3, queue_size=4)
+        self.assertEqual(consumer.queue_size, 4)
+        dispatcher = consumer._create_dispatcher()
+        dispatcher.queue_timeout = 0.01
+        results = [multiply(i, i) for i in range(8)]
+
+        # Batches are read until the work queue is full, after which nothing
+        # more is read until the workers catch up.
+        dispatcher.loop()
+        self.assertEqual(len(memory_huey), 5)
+        dispatcher.loop()
+        self.assertEqual(len(memory_huey), 2)
+        self.assertEqual(len(dispatcher._pending), 2)
+        dispatcher.loop()
+        self.assertEqual(len(memory_huey), 2)
+
+        worker = consumer._create_worker()
+        worker.loop()
+        self.assertEqual(results[0].get(), 0)
+        dispatcher.loop()
+        self.assertEqual(len(dispatcher._pending), 1)
+
+        dispatcher.shutdown()
+        consumer.requeue_undispatched()
+        self.assertEqual([t.task_id for t in memory_huey.pending()],
+                         [r.task.task_id for r in reversed(results[1:])])
+        memory_huey.flush()
+
+    def test_connection_pool(self):
+        huey = RedisHuey('testing-pool', blocking=False, max_connections=2)
+        Consumer(huey, workers=3)
+        self.assertEqual(huey.storage.pool_stats()['max_connections'], 5)
+
+        # Pools without a limit are left without one.
+        huey = RedisHuey('testing-pool', blocking=False)
+        pool = huey.storage.pool
+        Consumer(huey, workers=8)
+        self.assertTrue(huey.storage.pool is pool)
+
+        # Each process opens a pool for itself.
+        huey = RedisHuey('testing-pool', blocking=True, read_timeout=0.1,
+                         max_connections=1)
+        consumer = Consumer(huey, workers=2, worker_type='process')
+        self.assertEqual(huey.storage.pool_stats()['max_connections'], 2)
+        res = huey.enqueue(multiply.task_class(((3, 4), {})))
+        consumer.start()
+        try:
+            self.assertEqual(res.get(blocking=True, timeout=5), 12)
+        finally:
+            consumer.stop()
+            for worker in consumer.worker_threads:
+                worker.join()
+            consumer.scheduler.join()
+            huey.flush()
+        self.assertEqual(len(huey), 0)
+
+    def test_reliable_acknowledge(self):
+        huey = RedisHuey('testing-reliable', blocking=False, reliable=True,
+                         visibility_timeout=60)
+        consumer = Consumer(huey, workers=1)
+        worker = consumer._create_worker()
+        try:
+            huey.enqueue(modify_state.task_class((('k', 'v'), {})))
+            huey.enqueue(blow_up.task_class(((), {})))
+
+            # Succeeding and failing tasks are both acknowledged.
+            worker.loop()
+            self.assertEqual(state, {'k': 'v'})
+            worker.loop()
+            self.assertEqual(huey.storage.inflight_size(), 0)
+            self.assertEqual(len(huey), 0)
+        finally:
+            huey.flush()
+
+    def test_reliable_prefetch(self):
+        huey = RedisHuey('testing-reliable', blocking=False, reliable=True,
+                         visibility_timeout=60)
+        consumer = Consumer(huey, workers=1, prefetch=3)
+        worker = consumer._create_worker()
+        storage = huey.storage
+        try:
+            for i in range(3):
+                huey.enqueue(modify_state.task_class((('k%s' % i, i), {})))
+
+            # Prefetched tasks have their deadline restarted when they are
+            # run, and one that was already put back is skipped.
+            worker.loop()
+            self.assertEqual(state, {'k0': 0})
+            message = worker._buffer[0].message
+            storage._zadd(storage.conn, storage.inflight_key, 0, message)
+            task = worker.get_task()
+            self.assertTrue(storage.conn.zscore(storage.inflight_key,
+                                                message) > time.time())
+            worker.handle_task(task, worker.get_now())
+            self.assertEqual(state, {'k0': 0, 'k1': 1})
+
+            storage.conn.zrem(storage.inflight_key,
+                              worker._buffer[0].message)
+            with CaptureLogs() as capture:
+                worker.loop()
+            self.assertEqual(state, {'k0': 0, 'k1': 1})
+            self.assertEqual(len(worker._buffer), 0)
+            self.assertTrue('Skipping' in capture.messages[-1])
+        finally:
+            huey.flush()
+
     def test_worker(self):
         modify_state('k', 'w')
         task = test_huey.dequeue()
@@ -250,6 +602,67 @@ class TestConsumerAPIs(HueyTestCase):
         # our command was enqueued
         self.assertEqual(len(self.huey), 1)
 
+    def test_scheduling_batches(self):
+        dt = datetime.datetime(2011, 1, 1, 0, 1)
+        for i in range(7):
+            modify_state.schedule(args=('k%s' % i, i), eta=dt,
+                                  convert_utc=False)
+            self.huey.add_schedule(self.huey.dequeue())
+        self.assertEqual(self.huey.scheduled_count(), 7)
+
+        self.consumer = self.get_consumer(schedule_batch_size=3)
+        self.scheduler(dt)
+        self.assertEqual(self.huey.scheduled_count(), 0)
+        self.assertEqual(len(self.huey), 7)
+
+    def test_scheduling_without_promotion(self):
+        dt = datetime.datetime(2011, 1, 1, 0, 1)
+        for i in range(4):
+            modify_state.schedule(args=('k%s' % i, i), eta=dt,
+                                  convert_utc=False, priority=i % 2)
+            self.huey.add_schedule(self.huey.dequeue())
+
+        # Storages that cannot promote scheduled tasks themselves have the
+        # tasks read and enqueued by the scheduler.
+        self.huey.storage.promote_schedule = lambda ts, limit=None: None
+        try:
+            self.consumer = self.get_consumer(schedule_batch_size=3)
+            self.scheduler(dt)
+        finally:
+            del self.huey.storage.promote_schedule
+        self.assertEqual(self.huey.scheduled_count(), 0)
+        self.assertEqual([task.priority for task in self.huey.pending()],
+                         [1, 1, 0, 0])
+
+    def test_scheduling_enqueue_error(self):
+        dt = datetime.datetime(2011, 1, 1, 0, 1)
+        for i in range(5):
+            modify_state.schedule(args=('k%s' % i, i), eta=dt,
+                                  convert_utc=False)
+            self.huey.add_schedule(self.huey.dequeue())
+
+        # Tasks that cannot be enqueued are put back on the schedule, and
+        # the scheduler stops draining it until its next pass.
+        storage = self.huey.storage
+
+        def enqueue_many(data, priority=0):
+            raise ValueError('queue unavailable')
+
+        storage.promote_schedule = lambda ts, limit=None: None
+        storage.enqueue_many = enqueue_many
+        try:
+            self.consumer = self.get_consumer(schedule_batch_size=2)
+            self.scheduler(dt)
+            self.assertEqual(self.huey.scheduled_count(), 5)
+            self.assertEqual(len(self.huey), 0)
+        finally:
+            del storage.enqueue_many
+
+        self.scheduler(dt)
+        del storage.promote_schedule
+        self.assertEqual(self.huey.scheduled_count(), 0)
+        self.assertEqual(len(self.huey), 5)
+
     def test_retry_scheduling(self):
         # this will continually fail
         retry_task_delay('blampf')
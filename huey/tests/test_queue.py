@@ -1,5 +1,7 @@
 import datetime
 import pickle
+import threading
+import time
 
 from huey import crontab
 from huey import exceptions as huey_exceptions
@@ -16,6 +18,8 @@ from huey.utils import local_to_utc
 huey = RedisHuey(result_store=False, events=False, blocking=False)
 huey_results = RedisHuey(blocking=False, max_errors=10)
 huey_store_none = RedisHuey(store_none=True, blocking=False)
+huey_notify = RedisHuey('notify', blocking=False, notify_results=True)
+huey_errors = RedisHuey('errors', blocking=False, error_index=True)
 
 # Global state.
 state = {}
@@ -52,6 +56,10 @@ throw_error_task_res = huey_results.task()(_throw_error_task)
 def add_values(a, b):
     return a + b
 
+@huey_results.task(priority=10)
+def add_values_priority(a, b):
+    return a + b
+
 @huey_results.periodic_task(crontab(minute='0'))
 def hourly_task2():
     state['periodic'] = 2
@@ -72,12 +80,14 @@ class BaseQueueTestCase(BaseTestCase):
         huey.flush()
         huey_results.flush()
         huey_store_none.flush()
+        huey_notify.flush()
         self.assertEqual(len(huey), 0)
 
     def tearDown(self):
         huey.flush()
         huey_results.flush()
         huey_store_none.flush()
+        huey_notify.flush()
 
 
 class TestHueyQueueMetadataAPIs(BaseQueueTestCase):
@@ -88,6 +98,11 @@ class TestHueyQueueMetadataAPIs(BaseQueueTestCase):
         self.assertEqual(cmd2.data, (('k2', 'v2'), {}))
         self.assertEqual(cmd1.data, (('k1', 'v1'), {}))
 
+        cmd2, = huey.pending(limit=1)
+        self.assertEqual(cmd2.data, (('k2', 'v2'), {}))
+        self.assertEqual([t.data for t in huey.iter_pending(chunk_size=1)],
+                         [cmd2.data, cmd1.data])
+
         huey.dequeue()
         cmd1, = huey.pending()
         self.assertEqual(cmd1.data, (('k2', 'v2'), {}))
@@ -102,6 +117,9 @@ class TestHueyQueueMetadataAPIs(BaseQueueTestCase):
         cmd2, cmd1 = huey_results.scheduled()
         self.assertEqual(cmd1.data, ((1, 2), {}))
         self.assertEqual(cmd2.data, ((3, 4), {}))
+        self.assertEqual(
+            sorted(t.data for t in huey_results.iter_scheduled()),
+            [cmd1.data, cmd2.data])
 
     def test_results_metadata(self):
         add_values(1, 2)
@@ -116,6 +134,8 @@ class TestHueyQueueMetadataAPIs(BaseQueueTestCase):
         huey_results.execute(t2)
         self.assertEqual(sorted(huey_results.all_results().keys()),
                          sorted([b(t1.task_id), b(t2.task_id)]))
+        self.assertEqual(dict(huey_results.iter_results(chunk_size=1)),
+                         huey_results.all_results())
 
 
 class TestHueyQueueAPIs(BaseQueueTestCase):
@@ -136,6 +156,78 @@ class TestHueyQueueAPIs(BaseQueueTestCase):
         # no changes to state
         self.assertEqual(state, {})
 
+    def test_enqueue_many(self):
+        tasks = [PutTask(('k%s' % i, 'v%s' % i)) for i in range(3)]
+        self.assertTrue(huey.enqueue_many(tasks) is None)
+        self.assertEqual(len(huey), 3)
+
+        # Tasks are dequeued in the order they were given.
+        self.assertEqual([huey.dequeue().task_id for i in range(3)],
+                         [task.task_id for task in tasks])
+
+    def test_map(self):
+        group = add_values.map([(1, 2), (3, 4), (5, 6)])
+        self.assertEqual(len(group), 3)
+        self.assertEqual(len(huey_results), 3)
+        self.assertEqual(group.get(), [None, None, None])
+
+        huey_results.execute(huey_results.dequeue())
+        huey_results.execute(huey_results.dequeue())
+        self.assertEqual(group.get(), [3, 7, None])
+
+        huey_results.execute(huey_results.dequeue())
+        self.assertEqual(group(), [3, 7, 11])
+        self.assertEqual(group.get(blocking=True), [3, 7, 11])
+
+        # Single arguments do not need to be wrapped in a tuple.
+        put_data.map(['k1', 'k2'])
+        self.assertEqual([t.data for t in reversed(huey.pending())],
+                         [(('k1',), {}), (('k2',), {})])
+
+    def test_map_timeout(self):
+        group = add_values.map([(1, 2), (3, 4)])
+        huey_results.execute(huey_results.dequeue())
+        self.assertRaises(huey_exceptions.DataStoreTimeout, group.get,
+                          blocking=True, timeout=0.01, max_delay=0.01)
+        self.assertEqual(group.get(), [3, None])
+
+    def test_priority(self):
+        add_values(1, 2)
+        add_values_priority(3, 4)
+        add_values.schedule((5, 6), priority=20)
+        add_values_priority.schedule((7, 8), priority=-1)
+
+        tasks = [huey_results.dequeue() for i in range(4)]
+        self.assertEqual([task.data for task in tasks], [
+            ((5, 6), {}),
+            ((3, 4), {}),
+            ((1, 2), {}),
+            ((7, 8), {})])
+        self.assertEqual([task.priority for task in tasks], [20, 10, 0, -1])
+
+        # Priority survives a round trip through the schedule.
+        dt = datetime.datetime(2011, 1, 1)
+        add_values_priority.schedule((9, 10), eta=dt, convert_utc=False)
+        huey_results.add_schedule(huey_results.dequeue())
+        task, = huey_results.read_schedule(dt)
+        self.assertEqual(task.priority, 10)
+
+        # Tasks are requeued with their own priority.
+        add_values(1, 1)
+        huey_results.requeue([task])
+        self.assertEqual(huey_results.dequeue().data, ((9, 10), {}))
+
+        # Integral priorities are converted, anything else is rejected.
+        huey_results.flush()
+        add_values.schedule((1, 1), priority='3')
+        self.assertEqual(huey_results.dequeue().priority, 3)
+        self.assertRaises(ValueError, add_values.schedule, (1, 1),
+                          priority=1.5)
+        self.assertRaises(ValueError, add_values.schedule, (1, 1),
+                          priority='high')
+        self.assertRaises(ValueError, huey_results.task, priority='high')
+        self.assertEqual(len(huey_results), 0)
+
     def test_enqueue_decorator(self):
         put_data('k', 'v')
         self.assertEqual(len(huey), 1)
@@ -202,6 +294,33 @@ class TestHueyQueueAPIs(BaseQueueTestCase):
         most_recent_error = hr.errors()[0]
         self.assertEqual(most_recent_error['id'], task.task_id)
 
+    def test_error_index(self):
+        @huey_errors.task()
+        def fails(n):
+            raise TestException(n)
+
+        @huey_errors.task()
+        def also_fails(n):
+            raise TestException(n)
+
+        huey_errors.flush()
+        try:
+            for i, task_fn in enumerate((fails, also_fails, fails)):
+                task_fn(i)
+                self.assertRaises(TestException, huey_errors.execute,
+                                  huey_errors.dequeue())
+
+            self.assertEqual(len(huey_errors.errors()), 3)
+            errors = huey_errors.errors(task=fails)
+            self.assertEqual([str(e['error']) for e in errors], ['2', '0'])
+            errors = list(huey_errors.iter_errors(fails, chunk_size=1))
+            self.assertEqual([str(e['error']) for e in errors], ['2', '0'])
+            name = also_fails.task_class.__name__
+            error, = huey_errors.errors(task=name)
+            self.assertEqual(error['task'], name)
+        finally:
+            huey_errors.flush()
+
     def test_internal_error(self):
         """
         Verify that exceptions are wrapped with the special "huey"
@@ -226,10 +345,10 @@ class TestHueyQueueAPIs(BaseQueueTestCase):
             def put_data(self, key, value):
                 raise SpecialException('put error')
 
-            def add_to_schedule(self, data, ts):
+            def add_to_schedule(self, data, ts, priority=0):
                 raise SpecialException('add error')
 
-            def read_schedule(self, ts):
+            def read_schedule(self, ts, limit=None):
                 raise SpecialException('read error')
 
         class BrokenHuey(RedisHuey):
@@ -412,6 +531,88 @@ class TestHueyQueueAPIs(BaseQueueTestCase):
         self.assertEqual(res.get(), None)
         self.assertEqual(res._result, None)
 
+    def test_result_notification(self):
+        res = huey_notify.enqueue(add_values.task_class(((1, 2), {})))
+        task = huey_notify.dequeue()
+
+        def execute():
+            time.sleep(0.1)
+            huey_notify.execute(task)
+
+        t = threading.Thread(target=execute)
+        t.start()
+
+        # The waiter is woken as soon as the result is stored, rather than
+        # when its next poll would have occurred.
+        start = time.time()
+        self.assertEqual(res.get(blocking=True, timeout=5, max_delay=5), 3)
+        self.assertTrue(time.time() - start < 1)
+        t.join()
+
+        # Only one waiter is woken per result, so a waiter whose signal was
+        # taken by another caller still finds the result within max_delay.
+        res = huey_notify.enqueue(add_values.task_class(((2, 3), {})))
+        task = huey_notify.dequeue()
+
+        def execute_and_consume():
+            time.sleep(0.1)
+            huey_notify.execute(task)
+            storage = huey_notify.storage
+            storage.conn.delete(storage.notify_prefix + task.task_id)
+
+        t = threading.Thread(target=execute_and_consume)
+        t.start()
+        start = time.time()
+        self.assertEqual(res.get(blocking=True, max_delay=0.3), 5)
+        self.assertTrue(time.time() - start < 2)
+        t.join()
+
+        # A result that is already stored is returned without waiting, and
+        # waiting for a result that never arrives times out.
+        res = huey_notify.enqueue(add_values.task_class(((3, 4), {})))
+        huey_notify.execute(huey_notify.dequeue())
+        self.assertEqual(res.get(blocking=True, timeout=1), 7)
+        res = huey_notify.enqueue(add_values.task_class(((5, 6), {})))
+        start = time.time()
+        self.assertRaises(huey_exceptions.DataStoreTimeout, res.get,
+                          blocking=True, timeout=0.3)
+        self.assertTrue(time.time() - start < 0.9)
+
+        # Servers older than Redis 6 only wait for whole seconds.
+        storage = huey_notify.storage
+        self.assertEqual(storage._blocking_timeout(0.3), 0.3)
+        storage._set_server_info({'redis_version': '5.0.14'})
+        self.assertEqual(storage._blocking_timeout(0.3), 1)
+        self.assertEqual(storage._blocking_timeout(None), 0)
+        storage._float_timeouts = None
+
+    def test_get_results(self):
+        r1 = add_values(1, 2)
+        r2 = add_values(3, 4)
+        r3 = add_values(5, 6)
+        tid3 = r3.task.task_id
+
+        self.assertEqual(huey_results.get_results([r1, r2, tid3]),
+                         [None, None, None])
+        huey_results.execute(huey_results.dequeue())
+        huey_results.execute(huey_results.dequeue())
+        self.assertEqual(huey_results.get_results([r1, r2, tid3]),
+                         [3, 7, None])
+
+        # Results are cached on the wrappers once they have been read.
+        self.assertEqual(r1.get(), 3)
+        self.assertEqual(huey_results.result_count(), 0)
+
+        self.assertRaises(huey_exceptions.DataStoreTimeout,
+                          huey_results.get_results, [r1, tid3],
+                          blocking=True, timeout=0.05, max_delay=0.01)
+
+        huey_results.execute(huey_results.dequeue())
+        self.assertEqual(
+            huey_results.get_results([tid3, r2, r1], preserve=True),
+            [11, 7, 3])
+        self.assertEqual(huey_results.result(tid3), 11)
+
     def test_huey_result_method(self):
         res = add_values(1, 2)
         tid = res.task.task_id
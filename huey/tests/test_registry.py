@@ -1,3 +1,5 @@
+import pickle
+
 from huey.api import crontab
 from huey.api import QueueTask
 from huey.registry import registry
@@ -31,3 +33,15 @@ class TestRegistry(BaseTestCase):
         periodic = registry._periodic_tasks
         task_classes = [type(task) for task in periodic]
         self.assertTrue(test_task_two.task_class in task_classes)
+
+    def test_message_priority(self):
+        task = test_task_one.task_class(((1, 2), {}), priority=5)
+        msg = registry.get_message_for_task(task)
+        self.assertEqual(registry.get_task_for_message(msg).priority, 5)
+
+        # Messages without a priority are read with the default priority.
+        legacy = pickle.dumps(('tid', 'queuecmd_test_task_one', None, 0, 0,
+                               ((1, 2), {})))
+        task = registry.get_task_for_message(legacy)
+        self.assertEqual(task.task_id, 'tid')
+        self.assertEqual(task.priority, 0)
@@ -0,0 +1,190 @@
+import datetime
+import unittest
+from decimal import Decimal
+
+from huey import RedisHuey
+from huey.api import QueueTask
+from huey.exceptions import DataStorePutException
+from huey.registry import registry
+from huey.serializer import COMPRESSED
+from huey.serializer import JSONSerializer
+from huey.serializer import MsgPackSerializer
+from huey.serializer import Serializer
+from huey.serializer import lz4
+from huey.serializer import msgpack
+from huey.tests.base import BaseTestCase
+
+
+huey_json = RedisHuey('testing-json', blocking=False,
+                      serializer=JSONSerializer())
+huey_zlib = RedisHuey('testing-zlib', blocking=False,
+                      serializer=Serializer(compression='zlib',
+                                            compression_threshold=256))
+
+@huey_json.task()
+def concat(a, b):
+    return a + b
+
+@huey_json.task()
+def fail(message):
+    raise ValueError(message)
+
+@huey_json.task()
+def today():
+    return datetime.date.today()
+
+@huey_zlib.task()
+def repeat(s, n):
+    return s * n
+
+
+class SerializerTask(QueueTask):
+    def execute(self):
+        return self.data
+
+
+class BaseSerializerTestCase(BaseTestCase):
+    def get_serializer(self):
+        return Serializer()
+
+    def test_message_round_trip(self):
+        serializer = self.get_serializer()
+        dt = datetime.datetime(2016, 7, 1, 12, 30, 15, 123456)
+        task = SerializerTask(((1, 'two'), {'k': [3]}), execute_time=dt,
+                              retries=2, retry_delay=5, priority=3)
+        msg = registry.get_message_for_task(task, serializer)
+        decoded = registry.get_task_for_message(msg, serializer)
+
+        self.assertEqual(decoded, task)
+        self.assertTrue(isinstance(decoded, SerializerTask))
+        self.assertEqual(decoded.execute_time, dt)
+        self.assertEqual(decoded.retries, 2)
+        self.assertEqual(decoded.retry_delay, 5)
+        self.assertEqual(decoded.priority, 3)
+        args, kwargs = decoded.data
+        self.assertEqual(list(args), [1, 'two'])
+        self.assertEqual(kwargs, {'k': [3]})
+
+        task = SerializerTask(None)
+        msg = registry.get_message_for_task(task, serializer)
+        decoded = registry.get_task_for_message(msg, serializer)
+        self.assertEqual(decoded.execute_time, None)
+        self.assertEqual(decoded.data, None)
+
+    def test_values(self):
+        serializer = self.get_serializer()
+        for value in (None, 0, 1.5, 'a string', u'\xce\xcf', [1, [2]],
+                      {'a': {'b': None}}):
+            self.assertEqual(
+                serializer.deserialize(serializer.serialize(value)),
+                value)
+
+
+class TestPickleSerializer(BaseSerializerTestCase):
+    pass
+
+
+class TestJSONSerializer(BaseSerializerTestCase):
+    def get_serializer(self):
+        return JSONSerializer()
+
+    def test_huey(self):
+        huey_json.flush()
+        try:
+            res = concat('a', 'b')
+            huey_json.execute(huey_json.dequeue())
+            self.assertEqual(res.get(), 'ab')
+
+            fail('bad')
+            task = huey_json.dequeue()
+            self.assertRaises(ValueError, huey_json.execute, task)
+            error, = huey_json.errors()
+            self.assertEqual(error['id'], task.task_id)
+            self.assertEqual(error['error'], repr(ValueError('bad')))
+
+            # A result that cannot be serialized is an error storing the
+            # result, not an error in the task.
+            today()
+            self.assertRaises(DataStorePutException, huey_json.execute,
+                              huey_json.dequeue())
+            self.assertEqual(len(huey_json.errors()), 1)
+        finally:
+            huey_json.flush()
+
+    def test_invalid_values(self):
+        # Values are never silently converted to another type.
+        serializer = self.get_serializer()
+        for value in (Decimal('1.5'), datetime.datetime(2016, 7, 1),
+                      object()):
+            self.assertRaises(TypeError, serializer.serialize, [value])
+        task = SerializerTask(((Decimal('1.5'),), {}))
+        self.assertRaises(TypeError, registry.get_message_for_task, task,
+                          serializer)
+
+        # Only the exception stored with an error is converted.
+        data = serializer.serialize_error({'id': 't1', 'error': KeyError('k'),
+                                           'traceback': 'Traceback...'})
+        self.assertEqual(serializer.deserialize(data), {
+            'id': 't1', 'error': repr(KeyError('k')),
+            'traceback': 'Traceback...'})
+
+    def test_compact(self):
+        task = SerializerTask(((1, 2), {}))
+        msg = registry.get_message_for_task(task, self.get_serializer())
+        self.assertTrue(len(msg) < len(registry.get_message_for_task(task)))
+
+
+@unittest.skipIf(msgpack is None, 'requires msgpack')
+class TestMsgPackSerializer(TestJSONSerializer):
+    def get_serializer(self):
+        return MsgPackSerializer()
+
+    def test_huey(self):
+        pass
+
+
+class TestCompression(BaseTestCase):
+    def test_threshold(self):
+        serializer = Serializer(compression='zlib', compression_threshold=256)
+        small = serializer.serialize('x' * 10)
+        self.assertEqual(small, Serializer().serialize('x' * 10))
+        self.assertEqual(serializer.deserialize(small), 'x' * 10)
+
+        large = serializer.serialize('x' * 1000)
+        self.assertEqual(large[:1], COMPRESSED)
+        self.assertTrue(len(large) < 100)
+        self.assertEqual(serializer.deserialize(large), 'x' * 1000)
+
+        # Uncompressed and compressed data can be read by either.
+        self.assertEqual(Serializer().deserialize(small), 'x' * 10)
+        self.assertEqual(Serializer().deserialize(large), 'x' * 1000)
+
+    def test_incompressible(self):
+        serializer = Serializer(compression='zlib', compression_threshold=1)
+        data = serializer.serialize(b'a')
+        self.assertEqual(data, Serializer().serialize(b'a'))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, Serializer, compression='bz2')
+
+    def test_huey(self):
+        huey_zlib.flush()
+        try:
+            res = repeat('huey' * 100, 10)
+            msg, = huey_zlib.storage.enqueued_items()
+            self.assertEqual(msg[:1], COMPRESSED)
+
+            huey_zlib.execute(huey_zlib.dequeue())
+            value = huey_zlib.storage.peek_data(res.task.task_id)
+            self.assertEqual(value[:1], COMPRESSED)
+            self.assertEqual(res.get(), 'huey' * 1000)
+        finally:
+            huey_zlib.flush()
+
+    @unittest.skipIf(lz4 is None, 'requires lz4')
+    def test_lz4(self):
+        serializer = Serializer(compression='lz4', compression_threshold=256)
+        large = serializer.serialize('x' * 1000)
+        self.assertEqual(large[:1], COMPRESSED)
+        self.assertEqual(serializer.deserialize(large), 'x' * 1000)
+        self.assertEqual(Serializer().deserialize(large), 'x' * 1000)
@@ -1,6 +1,26 @@
 import datetime
+import gc
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
 
+import redis
+
+from huey.storage import FileHuey
+from huey.storage import FileStorage
+from huey.storage import MemoryHuey
+from huey.storage import MemoryStorage
+from huey.storage import RedisStorage
+from huey.storage import ShardedRedisHuey
+from huey.storage import ShardedRedisStorage
+from huey.storage import SqliteHuey
+from huey.storage import SqliteStorage
+from huey.storage import fcntl
 from huey.tests.base import b
+from huey.tests.base import BaseTestCase
 from huey.tests.base import HueyTestCase
 from huey.utils import EmptyData
 
@@ -24,6 +44,86 @@ class TestRedisStorage(HueyTestCase):
         self.huey.execute(task)
         self.assertEqual(res.get(), '\xce\xcf')
 
+    def test_enqueue_many(self):
+        storage = self.huey.storage
+        storage.enqueue_chunk_size = 2
+        try:
+            storage.enqueue_many(['m%s' % i for i in range(5)])
+        finally:
+            storage.enqueue_chunk_size = 1000
+        self.assertEqual(storage.queue_size(), 5)
+        self.assertEqual([storage.dequeue() for i in range(5)],
+                         [b('m%s' % i) for i in range(5)])
+
+    def test_dequeue_many(self):
+        storage = self.huey.storage
+        for i in range(5):
+            storage.enqueue('m%s' % i)
+
+        self.assertEqual(storage.dequeue_many(2), [b('m0'), b('m1')])
+        self.assertEqual(storage.queue_size(), 3)
+
+        # Requeued messages are the next to be dequeued, in the same order.
+        storage.requeue([b('m0'), b('m1')])
+        self.assertEqual(storage.dequeue(), b('m0'))
+        self.assertEqual(storage.dequeue_many(10),
+                         [b('m1'), b('m2'), b('m3'), b('m4')])
+        self.assertEqual(storage.queue_size(), 0)
+        self.assertEqual(storage.dequeue_many(10), [])
+
+    def test_priorities(self):
+        storage = self.huey.storage
+        storage.enqueue('m1')
+        storage.enqueue('h1', priority=10)
+        storage.enqueue_many(['l1', 'l2'], priority=-5)
+        storage.enqueue('h2', priority=10)
+        storage.enqueue('m2')
+        self.assertEqual(storage.queue_size(), 6)
+        self.assertEqual(storage.enqueued_items(),
+                         [b('h2'), b('h1'), b('m2'), b('m1'), b('l2'), b('l1')])
+
+        self.assertEqual(storage.enqueued_items(3),
+                         [b('h2'), b('h1'), b('m2')])
+        self.assertEqual(storage.enqueued_items(0), [])
+        self.assertEqual(list(storage.iter_enqueued(chunk_size=4)),
+                         [b('h2'), b('h1'), b('m2'), b('m1'), b('l2'), b('l1')])
+
+        self.assertEqual(storage.dequeue(), b('h1'))
+        self.assertEqual(storage.dequeue_many(3), [b('h2'), b('m1'), b('m2')])
+        storage.requeue([b('m2')])
+        storage.requeue([b('h2')], priority=10)
+        self.assertEqual(storage.dequeue_many(10),
+                         [b('h2'), b('m2'), b('l1'), b('l2')])
+        self.assertEqual(storage.queue_size(), 0)
+
+        storage.blocking = True
+        storage.read_timeout = 0.1
+        try:
+            storage.enqueue('l3', priority=-5)
+            self.assertEqual(storage.dequeue(), b('l3'))
+            self.assertEqual(storage.dequeue(), None)
+        finally:
+            storage.blocking = False
+
+    def test_priority_weights(self):
+        storage = self.huey.storage
+        storage.enqueue_many(['h%s' % i for i in range(50)], priority=1)
+        storage.enqueue_many(['l%s' % i for i in range(50)])
+
+        # Low priority messages are dequeued even while high priority
+        # messages are waiting.
+        storage.priority_weights = {1: 3, 0: 1}
+        try:
+            messages = storage.dequeue_many(40)
+        finally:
+            storage.priority_weights = None
+        low = [m for m in messages if m.startswith(b('l'))]
+        self.assertTrue(0 < len(low) < 20)
+
+        # Ordering within a priority is preserved.
+        high = [m for m in messages if m.startswith(b('h'))]
+        self.assertEqual(high, [b('h%s' % i) for i in range(len(high))])
+
     def test_data_stores(self):
         storage = self.huey.storage
         storage.put_data('k1', 'v1')
@@ -38,6 +138,24 @@ class TestRedisStorage(HueyTestCase):
         storage.put_data('k3', 'v3-2')
         self.assertEqual(storage.peek_data('k3'), b('v3-2'))
 
+        # Empty values are distinct from missing values.
+        storage.put_data('k4', '')
+        self.assertEqual(storage.peek_data('k4'), b(''))
+        self.assertEqual(storage.pop_data('k4'), b(''))
+        self.assertEqual(storage.pop_data('k4'), EmptyData)
+        self.assertFalse(storage.has_data_for_key('k4'))
+
+    def test_get_data_many(self):
+        storage = self.huey.storage
+        storage.put_data('k1', 'v1')
+        storage.put_data('k2', '')
+        self.assertEqual(storage.get_data_many(['k1', 'kx', 'k2'], peek=True),
+                         [b('v1'), EmptyData, b('')])
+        self.assertEqual(storage.get_data_many(['k2', 'k1']), [b(''), b('v1')])
+        self.assertEqual(storage.get_data_many(['k1', 'k2']),
+                         [EmptyData, EmptyData])
+        self.assertEqual(storage.result_store_size(), 0)
+
     def test_schedules(self):
         storage = self.huey.storage
         dt1 = datetime.datetime(2013, 1, 1, 0, 0)
@@ -70,6 +188,61 @@ class TestRedisStorage(HueyTestCase):
         self.assertEqual(storage.read_schedule(dt4), [b('s4')])
         self.assertEqual(storage.read_schedule(dt4), [])
 
+    def test_schedule_limit(self):
+        storage = self.huey.storage
+        dt = datetime.datetime(2013, 1, 1, 0, 0)
+        for i in range(5):
+            storage.add_to_schedule('s%s' % i, dt + datetime.timedelta(i))
+
+        # The oldest items are read first, and only those read are removed.
+        now = dt + datetime.timedelta(3)
+        self.assertEqual(storage.read_schedule(now, 2), [b('s0'), b('s1')])
+        self.assertEqual(storage.schedule_size(), 3)
+        self.assertEqual(storage.read_schedule(now, 2), [b('s2'), b('s3')])
+        self.assertEqual(storage.read_schedule(now, 2), [])
+        self.assertEqual(storage.scheduled_items(), [b('s4')])
+
+    def test_iter_schedule(self):
+        storage = self.huey.storage
+        dt = datetime.datetime(2013, 1, 1, 0, 0)
+        for i in range(25):
+            storage.add_to_schedule('s%02d' % i, dt + datetime.timedelta(i))
+
+        self.assertEqual(storage.scheduled_items(2), [b('s00'), b('s01')])
+        self.assertEqual(sorted(storage.iter_scheduled(chunk_size=10)),
+                         [b('s%02d' % i) for i in range(25)])
+
+    def test_iter_results(self):
+        storage = self.huey.storage
+        for i in range(25):
+            storage.put_data('k%s' % i, 'v%s' % i)
+        self.assertEqual(dict(storage.iter_results(chunk_size=10)),
+                         storage.result_items())
+        self.assertEqual(len(storage.result_items()), 25)
+
+    def test_promote_schedule(self):
+        storage = self.huey.storage
+        dt = datetime.datetime(2013, 1, 1, 0, 0)
+        storage.add_to_schedule('s0', dt)
+        storage.add_to_schedule('s1', dt + datetime.timedelta(1), 5)
+        storage.add_to_schedule('s2', dt + datetime.timedelta(2))
+        storage.add_to_schedule('s3', dt + datetime.timedelta(3), 5)
+
+        now = dt + datetime.timedelta(2)
+        self.assertEqual(storage.promote_schedule(now, 2), 2)
+        self.assertEqual(storage.promote_schedule(now, 2), 1)
+        self.assertEqual(storage.promote_schedule(now, 2), 0)
+        self.assertEqual(storage.scheduled_items(), [b('s3')])
+
+        # Messages are queued at the priority they were scheduled with.
+        self.assertEqual(storage.dequeue_many(3), [b('s1'), b('s0'), b('s2')])
+
+        # Reading the schedule discards the recorded priority.
+        self.assertEqual(storage.read_schedule(dt + datetime.timedelta(3)),
+                         [b('s3')])
+        self.assertFalse(storage.conn.exists(
+            storage.schedule_destinations_key))
+
     def test_events(self):
         storage = self.huey.storage
         ps = storage.listener()
@@ -94,3 +267,742 @@ class TestRedisStorage(HueyTestCase):
         self.assertEqual(res, 'a')
         res = next(i)
         self.assertEqual(res, 'b')
+
+
+class TestReliableRedisStorage(BaseTestCase):
+    def setUp(self):
+        self.storage = RedisStorage('testing-reliable', reliable=True,
+                                    visibility_timeout=60, consumer_id='c1')
+        self.storage.flush_queue()
+
+    def tearDown(self):
+        self.storage.flush_queue()
+
+    def test_ack(self):
+        storage = self.storage
+        storage.enqueue_many(['m1', 'm2', 'm3'])
+        self.assertEqual(storage.dequeue(), b('m1'))
+        self.assertEqual(storage.dequeue_many(5), [b('m2'), b('m3')])
+        self.assertEqual(storage.queue_size(), 0)
+        self.assertEqual(storage.inflight_size(), 3)
+        self.assertEqual(storage.conn.llen(storage.processing_key), 3)
+
+        storage.ack(b('m2'))
+        self.assertEqual(storage.inflight_size(), 2)
+        self.assertEqual(storage.conn.lrange(storage.processing_key, 0, -1),
+                         [b('m3'), b('m1')])
+
+        # Nothing has expired yet.
+        self.assertEqual(storage.requeue_expired(), 0)
+
+        # Only messages that are still in flight are touched.
+        self.assertTrue(storage.touch(b('m3')))
+        self.assertFalse(storage.touch(b('m2')))
+        self.assertEqual(storage.inflight_size(), 2)
+
+        # Returning prefetched messages removes them from the in-flight set.
+        storage.requeue([b('m3')])
+        self.assertEqual(storage.inflight_size(), 1)
+        self.assertEqual(storage.dequeue(), b('m3'))
+
+    def test_requeue_expired(self):
+        storage = self.storage
+        storage.enqueue_many(['m%s' % i for i in range(5)])
+        storage.visibility_timeout = -1
+        storage.reap_batch_size = 2
+        self.assertEqual(len(storage.dequeue_many(3)), 3)
+        storage.visibility_timeout = 60
+        storage.dequeue()
+
+        # Expired messages are requeued in bounded batches, and are the next
+        # messages to be dequeued.
+        self.assertEqual(storage.requeue_expired(), 2)
+        self.assertEqual(storage.requeue_expired(), 1)
+        self.assertEqual(storage.requeue_expired(), 0)
+        self.assertEqual(storage.inflight_size(), 1)
+        self.assertEqual(storage.conn.lrange(storage.processing_key, 0, -1),
+                         [b('m3')])
+        self.assertEqual(sorted(storage.dequeue_many(4)),
+                         [b('m0'), b('m1'), b('m2'), b('m4')])
+
+    def test_requeue_expired_priority(self):
+        storage = self.storage
+        storage.enqueue('m1')
+        storage.enqueue('h1', priority=5)
+        storage.visibility_timeout = -1
+        self.assertEqual(storage.dequeue_many(2), [b('h1'), b('m1')])
+        storage.visibility_timeout = 60
+        storage.enqueue('m2')
+
+        # Expired messages go back to the queue for their priority.
+        self.assertEqual(storage.requeue_expired(), 2)
+        self.assertEqual(storage.dequeue_many(3), [b('h1'), b('m1'), b('m2')])
+
+    def test_blocking_dequeue(self):
+        storage = self.storage
+        storage.blocking = True
+        storage.read_timeout = 0.1
+        storage.enqueue('m1')
+        self.assertEqual(storage.dequeue(), b('m1'))
+        self.assertEqual(storage.inflight_size(), 1)
+        self.assertEqual(storage.dequeue(), None)
+        storage.ack(b('m1'))
+        self.assertEqual(storage.inflight_size(), 0)
+
+        # A message moved to the processing list by a consumer that died
+        # before recording it as in flight is given a deadline, and is
+        # requeued once that expires.
+        storage.enqueue('m2')
+        storage.conn.rpoplpush(storage.queue_key, storage.processing_key)
+        self.assertEqual(storage.requeue_expired(), 0)
+        self.assertEqual(storage.inflight_size(), 1)
+        storage._zadd(storage.conn, storage.inflight_key, 0, 'm2')
+        self.assertEqual(storage.requeue_expired(), 1)
+        self.assertEqual(storage.conn.llen(storage.processing_key), 0)
+        self.assertEqual(storage.dequeue(), b('m2'))
+
+
+class TestRedisResultKeys(BaseTestCase):
+    def setUp(self):
+        self.storage = RedisStorage('testing-keys', result_keys=True,
+                                    result_ttl=60)
+        self.storage.flush_results()
+
+    def tearDown(self):
+        self.storage.flush_results()
+
+    def test_result_ttl_requires_keys(self):
+        self.assertRaises(ValueError, RedisStorage, 'testing-keys',
+                          result_ttl=60)
+
+    def test_data_stores(self):
+        storage = self.storage
+        storage.put_result('k1', 'v1')
+        storage.put_result('k2', '')
+        storage.put_data('k3', 'v3')
+        self.assertEqual(storage.result_store_size(), 3)
+        self.assertEqual(storage.result_items(),
+                         {b('k1'): b('v1'), b('k2'): b(''), b('k3'): b('v3')})
+
+        # Results expire, other data is kept indefinitely.
+        self.assertEqual(storage.conn.ttl(storage.result_prefix + 'k1'), 60)
+        # Older versions of redis-py return None rather than -1.
+        self.assertTrue(storage.conn.ttl(storage.result_prefix + 'k3') in
+                        (None, -1))
+
+        self.assertEqual(storage.peek_data('k2'), b(''))
+        self.assertEqual(storage.pop_data('k2'), b(''))
+        self.assertEqual(storage.peek_data('k2'), EmptyData)
+        self.assertEqual(storage.pop_data('k2'), EmptyData)
+        self.assertFalse(storage.has_data_for_key('k2'))
+        self.assertTrue(storage.has_data_for_key('k1'))
+        self.assertEqual(storage.result_store_size(), 2)
+
+        # Once a result key expires, it no longer counts towards the size.
+        storage.conn.delete(storage.result_prefix + 'k1')
+        storage._zadd(storage.conn, storage.result_index_key, 1,
+                      storage.result_prefix + 'k1')
+        self.assertEqual(storage.result_store_size(), 1)
+        self.assertEqual(storage.result_items(), {b('k3'): b('v3')})
+        self.assertEqual(list(storage.iter_results(chunk_size=1)),
+                         [(b('k3'), b('v3'))])
+
+    def test_get_data_many(self):
+        storage = self.storage
+        storage.put_result('k1', 'v1')
+        storage.put_result('k2', 'v2')
+        self.assertEqual(storage.get_data_many(['k1', 'kx'], peek=True),
+                         [b('v1'), EmptyData])
+        self.assertEqual(storage.get_data_many(['k1', 'k2', 'kx']),
+                         [b('v1'), b('v2'), EmptyData])
+        self.assertEqual(storage.result_store_size(), 0)
+
+    def test_migrate_results(self):
+        storage = self.storage
+        for i in range(25):
+            storage.conn.hset(storage.result_key, 'k%s' % i, 'v%s' % i)
+
+        self.assertEqual(storage.migrate_results(batch_size=10), 25)
+        self.assertFalse(storage.conn.exists(storage.result_key))
+        self.assertEqual(storage.result_store_size(), 25)
+        self.assertEqual(storage.pop_data('k7'), b('v7'))
+        self.assertEqual(storage.conn.ttl(storage.result_prefix + 'k8'), 60)
+
+
+class TestRedisErrorIndex(BaseTestCase):
+    def setUp(self):
+        self.storage = RedisStorage('testing-errors', max_errors=10,
+                                    error_index=True)
+        self.storage.flush_errors()
+
+    def tearDown(self):
+        self.storage.flush_errors()
+
+    def test_put_errors(self):
+        storage = self.storage
+        storage.put_errors(['a0', 'b0', 'a1'], ['a', 'b', 'a'])
+        storage.put_error('b1', 'b')
+        storage.put_error('x0')
+        self.assertEqual(storage.get_errors(),
+                         [b('x0'), b('b1'), b('a1'), b('b0'), b('a0')])
+        self.assertEqual(storage.get_errors(task_name='a'),
+                         [b('a1'), b('a0')])
+        self.assertEqual(storage.get_errors(task_name='b', limit=1),
+                         [b('b1')])
+        self.assertEqual(storage.get_errors(task_name='c'), [])
+        self.assertEqual(storage.get_errors(limit=2, offset=1),
+                         [b('b1'), b('a1')])
+        self.assertEqual(list(storage.iter_errors(2)),
+                         storage.get_errors())
+        self.assertEqual(list(storage.iter_errors(1, 'a')),
+                         [b('a1'), b('a0')])
+
+        # Errors without a task name are not indexed.
+        storage.put_errors(['b2', 'x1'], ['b', None])
+        self.assertEqual(storage.get_errors(limit=2), [b('x1'), b('b2')])
+        self.assertEqual(storage.get_errors(task_name='b'),
+                         [b('b2'), b('b1'), b('b0')])
+        self.assertEqual(
+            sorted(storage.conn.smembers(storage.error_index_key)),
+            [b(storage.error_key_for('a')), b(storage.error_key_for('b'))])
+
+        # The list and the indexes are trimmed once they exceed the cap.
+        storage.put_errors(['a%s' % i for i in range(2, 12)], ['a'] * 10)
+        self.assertEqual(len(storage.get_errors()), 10)
+        self.assertEqual(len(storage.get_errors(task_name='a')), 10)
+        self.assertEqual(storage.get_errors(task_name='a', limit=1),
+                         [b('a11')])
+
+        storage.flush_errors()
+        self.assertEqual(storage.get_errors(), [])
+        self.assertEqual(storage.get_errors(task_name='a'), [])
+        self.assertFalse(storage.conn.exists(storage.error_key_for('b')))
+
+    def test_requires_index(self):
+        storage = RedisStorage('testing-errors')
+        storage.put_errors(['e0', 'e1'], ['a', 'a'])
+        self.assertEqual(storage.get_errors(), [b('e1'), b('e0')])
+        self.assertRaises(ValueError, storage.get_errors, task_name='a')
+
+
+class TestRedisConnectionPool(BaseTestCase):
+    def test_pool_stats(self):
+        storage = RedisStorage('testing-pool')
+        self.assertEqual(storage.pool_stats()['checkouts'], 0)
+        storage.enqueue(b('a'))
+        self.assertEqual(storage.dequeue(), b('a'))
+        stats = storage.pool_stats()
+        self.assertEqual(stats['checkouts'], 2)
+        self.assertEqual(stats['created'], 1)
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(stats['max_in_use'], 1)
+        self.assertEqual(stats['waits'], 0)
+
+        # A pool passed in by the caller is not instrumented.
+        pool = redis.ConnectionPool()
+        self.assertEqual(RedisStorage('testing-pool',
+                                      connection_pool=pool).pool_stats(), {})
+
+    def test_configure_pool(self):
+        # Pools without a limit are left alone.
+        storage = RedisStorage('testing-pool')
+        storage.configure_pool(5)
+        self.assertFalse(storage.pool_stats()['max_connections'] == 5)
+
+        storage = RedisStorage('testing-pool', max_connections=2)
+        storage.configure_pool(5)
+        self.assertEqual(storage.pool_stats()['max_connections'], 5)
+
+        # The pool is never made smaller.
+        storage.configure_pool(3)
+        self.assertEqual(storage.pool_stats()['max_connections'], 5)
+
+        # The scripts are bound to the new connection.
+        storage.flush_queue()
+        storage.enqueue(b('a'))
+        self.assertEqual(storage.dequeue(), b('a'))
+
+    def test_contention(self):
+        storage = RedisStorage('testing-pool', max_connections=1,
+                               pool_timeout=0.1)
+        connection = storage.pool.get_connection('PING')
+        self.assertRaises(redis.ConnectionError, storage.queue_size)
+        stats = storage.pool_stats()
+        self.assertEqual(stats['timeouts'], 1)
+
+        def release():
+            time.sleep(0.05)
+            storage.pool.release(connection)
+
+        t = threading.Thread(target=release)
+        t.start()
+        storage.pool.timeout = 1
+        storage.queue_size()
+        t.join()
+        stats = storage.pool_stats()
+        self.assertEqual(stats['waits'], 1)
+        self.assertTrue(stats['wait_time'] > 0)
+        self.assertEqual(stats['in_use'], 0)
+
+    def test_after_fork(self):
+        storage = RedisStorage('testing-pool', max_connections=4)
+        storage.queue_size()
+        pool = storage.pool
+        storage.after_fork()
+        self.assertFalse(storage.pool is pool)
+        self.assertEqual(storage.pool_stats()['max_connections'], 4)
+        self.assertEqual(storage.pool_stats()['created'], 0)
+
+        # The inherited connection was left open for the parent.
+        self.assertTrue(pool._connections[0]._sock is not None)
+        storage.flush_queue()
+        storage.enqueue(b('a'))
+        self.assertEqual(storage.dequeue(), b('a'))
+
+
+class StorageConformanceMixin(object):
+    """
+    Checks that every storage must pass. Test cases create ``self.storage``
+    with ``max_errors=3`` in ``setUp()`` and implement ``get_huey()``.
+    """
+    # Whether the storage returns the messages and values it stores as bytes.
+    binary = True
+
+    def encoded(self, value):
+        return b(value) if self.binary else value
+
+    def get_huey(self):
+        raise NotImplementedError
+
+    def test_queues(self):
+        storage = self.storage
+        e = self.encoded
+        storage.enqueue('m1')
+        storage.enqueue('h1', priority=10)
+        storage.enqueue_many(['m2', 'm3'])
+        self.assertEqual(storage.queue_size(), 4)
+        self.assertEqual(storage.enqueued_items(),
+                         [e('h1'), e('m3'), e('m2'), e('m1')])
+        self.assertEqual(storage.enqueued_items(2), [e('h1'), e('m3')])
+
+        self.assertEqual(storage.dequeue(), e('h1'))
+        self.assertEqual(storage.dequeue_many(2), [e('m1'), e('m2')])
+        storage.requeue([e('m1'), e('m2')])
+        self.assertEqual(storage.enqueued_items(), [e('m3'), e('m2'), e('m1')])
+        self.assertEqual(storage.unqueue('m2'), 1)
+        self.assertEqual(storage.dequeue_many(5), [e('m1'), e('m3')])
+        self.assertEqual(storage.dequeue(), None)
+        self.assertEqual(storage.queue_size(), 0)
+
+        storage.enqueue('m4')
+        storage.flush_queue()
+        self.assertEqual(storage.queue_size(), 0)
+        self.assertEqual(storage.dequeue(), None)
+
+    def test_schedule(self):
+        storage = self.storage
+        e = self.encoded
+        dt = datetime.datetime(2013, 1, 1, 0, 0)
+        storage.add_to_schedule('s2', dt + datetime.timedelta(2))
+        storage.add_to_schedule('s0', dt)
+        storage.add_to_schedule('s1', dt + datetime.timedelta(1), 5)
+        storage.add_to_schedule('s3', dt + datetime.timedelta(3))
+        self.assertEqual(storage.schedule_size(), 4)
+        self.assertEqual(storage.scheduled_items(),
+                         [e('s0'), e('s1'), e('s2'), e('s3')])
+
+        self.assertEqual(storage.read_schedule(dt), [e('s0')])
+        self.assertEqual(
+            storage.promote_schedule(dt + datetime.timedelta(2), 1), 1)
+        self.assertEqual(storage.promote_schedule(dt + datetime.timedelta(2)),
+                         1)
+        self.assertEqual(storage.dequeue_many(2), [e('s1'), e('s2')])
+        self.assertEqual(storage.scheduled_items(), [e('s3')])
+
+    def test_data(self):
+        storage = self.storage
+        e = self.encoded
+        storage.put_data('k1', 'v1')
+        storage.put_data('k2', '')
+        storage.put_data('k1', 'v1-2')
+        self.assertEqual(storage.peek_data('k1'), e('v1-2'))
+        self.assertEqual(storage.pop_data('k2'), e(''))
+        self.assertEqual(storage.pop_data('k2'), EmptyData)
+        self.assertTrue(storage.has_data_for_key('k1'))
+        self.assertFalse(storage.has_data_for_key('k2'))
+        storage.put_data('r:k3', 'v3')
+        self.assertEqual(sorted(storage.result_items().values()),
+                         [e('v1-2'), e('v3')])
+        self.assertEqual(storage.get_data_many(['k1', 'kx'], peek=True),
+                         [e('v1-2'), EmptyData])
+        self.assertEqual(storage.get_data_many(['k1', 'kx']),
+                         [e('v1-2'), EmptyData])
+        self.assertEqual(storage.result_store_size(), 1)
+
+    def test_errors(self):
+        storage = self.storage
+        e = self.encoded
+        storage.put_errors(['e0', 'e1'], ['a', 'b'])
+        storage.put_error('e2', 'a')
+        self.assertEqual(storage.get_errors(), [e('e2'), e('e1'), e('e0')])
+        self.assertEqual(storage.get_errors(limit=1, offset=1), [e('e1')])
+        self.assertEqual(storage.get_errors(task_name='a'), [e('e2'), e('e0')])
+
+        # Only the most recent max_errors errors are kept.
+        storage.put_error('e3')
+        self.assertEqual(storage.get_errors(), [e('e3'), e('e2'), e('e1')])
+        storage.flush_errors()
+        self.assertEqual(storage.get_errors(), [])
+
+    def test_huey(self):
+        huey = self.get_huey()
+
+        @huey.task()
+        def add(a, b):
+            return a + b
+
+        results = add.map([(i, i) for i in range(10)])
+        for i in range(10):
+            huey.execute(huey.dequeue())
+        self.assertEqual(results.get(), [i * 2 for i in range(10)])
+        self.assertEqual(len(huey), 0)
+
+
+class TestMemoryStorage(StorageConformanceMixin, BaseTestCase):
+    binary = False
+
+    def setUp(self):
+        self.storage = MemoryStorage('testing-memory', max_errors=3)
+
+    def get_huey(self):
+        return MemoryHuey('testing-memory')
+
+    def test_blocking_dequeue(self):
+        storage = MemoryStorage('testing-memory', blocking=True,
+                                read_timeout=5)
+        timer = threading.Timer(0.01, storage.enqueue, ('m1',))
+        timer.start()
+        self.assertEqual(storage.dequeue(), 'm1')
+        timer.join()
+
+        # Storing a result does not cut the wait for a message short.
+        timers = [threading.Timer(0.01, storage.put_data, ('k1', 'v1')),
+                  threading.Timer(0.1, storage.enqueue, ('m2',))]
+        for timer in timers:
+            timer.start()
+        self.assertEqual(storage.dequeue_many(2), ['m2'])
+        for timer in timers:
+            timer.join()
+
+        storage.read_timeout = 0.01
+        self.assertEqual(storage.dequeue(), None)
+
+    def test_wait_for_data(self):
+        storage = self.storage
+        timer = threading.Timer(0.01, storage.put_result, ('k3', 'v3'))
+        timer.start()
+        self.assertTrue(storage.wait_for_data('k3', 5))
+        self.assertEqual(storage.result_items(), {'k3': 'v3'})
+        timer.join()
+
+    def test_events(self):
+        storage = self.storage
+        storage.emit('"dropped"')
+        i = iter(storage)
+        storage.emit('"a"')
+        storage.emit('"b"')
+        self.assertEqual(next(i), 'a')
+        self.assertEqual(next(i), 'b')
+
+        # Closed or discarded listeners are unsubscribed.
+        i.close()
+        self.assertEqual(len(storage._subscribers), 0)
+        i = iter(storage)
+        self.assertEqual(len(storage._subscribers), 1)
+        del i
+        gc.collect()
+        self.assertEqual(len(storage._subscribers), 0)
+
+    def test_events_bounded(self):
+        storage = MemoryStorage('testing-memory', max_events=2)
+        i = iter(storage)
+        for message in ('"a"', '"b"', '"c"'):
+            storage.emit(message)
+        self.assertEqual(next(i), 'a')
+        self.assertEqual(next(i), 'b')
+        self.assertTrue(i.queue.empty())
+        i.close()
+
+
+class TestSqliteStorage(StorageConformanceMixin, BaseTestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'huey.db')
+        self.storage = SqliteStorage('testing-sqlite', self.filename,
+                                     max_errors=3)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def get_huey(self):
+        return SqliteHuey('testing-sqlite', filename=self.filename)
+
+    def test_batch(self):
+        storage = self.storage
+        with storage.batch():
+            storage.enqueue('m1')
+            storage.enqueue('m2')
+        self.assertEqual(storage.enqueued_items(), [b('m2'), b('m1')])
+
+        # The queue is durable and shared between connections.
+        other = SqliteStorage('testing-sqlite', self.filename)
+        self.assertEqual(other.dequeue_many(5), [b('m1'), b('m2')])
+        self.assertEqual(storage.queue_size(), 0)
+
+    def test_batch_rollback(self):
+        storage = self.storage
+        try:
+            with storage.batch():
+                storage.enqueue('m1')
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(storage.queue_size(), 0)
+
+    def test_blocking_dequeue(self):
+        storage = self.storage
+        storage.blocking = True
+        storage.read_timeout = 1
+        storage.poll_interval = 0.25
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            if len(sleeps) == 2:
+                storage.enqueue('m1')
+
+        _sleep = time.sleep
+        time.sleep = sleep
+        try:
+            self.assertEqual(storage.dequeue(), b('m1'))
+        finally:
+            time.sleep = _sleep
+        self.assertEqual(sleeps, [0.25, 0.25])
+
+
+class TestFileStorage(StorageConformanceMixin, BaseTestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.storage = FileStorage('testing-file', self.tempdir,
+                                   max_errors=3, segment_size=64)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def get_huey(self):
+        return FileHuey('testing-file', path=self.tempdir)
+
+    def segments(self, priority=0):
+        path = os.path.join(self.storage.queue_path, str(priority), 'queue')
+        return sorted(f for f in os.listdir(path) if f.endswith('.log'))
+
+    def test_instances(self):
+        # The queue is durable and shared between instances.
+        storage = self.storage
+        storage.enqueue_many(['m1', 'm2'])
+        storage.enqueue('l1', priority=-5)
+        other = FileStorage('testing-file', self.tempdir)
+        self.assertEqual(other.dequeue_many(5), [b('m1'), b('m2'), b('l1')])
+        self.assertEqual(storage.queue_size(), 0)
+
+    def test_segments(self):
+        storage = self.storage
+        messages = [b('message-%02d' % i) for i in range(20)]
+        for message in messages:
+            storage.enqueue(message)
+        # Each record takes 18 bytes, so three fit in a segment.
+        self.assertEqual(len(self.segments()), 7)
+        self.assertEqual(storage.queue_size(), 20)
+
+        # Segments are removed once they have been read.
+        self.assertEqual(storage.dequeue_many(9), messages[:9])
+        self.assertEqual(len(self.segments()), 5)
+        self.assertEqual(storage.queue_size(), 11)
+        self.assertEqual(storage.enqueued_items(), messages[:8:-1])
+        self.assertEqual(storage.dequeue_many(20), messages[9:])
+        self.assertEqual(len(self.segments()), 1)
+        storage.enqueue('m')
+        self.assertEqual(storage.dequeue(), b('m'))
+
+    def test_damaged_records(self):
+        storage = self.storage
+        log = storage._logs(0)[1]
+        storage.enqueue_many(['m1', 'm2'])
+        path = os.path.join(log.path, self.segments()[0])
+
+        # Data written past the last complete record, as by a write that was
+        # interrupted, is not read, and is overwritten by the next write.
+        with open(path, 'r+b') as fh:
+            fh.seek(2 * (log.header.size + 2))
+            fh.write(b('\x00\x00\x00\x09torn'))
+        self.assertEqual(storage.queue_size(), 2)
+        storage.enqueue('m3')
+        self.assertEqual(storage.enqueued_items(),
+                         [b('m3'), b('m2'), b('m1')])
+
+        # A record that fails its checksum ends the segment.
+        with open(path, 'r+b') as fh:
+            fh.seek(log.header.size + 2 + log.header.size)
+            fh.write(b('x2'))
+        self.assertEqual(storage.dequeue_many(5), [b('m1')])
+        self.assertEqual(storage.queue_size(), 0)
+        storage.enqueue('m4')
+        self.assertEqual(storage.dequeue(), b('m4'))
+
+    def test_rollover_between_instances(self):
+        # The reader maps the segment while it is being written, and the
+        # writer then moves to a new segment, cutting the old one short.
+        storage = FileStorage('testing-file', self.tempdir,
+                              segment_size=16384)
+        other = FileStorage('testing-file', self.tempdir,
+                            segment_size=16384)
+        storage.enqueue_many(['a', 'b'])
+        self.assertEqual(other.dequeue(), b('a'))
+        large = b('c') * 16370
+        storage.enqueue(large)
+        storage.enqueue('d')
+        self.assertEqual(other.queue_size(), 3)
+        self.assertEqual(other.dequeue_many(5), [b('b'), large, b('d')])
+        self.assertEqual(other.dequeue(), None)
+
+    @unittest.skipIf(fcntl is None, 'requires fcntl')
+    def test_lock(self):
+        storage = self.storage
+        fh = open(os.path.join(storage.path, 'lock'))
+        self.addCleanup(fh.close)
+
+        def is_locked():
+            try:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                return True
+            fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+            return False
+
+        # The file lock is held until the outermost holder is done.
+        with storage._lock():
+            with storage._lock():
+                self.assertTrue(is_locked())
+            self.assertTrue(is_locked())
+        self.assertFalse(is_locked())
+
+    @unittest.skipIf(not hasattr(os, 'fork'), 'requires os.fork()')
+    def test_processes(self):
+        storage = self.storage
+
+        def produce():
+            child = FileStorage('testing-file', self.tempdir,
+                                segment_size=64)
+            for i in range(50):
+                child.enqueue('p%s' % i)
+            os._exit(0)
+
+        pids = []
+        for i in range(3):
+            pid = os.fork()
+            if pid == 0:
+                produce()
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        messages = storage.dequeue_many(200)
+        self.assertEqual(len(messages), 150)
+        self.assertEqual(sorted(set(messages)),
+                         sorted(b('p%s' % i) for i in range(50)))
+
+
+class TestShardedRedisStorage(StorageConformanceMixin, BaseTestCase):
+    def setUp(self):
+        # Separate databases stand in for separate servers.
+        self.storage = ShardedRedisStorage(
+            'testing-sharded',
+            shards=[{'db': 1}, {'db': 2}, {'db': 3}],
+            max_errors=3, error_index=True)
+        self.storage.flush_all()
+
+    def tearDown(self):
+        self.storage.flush_all()
+
+    def get_huey(self):
+        return ShardedRedisHuey('testing-sharded',
+                                shards=[{'db': 1}, {'db': 2}])
+
+    def test_keys(self):
+        shard = self.storage.shards[1]
+        self.assertEqual(shard.queue_key, 'huey.redis.{testingsharded.1}')
+        self.assertEqual(shard.queue_key_for(5),
+                         'huey.redis.{testingsharded.1}.p5')
+        self.assertEqual(shard.conn.connection_pool.connection_kwargs['db'],
+                         2)
+
+    def test_queues(self):
+        # Messages are spread over the shards, so are not read in order.
+        storage = self.storage
+        messages = [b('m%s' % i) for i in range(10)]
+        storage.enqueue_many(messages[:6])
+        for message in messages[6:]:
+            storage.enqueue(message)
+        self.assertEqual(storage.queue_size(), 10)
+        for shard in storage.shards:
+            self.assertTrue(shard.queue_size() >= 3)
+        self.assertEqual(sorted(storage.enqueued_items()), sorted(messages))
+
+        accum = storage.dequeue_many(4)
+        while len(accum) < 10:
+            message = storage.dequeue()
+            self.assertTrue(message is not None)
+            accum.append(message)
+        self.assertEqual(sorted(accum), sorted(messages))
+        self.assertEqual(storage.dequeue(), None)
+
+        storage.enqueue('m0', priority=5)
+        self.assertEqual(storage.unqueue('m0'), 1)
+        self.assertEqual(storage.queue_size(), 0)
+
+    def test_schedule(self):
+        # As with the queue, the shards are not read in order.
+        storage = self.storage
+        dt = datetime.datetime(2013, 1, 1, 0, 0)
+        for i in range(6):
+            storage.add_to_schedule('s%s' % i, dt, i % 2)
+        self.assertEqual(storage.schedule_size(), 6)
+        self.assertEqual(storage.promote_schedule(dt, 3), 3)
+        self.assertEqual(len(storage.read_schedule(dt, 2)), 2)
+        self.assertEqual(storage.promote_schedule(dt), 1)
+        self.assertEqual(storage.queue_size(), 4)
+
+    def test_schedule_uneven(self):
+        # All of the due tasks are on one shard. A batch is only short once
+        # that shard has been drained.
+        storage = self.storage
+        dt = datetime.datetime(2013, 1, 1, 0, 0)
+        for i in range(8):
+            storage.shards[1].add_to_schedule('s%s' % i, dt)
+        self.assertEqual(storage.promote_schedule(dt, 3), 3)
+        self.assertEqual(len(storage.read_schedule(dt, 3)), 3)
+        self.assertEqual(storage.promote_schedule(dt, 3), 2)
+        self.assertEqual(storage.promote_schedule(dt, 3), 0)
+        self.assertEqual(storage.queue_size(), 5)
+
+    def test_data_shards(self):
+        storage = self.storage
+        keys = ['k%s' % i for i in range(20)]
+        for key in keys:
+            storage.put_data(key, key)
+        counts = [shard.result_store_size() for shard in storage.shards]
+        self.assertEqual(sum(counts), 20)
+        self.assertTrue(all(counts))
+        self.assertEqual(storage.get_data_many(['k2', 'kx', 'k3']),
+                         [b('k2'), EmptyData, b('k3')])
+        self.assertEqual(storage.result_store_size(), 18)
+        self.assertEqual(len(storage.result_items()), 18)